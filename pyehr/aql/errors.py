@@ -61,6 +61,15 @@ class ParsePredicateExpressionError(Exception):
         return repr(self.value)
 
 
+class ParseGroupByError(Exception):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
 class ParseOrderRulesError(Exception):
 
     def __init__(self, value):
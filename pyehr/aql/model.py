@@ -138,12 +138,19 @@ class ValueRange(Primitive):
 
 
 class Variable(object):
+
+    AGGREGATE_FUNCTIONS = ('COUNT', 'MIN', 'MAX', 'SUM', 'AVG')
+
     def __init__(self):
         self.variable = None
         self.label = None
+        # the aggregate function applied to the variable, a COUNT(*) has no variable
+        self.function = None
 
     def __str__(self):
         str_list = ["VARIABLE"]
+        if self.function:
+            str_list.append(" -> FUNCTION: %s" % self.function)
         if self.variable:
             str_list.append(" -> VARIABLE: %s" % str(self.variable))
         if self.label:
@@ -196,9 +203,15 @@ class Selection(object):
     def __init__(self):
         self.top = -1
         self.variables = []
+        # True if the selection contains aggregate functions or the query has a GROUP BY clause
+        self.aggregated = False
+
+    @property
+    def group_variables(self):
+        return [v for v in self.variables if not v.function]
 
     def __str__(self):
-        str_list = ["SELECTION", " -> TOP: %d" % self.top]
+        str_list = ["SELECTION", " -> TOP: %d" % self.top, " -> AGGREGATED: %s" % self.aggregated]
         for v in self.variables:
             str_list.append(" -> VARIABLE: %s" % str(v))
         s = "\n".join(str_list)
@@ -304,12 +317,33 @@ class Condition(object):
         return s
 
 
+class OrderRule(object):
+
+    DIRECTIONS = ('ASC', 'DESC')
+
+    def __init__(self):
+        # the selected variable used to sort the results
+        self.variable = None
+        self.direction = 'ASC'
+
+    def __str__(self):
+        str_list = ["ORDER_RULE", " -> DIRECTION: %s" % self.direction]
+        if self.variable:
+            str_list.append(" -> VARIABLE: %s" % str(self.variable))
+        s = "\n".join(str_list)
+        return s
+
+
 class OrderRules(object):
     def __init__(self):
-        pass
+        self.rules = []
 
     def __str__(self):
-        return "None"
+        str_list = ["ORDER_RULES"]
+        for r in self.rules:
+            str_list.append(" -> RULE: %s" % str(r))
+        s = "\n".join(str_list)
+        return s
 
 
 class TimeConstraints(object):
@@ -325,6 +359,7 @@ class QueryModel(object):
         self.selection = None
         self.location = None
         self.condition = None
+        self.group_by = None
         self.order_rules = None
         self.time_constraints = None
 
@@ -336,6 +371,8 @@ class QueryModel(object):
         str_list.append(str(self.location))
         str_list.append("-- CONDITION --")
         str_list.append(str(self.condition))
+        str_list.append("-- GROUP_BY --")
+        str_list.append(str(self.group_by))
         str_list.append("-- ORDER_RULES --")
         str_list.append(str(self.order_rules))
         str_list.append("-- TIME_CONSTRAINTS --")
@@ -1,20 +1,26 @@
 import re
 from errors import InvalidAQLError, ParsingError, ParsePredicateExpressionError,\
-    ParsePathError, ParseSelectionError, ParseLocationError, ParseConditionError
+    ParsePathError, ParseSelectionError, ParseLocationError, ParseConditionError,\
+    ParseGroupByError, ParseOrderRulesError
 from pyehr.aql.model import QueryModel, NodePredicate, Predicate, ArchetypePredicate, IdentifiedPath, Selection, \
     Variable, Path, NodePath, ClassExpression, Container, Location, Condition, ConditionSequence, ConditionOperator,\
-    PredicateExpression
+    PredicateExpression, OrderRules, OrderRule
 from pyehr.utils import get_logger
 
 
 class Parser(object):
 
     KEYWORDS = ('EHR', 'COMPOSITION', 'OBSERVATION', 'CONTAINS')
+    # optional clauses that can follow the FROM clause
+    CLAUSES = (' WHERE ', ' GROUP BY ', ' ORDER BY ', ' TIMEWINDOW ')
+    AGGREGATE_FUNCTION = re.compile(r'^(?P<function>%s)\s*\((?P<argument>[^)]*)\)(\s+AS\s+(?P<label>\S+))?$' %
+                                    '|'.join(Variable.AGGREGATE_FUNCTIONS), re.IGNORECASE)
 
     def __init__(self, logger=None):
         self.selection = None
         self.location = None
         self.condition = None
+        self.group_by = None
         self.order_rules = None
         self.time_constraints = None
         self.logger = logger or get_logger('pyehr-aql-parser')
@@ -23,6 +29,7 @@ class Parser(object):
         self.selection = None
         self.location = None
         self.condition = None
+        self.group_by = None
         self.order_rules = None
         self.time_constraints = None
         self.logger.debug('Parser resetted')
@@ -39,38 +46,26 @@ class Parser(object):
             else:
                 self.selection = text[7:result.start()]
                 location_start = result.start()+6
-                option_result = re.search(' WHERE | ORDER BY | TIMEWINDOW ', text.upper())
-                if option_result:
-                    location_end = option_result.start()
-                    self.location = text[location_start:location_end]
-                    optional_text = text[location_end:]
-                    where_result = re.search(' WHERE ', optional_text.upper())
-                    if where_result:
-                        condition_start = where_result.start()+7
-                        other_option_result = re.search(' ORDER BY | TIMEWINDOW ', optional_text.upper())
-                        if other_option_result and other_option_result.start() > condition_start:
-                            condition_stop = other_option_result.start()
-                            self.condition = optional_text[condition_start:condition_stop]
+                clauses = list()
+                for clause in self.CLAUSES:
+                    clause_result = re.search(clause, text.upper()[location_start:])
+                    if clause_result:
+                        clauses.append((location_start + clause_result.start(), clause))
+                clauses.sort()
+                if clauses:
+                    self.location = text[location_start:clauses[0][0]]
+                    # each clause ends where the following one begins
+                    for i, (clause_start, clause) in enumerate(clauses):
+                        clause_stop = clauses[i+1][0] if i < len(clauses)-1 else len(text)
+                        clause_text = text[clause_start+len(clause):clause_stop]
+                        if clause == ' WHERE ':
+                            self.condition = clause_text
+                        elif clause == ' GROUP BY ':
+                            self.group_by = clause_text
+                        elif clause == ' ORDER BY ':
+                            self.order_rules = clause_text
                         else:
-                            self.condition = optional_text[condition_start:]
-                    order_result = re.search(' ORDER BY ', optional_text.upper())
-                    if order_result:
-                        order_start = order_result.start()+7
-                        other_option_result = re.search(' WHERE | TIMEWINDOW ', optional_text.upper())
-                        if other_option_result and other_option_result.start() > order_start:
-                            order_stop = other_option_result.start()
-                            self.order_rules = optional_text[order_start:order_stop]
-                        else:
-                            self.order_rules = optional_text[order_start:]
-                    time_result = re.search(' TIMEWINDOW ', optional_text.upper())
-                    if time_result:
-                        time_start = time_result.start()+7
-                        other_option_result = re.search(' WHERE | ORDER BY ', optional_text.upper())
-                        if other_option_result and other_option_result.start() > time_start:
-                            time_stop = other_option_result.start()
-                            self.time_constraints = optional_text[time_start:time_stop]
-                        else:
-                            self.time_constraints = optional_text[time_start:]
+                            self.time_constraints = clause_text
                 else:
                     self.location = text[location_start:]
         except Exception as e:
@@ -83,10 +78,12 @@ class Parser(object):
         query.location = self.parse_location(self.location)
         if self.condition:
             query.condition = self.parse_condition(self.condition)
+        if self.group_by:
+            query.group_by = self.parse_group_by(self.group_by, query.selection)
         if self.order_rules:
-            query.orderRules = self.parse_order_rules(self.order_rules)
+            query.order_rules = self.parse_order_rules(self.order_rules, query.selection)
         if self.time_constraints:
-            query.timeConstraints = self.parse_time_constraints(self.time_constraints)
+            query.time_constraints = self.parse_time_constraints(self.time_constraints)
         return query
 
     def parse_predicate_expression(self, expression):
@@ -201,7 +198,18 @@ class Parser(object):
                 for cl in classes:
                     variable = Variable()
                     class_tokens = cl.strip().split(" ")
-                    if class_tokens and len(class_tokens) == 3:
+                    aggregate_function = self.AGGREGATE_FUNCTION.match(cl.strip())
+                    if aggregate_function:
+                        variable.function = aggregate_function.group('function').upper()
+                        argument = aggregate_function.group('argument').strip()
+                        if argument != '*':
+                            variable.variable = self.parse_identified_path(argument)
+                        elif variable.function != 'COUNT':
+                            raise ParseSelectionError('Only COUNT function can be applied to *')
+                        variable.label = aggregate_function.group('label') or \
+                            '%s(%s)' % (variable.function, argument)
+                        selection.aggregated = True
+                    elif class_tokens and len(class_tokens) == 3:
                         variable.variable = self.parse_identified_path(class_tokens[0])
                         variable.label = class_tokens[2]
                     else:
@@ -338,9 +346,72 @@ class Parser(object):
         except Exception, e:
             raise ParseConditionError(e.message)
 
-    # TBD...
-    def parse_order_rules(self, order_rules):
-        raise NotImplementedError()
+    def _get_selected_variables_map(self, variables):
+        # map labels and identified paths to the selected variables
+        variables_map = dict()
+        for var in variables:
+            if var.variable:
+                variables_map['%s%s' % (var.variable.variable, var.variable.path.value)] = var
+            if var.label:
+                variables_map[var.label] = var
+        return variables_map
+
+    def parse_group_by(self, group_by, selection):
+        """
+        Parse the GROUP BY clause of an AQL statement. Each element of the clause is the label or the
+        identified path of a variable of the selection and all the selected variables without an aggregate
+        function must be part of the clause. Return the list of the grouping variables.
+        """
+        try:
+            group_variables = self._get_selected_variables_map(selection.group_variables)
+            variables = list()
+            for token in group_by.split(','):
+                try:
+                    var = group_variables[token.strip()]
+                except KeyError:
+                    raise ParseGroupByError('%s is not a selected variable' % token.strip())
+                if var not in variables:
+                    variables.append(var)
+            if len(variables) != len(selection.group_variables):
+                raise ParseGroupByError('Selected variables must be aggregated or part of the GROUP BY clause')
+            selection.aggregated = True
+            return variables
+        except ParseGroupByError:
+            raise
+        except Exception, e:
+            raise ParseGroupByError(str(e))
+
+    def parse_order_rules(self, order_rules, selection):
+        """
+        Parse the ORDER BY clause of an AQL statement. Each element of the clause is the label or the
+        identified path of a variable of the selection, optionally followed by the sort direction
+        (ASC, ASCENDING, DESC or DESCENDING).
+        """
+        try:
+            selected_variables = self._get_selected_variables_map(selection.variables)
+            rules = OrderRules()
+            for token in order_rules.split(','):
+                rule = OrderRule()
+                rule_tokens = token.split()
+                if len(rule_tokens) == 2:
+                    direction = rule_tokens[1].upper()
+                    if direction in ('ASCENDING', 'DESCENDING'):
+                        direction = direction[:-6]
+                    if direction not in OrderRule.DIRECTIONS:
+                        raise ParseOrderRulesError('Unknown sort direction %s' % rule_tokens[1])
+                    rule.direction = direction
+                elif len(rule_tokens) != 1:
+                    raise ParseOrderRulesError('Invalid order rule %s' % token.strip())
+                try:
+                    rule.variable = selected_variables[rule_tokens[0]]
+                except KeyError:
+                    raise ParseOrderRulesError('%s is not a selected variable' % rule_tokens[0])
+                rules.rules.append(rule)
+            return rules
+        except ParseOrderRulesError:
+            raise
+        except Exception, e:
+            raise ParseOrderRulesError(str(e))
 
     # TBD...
     def parse_time_constraints(self, time_constraints):
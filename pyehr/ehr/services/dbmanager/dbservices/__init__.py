@@ -2,7 +2,7 @@ from pyehr.ehr.services.dbmanager.drivers.factory import DriversFactory
 from pyehr.utils import get_logger
 from pyehr.ehr.services.dbmanager.dbservices.index_service import IndexService
 from pyehr.ehr.services.dbmanager.dbservices.wrappers import PatientRecord, ClinicalRecord
-from pyehr.ehr.services.dbmanager.errors import CascadeDeleteError, RedundantUpdateError,\
+from pyehr.ehr.services.dbmanager.errors import CascadeDeleteError,\
     RecordRestoreUnnecessaryError, OperationNotAllowedError, ConfigurationError
 from pyehr.ehr.services.dbmanager.dbservices.version_manager import VersionManager
 
@@ -26,12 +26,16 @@ class DBServices(object):
       records are stored
     :ivar logger: logger for the DBServices class, if no logger is provided a new one
       is created
+    :ivar revisions_mode: how older versions of clinical records are stored, 'full' saves
+      a copy of the clinical data, 'delta' saves the changes from the next version
+    :ivar snapshot_interval: in 'delta' mode, a full copy of the clinical data is saved
+      every snapshot_interval versions
     """
 
     def __init__(self, driver, host, database, versioning_database=None,
                  patients_repository=None, ehr_repository=None,
                  ehr_versioning_repository=None, port=None, user=None,
-                 passwd=None, logger=None):
+                 passwd=None, logger=None, revisions_mode='full', snapshot_interval=10):
         self.driver = driver
         self.host = host
         self.database = database
@@ -42,6 +46,8 @@ class DBServices(object):
         self.port = port
         self.user = user
         self.passwd = passwd
+        self.revisions_mode = revisions_mode
+        self.snapshot_interval = snapshot_interval
         self.index_service = None
         self.logger = logger or get_logger('db_services')
         self.version_manager = self._set_version_manager()
@@ -71,14 +77,16 @@ class DBServices(object):
             port=self.port,
             user=self.user,
             passwd=self.passwd,
-            logger=self.logger
+            logger=self.logger,
+            revisions_mode=self.revisions_mode,
+            snapshot_interval=self.snapshot_interval
         )
 
     def _check_index_service(self):
         if not self.index_service:
             raise ConfigurationError('Operation not allowed, missing IndexService')
 
-    def set_index_service(self, url, database, user, passwd):
+    def set_index_service(self, url, database, user, passwd, cache_size=1024, cache_ttl=None):
         """
         Add a :class:`IndexService` to the current :class:`DBService` that will be used
         to index clinical records
@@ -90,8 +98,13 @@ class DBServices(object):
         :type user: str
         :param passwd: the password to access the :class:`IndexService`
         :type passwd: str
+        :param cache_size: the number of structure IDs cached by the :class:`IndexService`, 0 disables the cache
+        :type cache_size: int
+        :param cache_ttl: if not None, the number of seconds after which a cached structure ID expires
+        :type cache_ttl: int
         """
-        self.index_service = IndexService(database, url, user, passwd, self.logger)
+        self.index_service = IndexService(database, url, user, passwd, self.logger,
+                                          cache_size, cache_ttl)
         # update version manager as well
         self.version_manager = self._set_version_manager()
 
@@ -188,9 +201,9 @@ class DBServices(object):
         for rec in ehr_records:
             if rec.record_id in saved:
                 saved_struct_counter[rec.structure_id] += 1
-        error_struct_counter = set([rec.record_id for rec in errors])
-        for struct, counter in saved_struct_counter.iteritems():
-            self.index_service.increase_structure_counter(struct, counter)
+        # all references counters are updated with a single request
+        self.index_service.apply_counter_deltas(saved_struct_counter)
+        error_struct_counter = set([rec.structure_id for rec in errors]) - set(saved_struct_counter)
         for struct in error_struct_counter:
             self.index_service.check_structure_counter(struct)
         saved_ehr_records = [ehr for ehr in ehr_records if ehr.record_id in saved]
@@ -342,6 +355,36 @@ class DBServices(object):
                                                         record_moved=True)
         return src_patient, dest_patient
 
+    def move_ehr_records(self, src_patient, dest_patient, ehr_records, reset_ehr_records_history=False):
+        """
+        Move a list of saved :class:`ClinicalRecord` objects from a saved :class:`PatientRecord` to another
+        one. Patient records are updated with a single request each and all the clinical records
+        are updated (or deleted and saved again) in bulk.
+
+        :param src_patient: the :class:`PatientRecord` related to the EHR records that are going to be
+          moved
+        :type src_patient: :class:`PatientRecord`
+        :param dest_patient: the :class:`PatientRecord` which will be associated with the the EHR records
+        :type dest_patient: :class:`PatientRecord`
+        :param ehr_records: the :class:`ClinicalRecord` objects that are going to be moved
+        :type ehr_records: list
+        :param reset_ehr_records_history: if True, reset EHR records history and delete all revisions, if
+          False keep records' history and keep trace of the move event. Default value is False.
+        :type reset_ehr_records_history: bool
+        :return: the two :class:`PatientRecord` mapping the proper association to the EHR records
+        """
+        ehr_records, src_patient = self.remove_ehr_records(ehr_records, src_patient,
+                                                           reset_records=reset_ehr_records_history)
+        if reset_ehr_records_history:
+            ehr_records, dest_patient, _ = self.save_ehr_records(ehr_records, dest_patient)
+        else:
+            for ehr in ehr_records:
+                ehr.bind_to_patient(dest_patient)
+            self.version_manager.update_records_field(ehr_records, 'patient_id', dest_patient.record_id,
+                                                      'last_update')
+            dest_patient = self._add_ehr_records(dest_patient, ehr_records)
+        return src_patient, dest_patient
+
     def remove_ehr_record(self, ehr_record, patient_record, reset_record=True):
         """
         Remove a :class:`ClinicalRecord` from a patient's records and delete
@@ -367,11 +410,17 @@ class DBServices(object):
 
     def remove_ehr_records(self, ehr_records, patient_record, reset_records=True):
         """
+        Remove a list of :class:`ClinicalRecord` objects from a patient's records and delete
+        them from the database if *reset_records* is True.
 
-        :param ehr_records:
-        :param patient_record:
-        :param reset_records:
-        :return:
+        :param ehr_records: the :class:`ClinicalRecord` objects that will be removed
+        :type ehr_records: list
+        :param patient_record: the reference :class:`PatientRecord`
+        :type patient_record: :class:`PatientRecord`
+        :param reset_records: if True, reset ehr records (new IDs and delete their revisions)
+        :type reset_records: bool
+        :return: the EHR records and the updated patient record
+        :rtype: list, :class:`PatientRecord`
         """
         self._remove_from_list(patient_record, 'ehr_records', [ehr.record_id for ehr in ehr_records])
         for ehr in ehr_records:
@@ -385,31 +434,79 @@ class DBServices(object):
                 ehr.patient_id = None
         return ehr_records, patient_record
 
-    def _get_active_records(self, driver):
-        return driver.get_records_by_value('active', True)
+    def _fetch_patients_data_full(self, patient_docs, fetch_ehr_records=True,
+                                  fetch_hidden_ehr=False):
+        drf = self._get_drivers_factory(self.ehr_repository)
+        with drf.get_driver() as driver:
+            patient_records = [driver.decode_record(p) for p in patient_docs]
+            ehr_ids = [ehr.record_id for p in patient_records for ehr in p.ehr_records]
+            if not ehr_ids:
+                return patient_records
+            # hidden records are filtered by the query, all records connected to the
+            # given patients are retrieved using a single query
+            ehr_docs = dict(
+                (ehr_doc['_id'], ehr_doc) for ehr_doc in
+                driver.get_records_by_ids(ehr_ids, active_only=not fetch_hidden_ehr)
+            )
+            for patient_record in patient_records:
+                ehr_records = []
+                for ehr in patient_record.ehr_records:
+                    ehr_doc = ehr_docs.get(ehr.record_id)
+                    if ehr_doc:
+                        ehr_records.append(driver.decode_record(ehr_doc, fetch_ehr_records))
+                    else:
+                        self.logger.debug('Ignoring hidden EHR record %r', ehr.record_id)
+                patient_record.ehr_records = ehr_records
+            return patient_records
 
     def _fetch_patient_data_full(self, patient_doc, fetch_ehr_records=True,
                                  fetch_hidden_ehr=False):
-        drf = self._get_drivers_factory(self.ehr_repository)
+        return self._fetch_patients_data_full([patient_doc], fetch_ehr_records,
+                                              fetch_hidden_ehr)[0]
+
+    def iter_patients(self, batch_size=100, after_id=None, active_records_only=True,
+                      fetch_ehr_records=True, fetch_hidden_ehr=False):
+        """
+        Iterate over patients stored in the DB. Patients are sorted by ID and retrieved *batch_size*
+        at a time using a server side cursor, EHR records of each batch are loaded with a single query,
+        so memory usage doesn't depend on the size of the patients collection. An interrupted iteration
+        can be resumed by passing the ID of the last retrieved patient as *after_id*.
+
+        :param batch_size: the number of patients retrieved and hydrated with each batch
+        :type batch_size: int
+        :param after_id: if not None, only patients with an ID greater than this one will be returned
+        :param active_records_only: if True fetch only active patient records, if False get all
+          patient records from the DB
+        :type active_records_only: boolean
+        :param fetch_ehr_records: if True fetch connected EHR records  as well, if False only EHR records'
+          IDs will be retrieved
+        :type fetch_ehr_records: boolean
+        :param fetch_hidden_ehr: if False only fetch active EHR records, if True fetch all EHR records
+          connected to the given patient record
+        :type fetch_hidden_ehr: boolean
+        :return: a generator of :class:`PatientRecord` objects
+        """
+        filters = {'active': True} if active_records_only else None
+        drf = self._get_drivers_factory(self.patients_repository)
         with drf.get_driver() as driver:
-            patient_record = driver.decode_record(patient_doc)
-            ehr_records = []
-            for ehr in patient_record.ehr_records:
-                ehr_doc = driver.get_record_by_id(ehr.record_id)
-                if fetch_hidden_ehr or (not fetch_hidden_ehr and ehr_doc['active']):
-                    self.logger.debug('fetch_hidden_ehr: %s --- ehr_doc[\'active\']: %s',
-                                      fetch_hidden_ehr, ehr_doc['active'])
-                    ehr_records.append(driver.decode_record(ehr_doc, fetch_ehr_records))
-                    self.logger.debug('ehr_records: %r', ehr_records)
-                else:
-                    self.logger.debug('Ignoring hidden EHR record %r', ehr_doc['_id'])
-            patient_record.ehr_records = ehr_records
-            return patient_record
+            patient_docs = []
+            for patient_doc in driver.iter_records(filters, batch_size, after_id):
+                patient_docs.append(patient_doc)
+                if len(patient_docs) == batch_size:
+                    for patient_record in self._fetch_patients_data_full(patient_docs, fetch_ehr_records,
+                                                                         fetch_hidden_ehr):
+                        yield patient_record
+                    patient_docs = []
+            if patient_docs:
+                for patient_record in self._fetch_patients_data_full(patient_docs, fetch_ehr_records,
+                                                                     fetch_hidden_ehr):
+                    yield patient_record
 
     def get_patients(self, active_records_only=True, fetch_ehr_records=True,
                      fetch_hidden_ehr=False):
         """
-        Get all patients from the DB.
+        Get all patients from the DB. Use :meth:`iter_patients` to avoid loading the whole
+        patients collection in memory.
 
         :param active_records_only: if True fetch only active patient records, if False get all
           patient records from the DB
@@ -422,14 +519,9 @@ class DBServices(object):
         :type fetch_hidden_ehr: boolean
         :return: a list of :class:`PatientRecord` objects
         """
-        drf = self._get_drivers_factory(self.patients_repository)
-        with drf.get_driver() as driver:
-            if not active_records_only:
-                patient_records = driver.get_all_records()
-            else:
-                patient_records = self._get_active_records(driver)
-        return [self._fetch_patient_data_full(r, fetch_ehr_records,
-                                              fetch_hidden_ehr) for r in patient_records]
+        return list(self.iter_patients(active_records_only=active_records_only,
+                                       fetch_ehr_records=fetch_ehr_records,
+                                       fetch_hidden_ehr=fetch_hidden_ehr))
 
     def get_patient(self, patient_id, fetch_ehr_records=True, fetch_hidden_ehr=False):
         """
@@ -475,7 +567,8 @@ class DBServices(object):
 
     def load_ehr_records(self, patient):
         """
-        Load all :class:`ClinicalRecord` objects connected to the given :class:`PatientRecord` object
+        Load all :class:`ClinicalRecord` objects connected to the given :class:`PatientRecord` object,
+        records that can't be found in the DB are skipped
 
         :param patient: the patient record object
         :type patient: :class:`PatientRecord`
@@ -484,8 +577,17 @@ class DBServices(object):
         """
         drf = self._get_drivers_factory(self.ehr_repository)
         with drf.get_driver() as driver:
-            ehr_records = [driver.get_record_by_id(ehr.record_id) for ehr in patient.ehr_records]
-            patient.ehr_records = [driver.decode_record(ehr) for ehr in ehr_records]
+            ehr_docs = dict((ehr_doc['_id'], ehr_doc) for ehr_doc in
+                            driver.get_records_by_ids([ehr.record_id for ehr in patient.ehr_records]))
+            ehr_records = []
+            for ehr in patient.ehr_records:
+                ehr_doc = ehr_docs.get(ehr.record_id)
+                if ehr_doc:
+                    ehr_records.append(driver.decode_record(ehr_doc))
+                else:
+                    self.logger.warning('EHR record %r of patient %r not found, skipping it',
+                                        ehr.record_id, patient.record_id)
+            patient.ehr_records = ehr_records
         return patient
 
     def hide_patient(self, patient):
@@ -498,14 +600,8 @@ class DBServices(object):
         :rtype: :class:`PatientRecord`
         """
         if patient.active:
-            for ehr_rec in patient.ehr_records:
-                try:
-                    self.hide_ehr_record(ehr_rec)
-                except RedundantUpdateError:
-                    # just ignore RedundantUpdateError, this means that the records
-                    # is already hidden
-                    self.logger.debug('Record %s is already hidden', ehr_rec.record_id)
-                    pass
+            # records that are already hidden are skipped
+            self.hide_ehr_records(patient.ehr_records)
             rec = self._hide_record(patient)
         else:
             rec = patient
@@ -526,6 +622,21 @@ class DBServices(object):
             rec = ehr_record
         return rec
 
+    def hide_ehr_records(self, ehr_records):
+        """
+        Hide a list of :class:`ClinicalRecord` objects, current versions of the records are
+        archived and records are updated in bulk
+
+        :param ehr_records: the clinical records that are going to be hidden
+        :type ehr_records: list
+        :return: the clinical records
+        :rtype: list
+        """
+        active_records = [ehr for ehr in ehr_records if ehr.active]
+        if active_records:
+            self.version_manager.update_records_field(active_records, 'active', False, 'last_update')
+        return ehr_records
+
     def delete_patient(self, patient, cascade_delete=False):
         """
         Delete a patient from the DB. A patient record can be deleted only if it has no clinical record connected
@@ -539,19 +650,39 @@ class DBServices(object):
         :raise: :class:`CascadeDeleteError` if a record with connected clinical record is going to be deleted and
           cascade_delete option is False
         """
-        def reload_patient(patient):
-            return self.get_patient(patient.record_id, fetch_ehr_records=False,
-                                    fetch_hidden_ehr=True)
-        patient = reload_patient(patient)
-        if not cascade_delete and len(patient.ehr_records) > 0:
-            raise CascadeDeleteError('Unable to delete patient record with ID %s, %d EHR records still connected',
-                                     patient.record_id, len(patient.ehr_records))
-        else:
-            self._delete_ehr_records(patient.ehr_records)
-            drf = self._get_drivers_factory(self.patients_repository)
-            with drf.get_driver() as driver:
-                driver.delete_record(patient.record_id)
-                return None
+        return self.delete_patients([patient], cascade_delete)
+
+    def delete_patients(self, patients, cascade_delete=False):
+        """
+        Delete a list of patients from the DB. Patients and their clinical records are reloaded,
+        deleted and their revisions removed with a single request for each repository. If
+        *cascade_delete* is False and one of the patients has connected clinical records, a
+        :class:`CascadeDeleteError` exception will be thrown and no record will be deleted.
+
+        :param patients: the patient records that are going to be deleted
+        :type patients: list of :class:`PatientRecord` objects
+        :param cascade_delete: if True connected `ClinicalRecord` objects will be deleted as well
+        :type cascade_delete: boolean
+        :raise: :class:`CascadeDeleteError` if a record with connected clinical record is going to be deleted and
+          cascade_delete option is False
+        """
+        drf = self._get_drivers_factory(self.patients_repository)
+        with drf.get_driver() as driver:
+            patient_docs = driver.get_records_by_ids([p.record_id for p in patients])
+        # structure IDs of hidden records are needed as well to update the counters
+        patients = self._fetch_patients_data_full(patient_docs, fetch_ehr_records=False,
+                                                  fetch_hidden_ehr=True)
+        if not cascade_delete:
+            for patient in patients:
+                if len(patient.ehr_records) > 0:
+                    raise CascadeDeleteError('Unable to delete patient record with ID %s, %d EHR records still connected' %
+                                             (patient.record_id, len(patient.ehr_records)))
+        ehr_records = [ehr for patient in patients for ehr in patient.ehr_records]
+        if ehr_records:
+            self._delete_ehr_records(ehr_records)
+        with drf.get_driver() as driver:
+            driver.delete_records_by_id([p.record_id for p in patients])
+        return None
 
     def _delete_ehr_record(self, ehr_record, reset_history=True):
         drf = self._get_drivers_factory(self.ehr_repository)
@@ -568,12 +699,10 @@ class DBServices(object):
             driver.delete_records_by_id([ehr.record_id for ehr in ehr_records])
             struct_id_counter = Counter()
             for rec in ehr_records:
-                struct_id_counter[rec.structure_id] += 1
-            for str_id, str_count in struct_id_counter.iteritems():
-                self.index_service.decrease_structure_counter(str_id, str_count)
+                struct_id_counter[rec.structure_id] -= 1
+            self.index_service.apply_counter_deltas(struct_id_counter)
         if reset_history:
-            for ehr in ehr_records:
-                self.version_manager.remove_revisions(ehr.record_id)
+            self.version_manager.remove_revisions_for([ehr.record_id for ehr in ehr_records])
         return None
 
     def _hide_record(self, record):
@@ -2,20 +2,51 @@ from lxml import etree
 from hashlib import md5
 from uuid import uuid4
 from copy import copy
+from threading import local, Lock
 from pyehr.utils.services import get_logger
+from pyehr.utils.cache import LRUCache
 from pybasex import BaseXClient
 import pybasex.errors as pbx_errors
 
 
 class IndexService(object):
+    """
+    Map the structures of the EHR records to structure IDs using a BaseX database.
 
-    def __init__(self, db, url, user, passwd, logger=None):
+    Structure IDs resolved by :meth:`get_structure_id` are kept in a LRU cache of *cache_size*
+    elements (use 0 to disable the cache), so that records sharing an already known structure
+    don't need to contact BaseX. Cached IDs are dropped when the related structure is deleted by
+    this service, if other processes can delete structures a *cache_ttl* (in seconds) should be
+    used as well.
+
+    An IndexService can be shared by several threads, each thread uses its own BaseX client.
+    """
+
+    # incremented every time a structure is added or deleted by an IndexService of the current
+    # process, objects built using the structures index (i.e. compiled queries) can check it
+    # to understand if they are still valid
+    structures_version = 0
+    _structures_version_lock = Lock()
+
+    def __init__(self, db, url, user, passwd, logger=None, cache_size=1024, cache_ttl=None):
         self.url = url
         self.user = user
         self.passwd = passwd
         self.db = db
-        self.basex_client = None
+        self._local = local()
         self.logger = logger or get_logger('index_service')
+        if cache_size:
+            self.structures_cache = LRUCache(cache_size, cache_ttl)
+        else:
+            self.structures_cache = None
+
+    @property
+    def basex_client(self):
+        return getattr(self._local, 'basex_client', None)
+
+    @basex_client.setter
+    def basex_client(self, client):
+        self._local.basex_client = client
 
     def connect(self):
         self.basex_client = BaseXClient(self.url, self.db, self.user, self.passwd, self.logger)
@@ -137,6 +168,7 @@ class IndexService(object):
         if not self.basex_client:
             self.connect()
         self.basex_client.add_document(record, structure_key)
+        IndexService._structures_changed()
         return structure_key
 
     def _get_structure_by_id(self, structure_id):
@@ -147,10 +179,10 @@ class IndexService(object):
     def _extract_structure_id_from_xml(self, xml_doc):
         return xml_doc.find('structure_id').get('uid')
 
-    def _get_structure_id(self, xml_doc):
+    def _get_structure_id(self, xml_doc, record_hash=None):
         if not self.basex_client:
             self.connect()
-        record_hash = self._get_record_hash(xml_doc)
+        record_hash = record_hash or self._get_record_hash(xml_doc)
         res = self._execute_query('/archetype_structure/structure_id[@str_hash="%s"]' % record_hash)
         try:
             return self._extract_structure_id_from_xml(res)
@@ -166,21 +198,45 @@ class IndexService(object):
         :param ehr_record: the EHR as a dictionary
         :type ehr_record: dictionary
         """
+        xml_structure = IndexService.get_structure(ehr_record)
+        record_hash = self._get_record_hash(xml_structure)
+        if self.structures_cache is not None:
+            str_id = self.structures_cache.get(record_hash)
+            if str_id:
+                self.logger.debug('Structure ID %s found in cache', str_id)
+                return str_id
         if not self.basex_client:
             self.connect()
-        xml_structure = IndexService.get_structure(ehr_record)
-        str_id = self._get_structure_id(xml_structure)
+        str_id = self._get_structure_id(xml_structure, record_hash)
         if not str_id:
             str_id = self.create_entry(xml_structure)
         self.disconnect()
+        if self.structures_cache is not None:
+            self.structures_cache.set(record_hash, str_id)
         return str_id
 
     def _get_document_reference_counter(self, doc):
         return int(doc.find("references_counter").get("hits"))
 
-    def _update_document_references_counter(self, doc, update_value):
-        doc.find("references_counter").set("hits", str(update_value))
-        return doc
+    def _build_counter_update_query(self, structure_id, delta):
+        # counter is updated in place by BaseX, if the counter reaches a value equal or
+        # lower than 0 the whole structure document is deleted
+        return (
+            'for $s in db:open("%(db)s", "%(str_id)s")/archetype_structure '
+            'let $hits := xs:integer($s/references_counter/@hits) + (%(delta)d) '
+            'return if ($hits <= 0) then db:delete("%(db)s", "%(str_id)s") '
+            'else replace value of node $s/references_counter/@hits with $hits'
+        ) % {'db': self.db, 'str_id': structure_id, 'delta': delta}
+
+    @classmethod
+    def _structures_changed(cls):
+        with cls._structures_version_lock:
+            cls.structures_version += 1
+
+    def _invalidate_cached_structure(self, structure_id):
+        IndexService._structures_changed()
+        if self.structures_cache is not None:
+            self.structures_cache.invalidate_value(structure_id)
 
     def check_structure_counter(self, structure_id):
         """
@@ -189,14 +245,39 @@ class IndexService(object):
 
         :param structure_id: the ID of the structure that will be checked
         """
-        doc = self._get_structure_by_id(structure_id)
-        if doc is not None:
-            doc_count = self._get_document_reference_counter(doc)
-            if doc_count == 0:
-                self.basex_client.delete_document(structure_id)
-            else:
-                self.logger.debug("References counter for structure %s id %d",
-                                  doc_count, structure_id)
+        if not self.basex_client:
+            self.connect()
+        self._execute_query(
+            'for $s in db:open("%(db)s", "%(str_id)s")/archetype_structure '
+            'where xs:integer($s/references_counter/@hits) = 0 '
+            'return db:delete("%(db)s", "%(str_id)s")' % {'db': self.db, 'str_id': structure_id}
+        )
+        self._invalidate_cached_structure(structure_id)
+
+    def apply_counter_deltas(self, counter_deltas):
+        """
+        Update the references counters of several structures with a single atomic XQuery Update
+        statement. *counter_deltas* maps structure IDs to the value that will be added to their
+        references counter (use negative values to decrease a counter), structures whose references
+        counter reaches a value equal or lower than 0 will be deleted.
+
+        :param counter_deltas: a dictionary mapping structure IDs to counter deltas
+        :type counter_deltas: dictionary
+        """
+        counter_deltas = dict((str_id, delta) for str_id, delta in counter_deltas.iteritems()
+                              if delta != 0)
+        if not counter_deltas:
+            return
+        if not self.basex_client:
+            self.connect()
+        query = ',\n'.join('(%s)' % self._build_counter_update_query(str_id, delta)
+                           for str_id, delta in counter_deltas.iteritems())
+        self._execute_query(query)
+        self.logger.debug('Updated references counters: %r', counter_deltas)
+        for str_id, delta in counter_deltas.iteritems():
+            if delta < 0:
+                # structure could have been deleted
+                self._invalidate_cached_structure(str_id)
 
     def increase_structure_counter(self, structure_id, increase_value=1):
         """
@@ -208,16 +289,7 @@ class IndexService(object):
         """
         if increase_value < 1:
             raise ValueError("increase_value must be an integer greater than 0")
-        doc = self._get_structure_by_id(structure_id)
-        if doc is not None:
-            doc_count = self._get_document_reference_counter(doc)
-            self.logger.debug("Current counter for %s is %d", structure_id, doc_count)
-            doc = self._update_document_references_counter(doc, (doc_count + increase_value))
-            self.basex_client.delete_document(structure_id)
-            self.basex_client.add_document(doc, structure_id)
-            self.logger.debug("Documents %s updated", structure_id)
-        else:
-            self.logger.warn("There is no document with structure ID %s", structure_id)
+        self.apply_counter_deltas({structure_id: increase_value})
 
     def decrease_structure_counter(self, structure_id, decrease_value=1):
         """
@@ -231,18 +303,7 @@ class IndexService(object):
         """
         if decrease_value < 1:
             raise ValueError("decrease_value must be an integer greater than 0")
-        doc = self._get_structure_by_id(structure_id)
-        if doc is not None:
-            doc_count = self._get_document_reference_counter(doc)
-            if (doc_count - decrease_value) <= 0:
-                self.basex_client.delete_document(structure_id)
-            else:
-                doc = self._update_document_references_counter(doc, (doc_count - decrease_value))
-                self.basex_client.delete_document(structure_id)
-                self.basex_client.add_document(doc, structure_id)
-                self.logger.debug("Document %s updated", structure_id)
-        else:
-            self.logger.warn("There is no document with structure ID %s", structure_id)
+        self.apply_counter_deltas({structure_id: -decrease_value})
 
     def _container_to_xpath(self, aql_container):
         if aql_container.class_expression.predicate:
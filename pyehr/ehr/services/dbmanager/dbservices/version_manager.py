@@ -1,26 +1,35 @@
-from hashlib import md5
+import json
 from operator import attrgetter
 
-try:
-    import simplejson as json
-except ImportError:
-    import json
-
 from pyehr.ehr.services.dbmanager.drivers.factory import DriversFactory
-from pyehr.utils import get_logger
+from pyehr.utils import get_logger, build_merge_patch, apply_merge_patch
 from pyehr.ehr.services.dbmanager.errors import OptimisticLockError,\
     RedundantUpdateError, MissingRevisionError, ConfigurationError
 
 
 class VersionManager(object):
     """
-    TODO: add documentation here
+    Archive the previous versions of clinical records and restore them.
+
+    With the 'full' revisions mode every archived revision contains a copy of the
+    clinical data. With the 'delta' mode the clinical data of a revision are replaced
+    by a JSON merge patch that rebuilds them from the ones of the next version and a
+    full copy is kept only every *snapshot_interval* versions.
     """
 
+    REVISIONS_MODES = ('full', 'delta')
+    # the field used to save the merge patch of revisions archived in delta mode
+    DELTA_FIELD = 'ehr_data_delta'
+
     def __init__(self, driver, host, database, versioning_database=None,
                  ehr_repository=None, ehr_versioning_repository=None,
                  index_service=None, port=None, user=None, passwd=None,
-                 logger=None):
+                 logger=None, revisions_mode='full', snapshot_interval=10):
+        if revisions_mode not in self.REVISIONS_MODES:
+            raise ValueError('Unsupported revisions mode %s, allowed values are %s' %
+                             (revisions_mode, ', '.join(self.REVISIONS_MODES)))
+        if snapshot_interval < 1:
+            raise ValueError('%r is not a valid snapshot interval' % snapshot_interval)
         self.driver = driver
         self.host = host
         self.database = database
@@ -32,6 +41,8 @@ class VersionManager(object):
         self.user = user
         self.passwd = passwd
         self.logger = logger or get_logger('version_manager')
+        self.revisions_mode = revisions_mode
+        self.snapshot_interval = snapshot_interval
 
     def _get_drivers_factory(self, write_on_archive=False):
         if write_on_archive:
@@ -57,11 +68,8 @@ class VersionManager(object):
             raise ConfigurationError('Operation not allowed, missing IndexService')
 
     def _check_redundant_update(self, new_record, old_record):
-        new_record_hash = md5()
-        new_record_hash.update(json.dumps(new_record.to_json()))
-        old_record_hash = md5()
-        old_record_hash.update(json.dumps(old_record.to_json()))
-        if new_record_hash.hexdigest() == old_record_hash.hexdigest():
+        # comparing JSON dictionaries needs a single walk and doesn't depend on keys ordering
+        if new_record.to_json() == old_record.to_json():
             raise RedundantUpdateError('Redundant update, old and new record are identical')
 
     def _check_optimistic_lock(self, current_revision, version):
@@ -78,13 +86,97 @@ class VersionManager(object):
             else:
                 return driver.decode_record(rec)
 
-    def _move_record_to_archive(self, record):
+    def _encode_delta(self, encoded_revision, version, next_ehr_data):
+        # the patch rebuilds the clinical data of this revision from the ones of the next
+        # version, it is saved as a string so that its structure is not indexed; the standard
+        # json module is used because replaying a lossy patch would change the clinical data
+        if next_ehr_data is None:
+            patch = {}
+        else:
+            patch = build_merge_patch(next_ehr_data, encoded_revision['ehr_data'])
+        encoded_revision[self.DELTA_FIELD] = {'version': version, 'patch': json.dumps(patch)}
+        if version % self.snapshot_interval != 0:
+            del encoded_revision['ehr_data']
+        return encoded_revision
+
+    def _encode_revision(self, driver, record, next_ehr_data=None):
+        # next_ehr_data are the encoded clinical data of the version replacing the archived
+        # one, None if the update didn't change them
         record = record.convert_to_revision()
+        encoded_record = driver.encode_record(record)
+        if self.revisions_mode == 'delta':
+            encoded_record = self._encode_delta(encoded_record, record.version, next_ehr_data)
+        return encoded_record
+
+    def _move_record_to_archive(self, record, next_ehr_data=None):
         drf = self._get_drivers_factory(True)
         with drf.get_driver() as driver:
-            record_id = driver.add_record(driver.encode_record(record))
+            record_id = driver.add_record(self._encode_revision(driver, record, next_ehr_data))
             return record_id
 
+    def _move_records_to_archive(self, records):
+        drf = self._get_drivers_factory(True)
+        with drf.get_driver() as driver:
+            saved, _ = driver.add_records([self._encode_revision(driver, rec) for rec in records])
+            return saved
+
+    def _get_current_ehr_data(self, record_id):
+        drf = self._get_drivers_factory()
+        with drf.get_driver() as driver:
+            record = driver.get_record_by_id(record_id)
+        if not record:
+            raise MissingRevisionError('Unable to rebuild revisions of record %s, the record was deleted' %
+                                       record_id)
+        return record['ehr_data']
+
+    def _apply_delta(self, revision, next_ehr_data):
+        patch = json.loads(revision[self.DELTA_FIELD]['patch'])
+        return dict(revision, ehr_data=apply_merge_patch(next_ehr_data, patch))
+
+    def _rebuild_revision(self, driver, record_id, revision):
+        # patches are applied backwards starting from the nearest newer revision with
+        # clinical data or, if there is none, from the current version of the record
+        if 'ehr_data' in revision:
+            return revision
+        deltas = [revision]
+        while True:
+            next_revision = driver.get_record_by_version(record_id,
+                                                         deltas[-1][self.DELTA_FIELD]['version'] + 1)
+            if not next_revision:
+                ehr_data = self._get_current_ehr_data(record_id)
+                break
+            if 'ehr_data' in next_revision:
+                ehr_data = next_revision['ehr_data']
+                break
+            deltas.append(next_revision)
+        for rev in reversed(deltas):
+            rev = self._apply_delta(rev, ehr_data)
+            ehr_data = rev['ehr_data']
+        return rev
+
+    def _decode_revisions(self, driver, record_id, revisions):
+        # revisions with clinical data are decoded first, the ones saved as deltas are
+        # rebuilt from the newest to the oldest one
+        ehr_data_map = dict()
+        decoded_revisions = list()
+        deltas = list()
+        for rev in revisions:
+            if 'ehr_data' in rev:
+                decoded_rev = driver.decode_record(rev)
+                ehr_data_map[decoded_rev.version] = rev['ehr_data']
+                decoded_revisions.append(decoded_rev)
+            else:
+                deltas.append(rev)
+        for rev in sorted(deltas, key=lambda r: r[self.DELTA_FIELD]['version'], reverse=True):
+            next_version = rev[self.DELTA_FIELD]['version'] + 1
+            if next_version not in ehr_data_map:
+                # the next version is the one saved in the clinical records repository
+                ehr_data_map[next_version] = self._get_current_ehr_data(record_id)
+            rev = self._apply_delta(rev, ehr_data_map[next_version])
+            ehr_data_map[next_version - 1] = rev['ehr_data']
+            decoded_revisions.append(driver.decode_record(rev))
+        return decoded_revisions
+
     def get_revision(self, record_id, version_number, convert_to_clinical_record=False):
         if not isinstance(version_number, int) or version_number < 1:
             raise ValueError('%r is not a valid version number' % version_number)
@@ -92,7 +184,7 @@ class VersionManager(object):
         with drf.get_driver() as driver:
             record = driver.get_record_by_version(record_id, version_number)
             if record:
-                rec = driver.decode_record(record)
+                rec = driver.decode_record(self._rebuild_revision(driver, record_id, record))
                 if convert_to_clinical_record:
                     crec = rec.convert_to_clinical_record()
                     self._set_structure_id(crec)
@@ -105,8 +197,8 @@ class VersionManager(object):
     def get_revisions(self, record_id, reverse_ordering=False):
         drf = self._get_drivers_factory(True)
         with drf.get_driver() as driver:
-            revisions = [driver.decode_record(rec) for rec in
-                         driver.get_revisions_by_ehr_id(record_id)]
+            revisions = self._decode_revisions(driver, record_id,
+                                               driver.get_revisions_by_ehr_id(record_id))
         return sorted(revisions, key=attrgetter('version'), reverse=reverse_ordering)
 
     def _set_structure_id(self, ehr_record):
@@ -119,76 +211,126 @@ class VersionManager(object):
             ehr_record.structure_id = structure_id
             return True
 
-    def update_record(self, new_record):
+    def _check_failed_swap(self, new_record):
+        # the saved record is read back only to find out why it was not replaced
         current_revision = self._get_current_revision(new_record.record_id)
         self._check_redundant_update(new_record, current_revision)
         self._check_optimistic_lock(current_revision, new_record.version)
-        self._move_record_to_archive(current_revision)
-        old_structure_id = current_revision.structure_id
+        raise RedundantUpdateError('Redundant update, old and new record have the same content and metadata')
+
+    def update_record(self, new_record):
+        version = new_record.version
+        self._set_structure_id(new_record)
         drf = self._get_drivers_factory()
         with drf.get_driver() as driver:
             new_record.increase_version()
-            self._set_structure_id(new_record)
-            last_update = driver.replace_record(new_record.record_id,
-                                                driver.encode_record(new_record),
-                                                'last_update')
-            if new_record.structure_id != old_structure_id:
-                self.index_service.increase_structure_counter(new_record.structure_id)
-                self.index_service.decrease_structure_counter(old_structure_id)
-            new_record.last_update = last_update
+            # version, content hash and metadata of the saved record are checked while replacing it
+            encoded_record = driver.encode_record(new_record)
+            previous_record, last_update = driver.swap_record(new_record.record_id, encoded_record,
+                                                              version, 'last_update')
+            if previous_record is None:
+                new_record.version = version
+                self._check_failed_swap(new_record)
+            current_revision = driver.decode_record(previous_record)
+        self._move_record_to_archive(current_revision, encoded_record['ehr_data'])
+        if new_record.structure_id != current_revision.structure_id:
+            self.index_service.apply_counter_deltas({new_record.structure_id: 1,
+                                                     current_revision.structure_id: -1})
+        new_record.last_update = last_update
         return new_record
 
-    def update_field(self, record, field, value, last_update_label=None):
+    def _check_failed_update(self, record, field, value, update_type):
+        # the saved record is read back only to find out why it was not updated
         current_revision = self._get_current_revision(record.record_id)
-        if getattr(current_revision, field) == value:
+        if update_type == 'set' and getattr(current_revision, field) == value:
             raise RedundantUpdateError('Field %s value for record %r is already %r' % (field,
                                                                                        record.record_id,
                                                                                        value))
         self._check_optimistic_lock(current_revision, record.version)
-        self._move_record_to_archive(current_revision)
+        raise OptimisticLockError('Record %s was modified by a concurrent update' % record.record_id)
+
+    def _versioned_update(self, record, field, update_type, value, last_update_label):
+        # the record is updated and its previous version retrieved with a single request,
+        # the previous version is then moved to the archive
         drf = self._get_drivers_factory()
         with drf.get_driver() as driver:
-            last_update = driver.update_field(record.record_id, field, value, last_update_label, True)
+            previous_record, last_update = driver.versioned_update(record.record_id, record.version,
+                                                                   field, update_type, value,
+                                                                   last_update_label)
+            if previous_record is None:
+                self._check_failed_update(record, field, value, update_type)
+            current_revision = driver.decode_record(previous_record)
+        self._move_record_to_archive(current_revision)
         record.last_update = last_update
         record.increase_version()
+        return record
+
+    def update_field(self, record, field, value, last_update_label=None):
+        record = self._versioned_update(record, field, 'set', value, last_update_label)
         setattr(record, field, value)
         return record
 
-    def add_to_list(self, record, list_label, element, last_update_label=None):
-        current_revision = self._get_current_revision(record.record_id)
-        self._check_optimistic_lock(current_revision, record.version)
-        self._move_record_to_archive(current_revision)
+    def update_records_field(self, records, field, value, last_update_label=None):
+        """
+        Set *field* of all the given records to *value*. Current versions of the records are
+        retrieved in bulk and records are updated with a single request, records whose field
+        already has the given value are skipped. Records are updated only if their saved version
+        is still the one that was retrieved, then the replaced versions are moved to the archive
+        in bulk: if a concurrent update changed some of the records, they are not archived and an
+        :class:`OptimisticLockError` is raised, the other records keep the new value.
+
+        :param records: the records that will be updated
+        :type records: list of :class:`ClinicalRecord` objects
+        :param field: the name of the field
+        :type field: str
+        :param value: the new value of the field
+        :param last_update_label: the label of the *last_update* field of the records
+        :type last_update_label: str or None
+        :return: the updated records
+        :rtype: list
+        """
+        records_map = dict((rec.record_id, rec) for rec in records)
         drf = self._get_drivers_factory()
         with drf.get_driver() as driver:
-            last_update = driver.add_to_list(record.record_id, list_label, element,
-                                             last_update_label, True)
-        record.last_update = last_update
-        record.increase_version()
-        return record
+            current_revisions = [driver.decode_record(rec) for rec in
+                                 driver.get_records_by_ids(records_map.keys())]
+            if len(current_revisions) != len(records_map):
+                missing_ids = set(records_map) - set(rev.record_id for rev in current_revisions)
+                raise OptimisticLockError('Records %s were deleted from the DB' % ', '.join(map(str, missing_ids)))
+            current_revisions = [rev for rev in current_revisions if getattr(rev, field) != value]
+            for rev in current_revisions:
+                self._check_optimistic_lock(rev, records_map[rev.record_id].version)
+            if current_revisions:
+                updated_ids, last_update = driver.versioned_update_records(
+                    dict((rev.record_id, rev.version) for rev in current_revisions),
+                    field, value, last_update_label
+                )
+                updated_ids = set(updated_ids)
+                for rid in updated_ids:
+                    records_map[rid].last_update = last_update
+                    records_map[rid].increase_version()
+                    setattr(records_map[rid], field, value)
+                # only the versions replaced by this update are archived, the ones changed by
+                # concurrent updates are archived by their own updaters
+                replaced_revisions = [rev for rev in current_revisions if rev.record_id in updated_ids]
+                if replaced_revisions:
+                    self._move_records_to_archive(replaced_revisions)
+                if len(updated_ids) != len(current_revisions):
+                    failed_revisions = [rev for rev in current_revisions if rev.record_id not in updated_ids]
+                    raise OptimisticLockError('Records %s were modified by a concurrent update' %
+                                              ', '.join(str(rev.record_id) for rev in failed_revisions))
+        for rec in records:
+            setattr(rec, field, value)
+        return records
+
+    def add_to_list(self, record, list_label, element, last_update_label=None):
+        return self._versioned_update(record, list_label, 'add', element, last_update_label)
 
     def extend_list(self, record, list_label, elements, last_update_label=None):
-        current_revision = self._get_current_revision(record.record_id)
-        self._check_optimistic_lock(current_revision, record.version)
-        self._move_record_to_archive(current_revision)
-        drf = self._get_drivers_factory()
-        with drf.get_driver() as driver:
-            last_update = driver.extend_list(record.record_id, list_label, elements,
-                                             last_update_label, True)
-        record.last_update = last_update
-        record.increase_version()
-        return record
+        return self._versioned_update(record, list_label, 'extend', elements, last_update_label)
 
     def remove_from_list(self, record, list_label, element, last_update_label=None):
-        current_revision = self._get_current_revision(record.record_id)
-        self._check_optimistic_lock(current_revision, record.version)
-        self._move_record_to_archive(current_revision)
-        drf = self._get_drivers_factory()
-        with drf.get_driver() as driver:
-            last_update = driver.remove_from_list(record.record_id, list_label, element,
-                                                  last_update_label, True)
-        record.last_update = last_update
-        record.increase_version()
-        return record
+        return self._versioned_update(record, list_label, 'remove', element, last_update_label)
 
     def restore_revision(self, record_id, revision):
         original_record = self.get_revision(record_id, revision,
@@ -202,8 +344,8 @@ class VersionManager(object):
             driver.delete_record(record_id)
             driver.add_record(driver.encode_record(original_record))
             if old_rec_struct != original_record.structure_id:
-                self.index_service.decrease_structure_counter(old_rec_struct)
-                self.index_service.increase_structure_counter(original_record.structure_id)
+                self.index_service.apply_counter_deltas({old_rec_struct: -1,
+                                                         original_record.structure_id: 1})
         drf = self._get_drivers_factory(True)
         with drf.get_driver() as driver:
             del_count = driver.delete_later_versions(record_id, revision-1)
@@ -219,3 +361,20 @@ class VersionManager(object):
         self.logger.debug('Removed %d revisions for record %s', del_count, record_id)
         return del_count
 
+    def remove_revisions_for(self, records_id):
+        """
+        Remove all the revisions of the records with the given IDs with a single request
+
+        :param records_id: the IDs of the records
+        :type records_id: list
+        :return: the number of removed revisions
+        :rtype: int
+        """
+        if not records_id:
+            return 0
+        drf = self._get_drivers_factory(True)
+        with drf.get_driver() as driver:
+            del_count = driver.delete_versions_by_ids(records_id)
+        self.logger.debug('Removed %d revisions for %d records', del_count, len(records_id))
+        return del_count
+
@@ -5,10 +5,31 @@ from uuid import uuid4
 
 from pyehr.ehr.services.dbmanager.errors import InvalidJsonStructureError,\
     OperationNotAllowedError
-from pyehr.utils import cleanup_json, decode_dict
+from pyehr.utils import decode_dict
 
 
-class Record(object):
+class _SlotsState(object):
+    """
+    Pickle support for classes using slots: pickle protocols older than 2 can't save objects
+    without an instance dictionary, their state is the map of the slots that are set.
+    """
+
+    __slots__ = ()
+
+    def __getstate__(self):
+        state = dict()
+        for cls in type(self).__mro__:
+            for slot in cls.__dict__.get('__slots__', ()):
+                if hasattr(self, slot):
+                    state[slot] = getattr(self, slot)
+        return state
+
+    def __setstate__(self, state):
+        for slot, value in state.iteritems():
+            setattr(self, slot, value)
+
+
+class Record(_SlotsState):
     """
     Generic record abstract class containing record's base fields.
 
@@ -20,6 +41,9 @@ class Record(object):
 
     __metaclass__ = ABCMeta
 
+    # records are loaded in large batches, slots avoid a dictionary for each instance
+    __slots__ = ('creation_time', 'last_update', 'active', 'record_id')
+
     def __eq__(self, other):
         if type(self) == type(other):
             return (self.record_id == other.record_id) and \
@@ -61,6 +85,8 @@ class PatientRecord(Record):
     :ivar ehr_records: the list of clinical records related to this patient
     """
 
+    __slots__ = ('ehr_records',)
+
     def __init__(self, record_id, ehr_records=None, creation_time=None,
                  last_update=None, active=True):
         super(PatientRecord, self).__init__(creation_time or time.time(),
@@ -122,7 +148,8 @@ class PatientRecord(Record):
             Required('ehr_records'): list
         })
         try:
-            json_data = decode_dict(json_data)
+            # clinical records are decoded by ClinicalRecord.from_json
+            json_data = decode_dict(json_data, skip_keys=('ehr_records',))
             schema(json_data)
             ehr_records = [ClinicalRecord.from_json(ehr) for ehr in json_data['ehr_records']]
             json_data['ehr_records'] = ehr_records
@@ -139,6 +166,8 @@ class ClinicalRecord(Record):
     :ivar ehr_data: clinical data in OpenEHR syntax
     """
 
+    __slots__ = ('ehr_data', 'patient_id', 'structure_id', '_version')
+
     def __init__(self, ehr_data, creation_time=None, last_update=None,
                  active=True, record_id=None, structure_id=None,
                  version=0):
@@ -237,7 +266,8 @@ class ClinicalRecord(Record):
         """
         schema = cls._get_validation_schema()
         try:
-            json_data = decode_dict(json_data)
+            # archetype data are decoded by ArchetypeInstance.from_json
+            json_data = decode_dict(json_data, skip_keys=('ehr_data',))
             schema(json_data)
             json_data['ehr_data'] = ArchetypeInstance.from_json(json_data['ehr_data'])
             try:
@@ -268,6 +298,8 @@ class ClinicalRecord(Record):
 
 class ClinicalRecordRevision(ClinicalRecord):
 
+    __slots__ = ()
+
     def __init__(self, ehr_data, record_id, patient_id, creation_time=None, last_update=None,
                  active=True, structure_id=None, version=0):
         super(ClinicalRecordRevision, self).__init__(ehr_data, creation_time, last_update,
@@ -303,7 +335,7 @@ class ClinicalRecordRevision(ClinicalRecord):
         return crec
 
 
-class ArchetypeInstance(object):
+class ArchetypeInstance(_SlotsState):
     """
     Class representing an openEHR Archetype instance
 
@@ -312,117 +344,195 @@ class ArchetypeInstance(object):
                              Values of the dictionary can be :class:`ArchetypeInstance` objects.
     """
 
+    __slots__ = ('archetype_class', '_archetype_details')
+
+    _VALIDATION_SCHEMA = Schema({
+        Required('archetype_class'): str,
+        Required('archetype_details'): dict,
+    })
+
     def __init__(self, archetype_class, archetype_details):
         self.archetype_class = archetype_class
         self.archetype_details = archetype_details
 
-    def to_json(self):
+    @property
+    def archetype_details(self):
+        return self._archetype_details
+
+    @archetype_details.setter
+    def archetype_details(self, archetype_details):
+        self._archetype_details = archetype_details
+
+    def to_json(self, keys_map=None):
         """
-        Encode current record into a JSON dictionary
+        Encode current record into a JSON dictionary. If *keys_map* is given, keys of the
+        dictionary are encoded in the same walk, every occurrence of a key of *keys_map* within
+        a key of the JSON dictionary is replaced by the corresponding value.
 
+        :param keys_map: the substrings of the keys that must be replaced
+        :type keys_map: dictionary
         :return: a JSON dictionary
         :rtype: dictionary
         """
+        def encode_key(key):
+            for original, encoded in keys_map.iteritems():
+                key = key.replace(original, encoded)
+            return key
+
+        def encode_value(value):
+            if isinstance(value, ArchetypeInstance):
+                return encode_archetype(value)
+            elif isinstance(value, dict):
+                return encode_dict_data(value)
+            elif isinstance(value, list):
+                return [encode_value(x) for x in value]
+            return value
+
         def encode_dict_data(record_data):
-            data = dict()
-            for k, v in record_data.iteritems():
-                if isinstance(v, ArchetypeInstance):
-                    data[k] = v.to_json()
-                elif isinstance(v, dict):
-                    data[k] = encode_dict_data(v)
-                elif isinstance(v, list):
-                    data[k] = encode_list_data(v)
-                else:
-                    data[k] = v
-            return data
-
-        def encode_list_data(record_data):
-            data = list()
-            for x in record_data:
-                if isinstance(x, ArchetypeInstance):
-                    data.append(x.to_json())
-                elif isinstance(x, dict):
-                    data.append(encode_dict_data(x))
-                elif isinstance(x, list):
-                    data.append(encode_list_data(x))
-                else:
-                    data.append(x)
-            return data
-
-        json = {
-            'archetype_class': self.archetype_class,
-            'archetype_details': dict()
-        }
-        for k, v in self.archetype_details.iteritems():
-            if isinstance(v, ArchetypeInstance):
-                json['archetype_details'][k] = v.to_json()
-            elif isinstance(v, dict):
-                json['archetype_details'][k] = encode_dict_data(v)
-            elif isinstance(v, list):
-                json['archetype_details'][k] = encode_list_data(v)
-            else:
-                json['archetype_details'][k] = v
-        return json
+            if keys_map:
+                return dict((encode_key(k), encode_value(v)) for k, v in record_data.iteritems())
+            return dict((k, encode_value(v)) for k, v in record_data.iteritems())
+
+        def encode_archetype(archetype):
+            return {
+                'archetype_class': archetype.archetype_class,
+                'archetype_details': encode_dict_data(archetype.archetype_details)
+            }
+
+        return encode_archetype(self)
 
     @staticmethod
-    def from_json(json_data):
+    def from_json(json_data, validate=True, lazy=False, keys_map=None):
         """
-        Create an :class:`ArchetypeInstance` object from a given JSON dictionary
+        Create an :class:`ArchetypeInstance` object from a given JSON dictionary. Data are
+        processed in a single walk that converts unicode into strings, removes None values
+        (as well as empty lists and dictionaries) and builds nested :class:`ArchetypeInstance`
+        objects. Validation of the archetypes structure can be disabled for data that are known
+        to be well formed, like records loaded from the database.
+        If *lazy* is True, a :class:`LazyArchetypeInstance` is returned and archetype details
+        are decoded one level at a time, when they are accessed.
 
         :param json_data: the JSON corresponding to the :class:`ArchetypeInstance` object
         :type json_data: dictionary
+        :param validate: if True, check the structure of every archetype
+        :type validate: bool
+        :param lazy: if True, decode archetype details only when they are accessed
+        :type lazy: bool
+        :param keys_map: a dictionary used to restore the keys of the JSON dictionary, every
+          occurrence of a dictionary key is replaced by the corresponding value
+        :type keys_map: dictionary
         :return: an :class:`ArchetypeInstance` object
         :rtype: :class:`ArchetypeInstance`
         """
-        def is_archetype(dict):
-            return ('archetype_class' in dict) and ('archetype_details' in dict)
-
-        def decode_dict_data(dict_data):
-            data = dict()
-            for k, v in dict_data.iteritems():
-                if isinstance(v, dict):
-                    if is_archetype(v):
-                        data[k] = ArchetypeInstance.from_json(v)
-                    else:
-                        data[k] = decode_dict_data(v)
-                elif isinstance(v, list):
-                    data[k] = decode_list_data(v)
-                else:
-                    data[k] = v
-            return data
-
-        def decode_list_data(dict_data):
-            data = list()
-            for x in dict_data:
-                if isinstance(x, dict):
-                    if is_archetype(x):
-                        data.append(ArchetypeInstance.from_json(x))
-                    else:
-                        data.append(decode_dict_data(x))
-                elif isinstance(x, list):
-                    data.append(decode_list_data(x))
-                else:
-                    data.append(x)
-            return data
-
-        schema = Schema({
-            Required('archetype_class'): str,
-            Required('archetype_details'): dict,
-        })
+        decoder = _ArchetypeDecoder(validate, lazy, keys_map)
         try:
-            json_data = cleanup_json(decode_dict(json_data))
-            schema(json_data)
-            archetype_data = dict()
-            for k, v in json_data['archetype_details'].iteritems():
-                if isinstance(v, dict):
-                    if is_archetype(v):
-                        archetype_data[k] = ArchetypeInstance.from_json(v)
-                    else:
-                        archetype_data[k] = decode_dict_data(v)
-                elif isinstance(v, list):
-                    archetype_data[k] = decode_list_data(v)
-                else:
-                    archetype_data[k] = v
-            return ArchetypeInstance(json_data['archetype_class'], archetype_data)
+            if not (isinstance(json_data, dict) and decoder.is_archetype(json_data)):
+                decoder.validate_archetype(json_data)
+            return decoder.decode_archetype(json_data)
         except MultipleInvalid:
-            raise InvalidJsonStructureError('JSON record\'s structure is not compatible with ArchetypeInstance object')
\ No newline at end of file
+            raise InvalidJsonStructureError('JSON record\'s structure is not compatible with ArchetypeInstance object')
+
+
+class LazyArchetypeInstance(ArchetypeInstance):
+    """
+    An :class:`ArchetypeInstance` that keeps archetype details as they were retrieved from the
+    backend and decodes them the first time that they are accessed, nested archetypes are
+    :class:`LazyArchetypeInstance` objects as well. Records that are only listed never build
+    the full tree of their clinical data.
+
+    Use :meth:`ArchetypeInstance.from_json` with *lazy* set to True to create these objects.
+    """
+
+    __slots__ = ('_raw_details', '_decoder')
+
+    def __init__(self, archetype_class, raw_details, decoder):
+        super(LazyArchetypeInstance, self).__init__(archetype_class, None)
+        self._raw_details = raw_details
+        self._decoder = decoder
+
+    @property
+    def is_loaded(self):
+        return self._raw_details is None
+
+    @property
+    def archetype_details(self):
+        if self._raw_details is not None:
+            try:
+                self._decoder.validate_archetype({'archetype_class': self.archetype_class,
+                                                  'archetype_details': self._raw_details})
+                details = self._decoder.decode_dict(self._raw_details)
+            except MultipleInvalid:
+                raise InvalidJsonStructureError('JSON record\'s structure is not compatible with ArchetypeInstance object')
+            self.archetype_details = details or {}
+        return self._archetype_details
+
+    @archetype_details.setter
+    def archetype_details(self, archetype_details):
+        self._archetype_details = archetype_details
+        self._raw_details = None
+
+
+class _ArchetypeDecoder(_SlotsState):
+    """
+    Decode the JSON representation of :class:`ArchetypeInstance` objects, see
+    :meth:`ArchetypeInstance.from_json`
+    """
+
+    __slots__ = ('validate', 'lazy', 'keys_map')
+
+    def __init__(self, validate=True, lazy=False, keys_map=None):
+        self.validate = validate
+        self.lazy = lazy
+        self.keys_map = keys_map
+
+    @staticmethod
+    def is_archetype(json_data):
+        return ('archetype_class' in json_data) and ('archetype_details' in json_data)
+
+    def validate_archetype(self, json_data):
+        if self.validate:
+            ArchetypeInstance._VALIDATION_SCHEMA(json_data or {})
+
+    def decode_key(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        if self.keys_map:
+            for encoded, original in self.keys_map.iteritems():
+                key = key.replace(encoded, original)
+        return key
+
+    def decode_value(self, value):
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        elif isinstance(value, dict):
+            if self.is_archetype(value):
+                return self.decode_archetype(value)
+            return self.decode_dict(value)
+        elif isinstance(value, list):
+            return self.decode_list(value)
+        return value
+
+    def decode_dict(self, dict_data):
+        data = dict()
+        for k, v in dict_data.iteritems():
+            v = self.decode_value(v)
+            if v is not None:
+                data[self.decode_key(k)] = v
+        return data or None
+
+    def decode_list(self, list_data):
+        data = list()
+        for x in list_data:
+            x = self.decode_value(x)
+            if x is not None:
+                data.append(x)
+        return data or None
+
+    def decode_archetype(self, json_data):
+        if self.lazy:
+            return LazyArchetypeInstance(self.decode_value(json_data['archetype_class']),
+                                         json_data['archetype_details'], self)
+        archetype_data = self.decode_dict(json_data)
+        self.validate_archetype(archetype_data)
+        return ArchetypeInstance(archetype_data['archetype_class'],
+                                 archetype_data.get('archetype_details', {}))
@@ -0,0 +1,158 @@
+import os
+import time
+from threading import Lock
+
+from pyehr.utils import get_logger
+
+
+class ConnectionPool(object):
+    """
+    A process-wide pool of database clients shared by all the drivers instances created
+    by the :class:`DriversFactory`. Clients are stored by key, a key is built by the driver and
+    identifies the (driver, host, port, database, credentials) tuple, so that a client
+    is never shared between two different servers or users.
+
+    A driver *leases* a client when it connects and *releases* it when it disconnects, clients
+    that are released are kept idle and handed back to the next driver using the same key
+    instead of opening a new TCP connection (and a new authentication handshake).
+
+    *max_size* is the number of idle clients kept for each key, clients released when the
+    pool is full are closed. Clients that stayed idle for more than *max_idle_time* seconds
+    are closed and removed from the pool. Before being leased, a client that has not been
+    checked in the last *health_check_interval* seconds is tested using the check function
+    provided by the driver and discarded if the check fails.
+    """
+
+    def __init__(self, max_size=10, max_idle_time=300, health_check_interval=30,
+                 logger=None):
+        self.max_size = max_size
+        self.max_idle_time = max_idle_time
+        self.health_check_interval = health_check_interval
+        self.logger = logger or get_logger('connection-pool')
+        self._lock = Lock()
+        self._idle_clients = {}
+        self._pid = os.getpid()
+
+    def _check_pid(self):
+        # clients inherited from a parent process (i.e. multiprocessing workers) share their
+        # sockets with the parent, drop them without closing and start with an empty pool
+        if self._pid != os.getpid():
+            self.logger.debug('Process forked, resetting connection pool')
+            self._idle_clients = {}
+            self._pid = os.getpid()
+
+    def _close_client(self, client, close_function):
+        try:
+            close_function(client)
+        except Exception, e:
+            self.logger.warning('Error while closing pooled client: %s', e)
+
+    def _evict_idle_clients(self, key):
+        now = time.time()
+        alive_clients = []
+        for client, close_function, released_at, checked_at in self._idle_clients.get(key, []):
+            if now - released_at > self.max_idle_time:
+                self.logger.debug('Evicting client idle for %.2f seconds', now - released_at)
+                self._close_client(client, close_function)
+            else:
+                alive_clients.append((client, close_function, released_at, checked_at))
+        self._idle_clients[key] = alive_clients
+
+    def lease(self, key, open_function, close_function, check_function=None):
+        """
+        Get a client for the given *key*. An idle client is returned if available, otherwise
+        a new one is created using *open_function*.
+
+        :param key: the key identifying the connection parameters
+        :type key: tuple
+        :param open_function: a function with no arguments that opens a new client
+        :param close_function: a function that closes the client passed as argument
+        :param check_function: a function that raises an exception (or returns False) if the
+                               client passed as argument can't be used anymore
+        :return: a client object
+        """
+        while True:
+            with self._lock:
+                self._check_pid()
+                self._evict_idle_clients(key)
+                try:
+                    client, _, _, checked_at = self._idle_clients[key].pop()
+                except IndexError:
+                    break
+            if check_function is None or \
+                    time.time() - checked_at <= self.health_check_interval:
+                return client
+            try:
+                if check_function(client) is not False:
+                    return client
+            except Exception, e:
+                self.logger.debug('Health check failed for pooled client: %s', e)
+            self._close_client(client, close_function)
+        self.logger.debug('No idle client available, opening a new one')
+        return open_function()
+
+    def release(self, key, client, close_function):
+        """
+        Give back to the pool a client obtained with the :meth:`lease` method. If the pool
+        already holds *max_size* idle clients for the given *key* the client is closed.
+
+        :param key: the key used to lease the client
+        :type key: tuple
+        :param client: the client that is going to be released
+        :param close_function: a function that closes the client passed as argument
+        """
+        with self._lock:
+            self._check_pid()
+            self._evict_idle_clients(key)
+            idle_clients = self._idle_clients[key]
+            if len(idle_clients) < self.max_size:
+                now = time.time()
+                # a client that was just used is considered healthy
+                idle_clients.append((client, close_function, now, now))
+                return
+        self._close_client(client, close_function)
+
+    def clear(self):
+        """
+        Close all the idle clients stored in the pool.
+        """
+        with self._lock:
+            self._check_pid()
+            idle_clients, self._idle_clients = self._idle_clients, {}
+        for clients in idle_clients.itervalues():
+            for client, close_function, _, _ in clients:
+                self._close_client(client, close_function)
+
+
+_connection_pool = ConnectionPool()
+
+
+def get_connection_pool():
+    """
+    Return the connection pool shared by all the drivers of the current process.
+
+    :rtype: :class:`ConnectionPool`
+    """
+    return _connection_pool
+
+
+def configure_connection_pool(max_size=None, max_idle_time=None,
+                              health_check_interval=None):
+    """
+    Change the settings of the shared connection pool. Settings that are not
+    specified keep their current value.
+
+    :param max_size: the number of idle clients kept for each connection key
+    :type max_size: int
+    :param max_idle_time: seconds after which an idle client is closed
+    :type max_idle_time: int
+    :param health_check_interval: seconds after which an idle client is checked before
+                                  being leased again
+    :type health_check_interval: int
+    """
+    if max_size is not None:
+        _connection_pool.max_size = max_size
+    if max_idle_time is not None:
+        _connection_pool.max_idle_time = max_idle_time
+    if health_check_interval is not None:
+        _connection_pool.health_check_interval = health_check_interval
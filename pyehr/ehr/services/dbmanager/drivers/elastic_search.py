@@ -1,13 +1,15 @@
 from pyehr.aql.parser import *
 from pyehr.ehr.services.dbmanager.drivers.interface import DriverInterface
+from pyehr.ehr.services.dbmanager.drivers.connection_pool import get_connection_pool
 from pyehr.ehr.services.dbmanager.querymanager.results_wrappers import *
 from pyehr.ehr.services.dbmanager.errors import *
 from pyehr.utils import *
-from itertools import izip
+from pyehr.utils import serializers
+from itertools import izip, islice
 from hashlib import md5
 from pyehr.ehr.services.dbmanager.querymanager.results_wrappers import ResultSet,\
-    ResultColumnDef, ResultRow
-from multiprocessing import Pool
+    ResultColumnDef, ResultRow, StreamingResultSet
+from contextlib import contextmanager
 
 try:
     import simplejson as json
@@ -17,6 +19,7 @@ except ImportError:
 import elasticsearch
 import time
 import re
+import copy
 
 class MultiprocessQueryRunner(object):
 
@@ -37,7 +40,8 @@ class MultiprocessQueryRunner(object):
         )
         results = driver_instance._run_aql_query(
             query_description['condition'], query_description['selection'],
-            query_description['aliases'], self.collection_name
+            query_description['aliases'], self.collection_name,
+            query_description.get('limit', 0), query_description.get('order_by')
         )
         return results
 
@@ -109,19 +113,40 @@ class ElasticSearchDriver(DriverInterface):
         self.disconnect()
         return None
 
+    @property
+    def _pool_key(self):
+        hosts = tuple(sorted((h['host'], h['port']) for h in self.host))
+        return (self.__class__.__name__, hosts, self.user, self.passwd)
+
+    def _open_client(self):
+        self.logger.debug('opening a new client for host %s', self.host)
+        try:
+            client = elasticsearch.Elasticsearch(hosts=self.host,connection_class=self.transportclass,
+                                                 maxsize=100,timeout=self.global_timeout)
+            client.info()
+        except elasticsearch.TransportError:
+            raise DBManagerNotConnectedError('Unable to connect to ElasticSearch at %s:%s' %
+                                            (self.host[0]['host'], self.host[0]['port']))
+        return client
+
+    def _close_client(self, client):
+        # elasticsearch-py doesn't always expose a close method on the transport
+        close = getattr(client.transport, 'close', None)
+        if close:
+            close()
+
+    def _check_client(self, client):
+        return client.ping()
+
     def connect(self):
         """
         Open a connection to a ES server.
+        The client is leased from the connection pool shared by all drivers of the current process.
         """
         if not self.client:
             self.logger.debug('connecting to host %s', self.host)
-            try:
-                self.client = elasticsearch.Elasticsearch(hosts=self.host,connection_class=self.transportclass,
-                                                          maxsize=100,timeout=self.global_timeout)
-                self.client.info()
-            except elasticsearch.TransportError:
-                raise DBManagerNotConnectedError('Unable to connect to ElasticSearch at %s:%s' %
-                                                (self.host[0]['host'], self.host[0]['port']))
+            self.client = get_connection_pool().lease(self._pool_key, self._open_client,
+                                                      self._close_client, self._check_client)
             self.logger.debug('binding to database %s', self.database)
             #there is no authentication/authorization layer in elasticsearch
             self.logger.debug('using collection %s', self.collection)
@@ -131,9 +156,12 @@ class ElasticSearchDriver(DriverInterface):
     def disconnect(self):
         """
         Close a connection to a ES server.
-        There's not such thing so we simply erase the client pointer
+        There's not such thing so we simply give the client back to the connection pool
+        and erase the client pointer
         """
         self.logger.debug('disconnecting from host %s', self.host)
+        if self.client:
+            get_connection_pool().release(self._pool_key, self.client, self._close_client)
         self.database = None
         self.collection = None
         self.client = None
@@ -200,23 +228,11 @@ class ElasticSearchDriver(DriverInterface):
         return encoded_record
 
     def _to_json(self,doc):
-        return json.dumps(doc)
+        return serializers.dumps(doc)
 
     def _from_json(self,doc):
         return json.loads('"'+doc+'"')
 
-    def _normalize_keys(self, document, original, encoded):
-        normalized_doc = {}
-        for k, v in document.iteritems():
-            k = k.replace(original, encoded)
-            if not isinstance(v, dict):
-                if isinstance(v, list):
-                    v = [self._normalize_keys(x, original, encoded) for x in v]
-                normalized_doc[k] = v
-            else:
-                normalized_doc[k] = self._normalize_keys(v, original, encoded)
-        return normalized_doc
-
     def _encode_clinical_record(self, clinical_record):
         """
         encode clinical record, i.e. transform from openehr to ES representation
@@ -225,15 +241,15 @@ class ElasticSearchDriver(DriverInterface):
         :return:encoded_record: clinical record in ES representation
         :type: encoded_record: dict
         """
-        ehr_data = clinical_record.ehr_data.to_json()
-        for original_value, encoded_value in self.ENCODINGS_MAP.iteritems():
-            ehr_data = self._normalize_keys(ehr_data, original_value, encoded_value)
+        # keys are encoded while the archetype is converted to JSON
+        ehr_data = clinical_record.ehr_data.to_json(keys_map=self.ENCODINGS_MAP)
         encoded_record = {
             'patient_id': clinical_record.patient_id,
             'creation_time': clinical_record.creation_time,
             'last_update': clinical_record.last_update,
             'active': clinical_record.active,
             'ehr_data': ehr_data,
+            'content_hash': self._get_content_hash(ehr_data),
             'version': clinical_record.version
         }
         if clinical_record.structure_id:
@@ -251,9 +267,8 @@ class ElasticSearchDriver(DriverInterface):
         :return:clinical revision record in ES representation
         :type: dict
         """
-        ehr_data = clinical_record_revision.ehr_data.to_json()
-        for original_value, encoded_value in self.ENCODINGS_MAP.iteritems():
-            ehr_data = self._normalize_keys(ehr_data, original_value, encoded_value)
+        # keys are encoded while the archetype is converted to JSON
+        ehr_data = clinical_record_revision.ehr_data.to_json(keys_map=self.ENCODINGS_MAP)
 
         return {
             '_id': clinical_record_revision.record_id['_id']+"_"+str(clinical_record_revision.record_id['_version']),
@@ -319,15 +334,12 @@ class ElasticSearchDriver(DriverInterface):
             )
 
 #    @profile
-    def _decode_keys(self, document, encoded, original):
-        normalized_doc = {}
-        for k, v in document.iteritems():
-            k = k.replace(encoded, original)
-            if not isinstance(v, dict):
-                normalized_doc[k] = v
-            else:
-                normalized_doc[k] = self._decode_keys(v, encoded, original)
-        return normalized_doc
+    def _decode_archetype(self, ehr_data):
+        from pyehr.ehr.services.dbmanager.dbservices.wrappers import ArchetypeInstance
+
+        # encoded keys are restored while archetype details are decoded, when they are accessed
+        keys_map = dict((encoded, original) for original, encoded in self.ENCODINGS_MAP.iteritems())
+        return ArchetypeInstance.from_json(ehr_data, validate=False, lazy=True, keys_map=keys_map)
 
 #    @profile
     def _decode_clinical_record(self, record, loaded):
@@ -342,13 +354,11 @@ class ElasticSearchDriver(DriverInterface):
         """
         from pyehr.ehr.services.dbmanager.dbservices.wrappers import ClinicalRecord,\
             ArchetypeInstance
-        record = decode_dict(record)
+        # archetype data are decoded by ArchetypeInstance.from_json
+        record = decode_dict(record, skip_keys=('ehr_data',) if loaded else ())
         if loaded:
-            ehr_data = record['ehr_data']
-            for original_value, encoded_value in self.ENCODINGS_MAP.iteritems():
-                ehr_data = self.decode_keys(ehr_data, encoded_value, original_value)
             crec = ClinicalRecord(
-                ehr_data=ArchetypeInstance.from_json(ehr_data),
+                ehr_data=self._decode_archetype(record['ehr_data']),
                 creation_time=record['creation_time'],
                 last_update=record['last_update'],
                 active=record['active'],
@@ -385,14 +395,10 @@ class ElasticSearchDriver(DriverInterface):
         :return:clinical revision record entity
         :type: ClinicalRecordRevision
         """
-        from pyehr.ehr.services.dbmanager.dbservices.wrappers import ClinicalRecordRevision, \
-            ArchetypeInstance
-        record = decode_dict(record)
-        ehr_data = record['ehr_data']
-        for original_value, encoded_value in self.ENCODINGS_MAP.iteritems():
-            ehr_data = self._decode_keys(ehr_data, encoded_value, original_value)
+        from pyehr.ehr.services.dbmanager.dbservices.wrappers import ClinicalRecordRevision
+        record = decode_dict(record, skip_keys=('ehr_data',))
         return ClinicalRecordRevision(
-            ehr_data=ArchetypeInstance.from_json(ehr_data),
+            ehr_data=self._decode_archetype(record['ehr_data']),
             patient_id=record['patient_id'],
             creation_time=record['creation_time'],
             last_update=record['last_update'],
@@ -428,11 +434,12 @@ class ElasticSearchDriver(DriverInterface):
 
 #    @profile
     def _is_clinical_record_revision(self,record):
-        return ('ehr_data' in record) and ('archived' in record)
+        # revisions archived in delta mode don't have the ehr_data field
+        return 'archived' in record
 
 #    @profile
     def _is_patient_record(self,record):
-        return 'ehr_data' not in record
+        return ('ehr_data' not in record) and ('archived' not in record)
 
     @property
     def documents_count(self):
@@ -449,6 +456,26 @@ class ElasticSearchDriver(DriverInterface):
     def count(self):
         return self.client.count(index=self.database)['count']
 
+    @contextmanager
+    def bulk_ingest_mode(self):
+        """
+        Context manager used to load large batches of records: within the context write and delete
+        requests don't refresh the indices, the records index and the lookup table are refreshed
+        only once when the context is closed.
+
+        >>> with driver.bulk_ingest_mode():
+        ...     for batch in batches:
+        ...         driver.add_records(batch)
+        """
+        self.__check_connection()
+        original_refresh, original_drefresh = self.refresh, self.drefresh
+        self.refresh = self.drefresh = 'false'
+        try:
+            yield self
+        finally:
+            self.refresh, self.drefresh = original_refresh, original_drefresh
+            self.client.indices.refresh(index=[self.database, self.database_ids], ignore_unavailable=True)
+
     def add_record(self, record):
         """
         Save a record within ElasticSearch and return the record's ID
@@ -554,7 +581,7 @@ class ElasticSearchDriver(DriverInterface):
             if new_value:
                 existing_record['ids']=new_value
                 self.client.index(index=self.database_ids,doc_type=self.doc_ids,id=id2e,
-                                        body=existing_record,refresh='true',timeout=self.insert_timeout)
+                                        body=existing_record,refresh=self.drefresh,timeout=self.insert_timeout)
             else:
                 self.client.delete(index=self.database_ids,doc_type=self.doc_ids,id=id2e,refresh=self.drefresh)
         else:
@@ -562,15 +589,15 @@ class ElasticSearchDriver(DriverInterface):
             existing_record=self._get_ids(baseid)
             if existing_record:
                 old_value=existing_record['ids']
-                new_value=[ov for ov in old_value if ov[0] != id]
+                new_value=[ov for ov in old_value if ov[0] != id2e]
                 if new_value:
                     existing_record['ids']=new_value
                     self.client.index(index=self.database_ids,doc_type=self.doc_ids,id=baseid,
-                                        body=existing_record,refresh='true',timeout=self.insert_timeout)
+                                        body=existing_record,refresh=self.drefresh,timeout=self.insert_timeout)
                 else:
                     self.client.delete(index=self.database_ids,doc_type=self.doc_ids,id=baseid,refresh=self.drefresh)
             else:
-                raise MissingRevisionError("A record with ID %s does not exist in archive" % id)
+                raise MissingRevisionError("A record with ID %s does not exist in archive" % id2e)
 
     def pack_records(self,records,rectype_clinical):
         """
@@ -583,8 +610,7 @@ class ElasticSearchDriver(DriverInterface):
         :type rectype_clinical: bool
         :return:
         """
-        first="{\"create\":{\"_index\":\""+self.database
-        puzzle=""
+        puzzle=[]
         for dox in records:
             if(rectype_clinical and self._is_patient_record(dox)):
                 raise InvalidRecordTypeError("Patient Record among Clinical Records")
@@ -592,15 +618,69 @@ class ElasticSearchDriver(DriverInterface):
                 raise InvalidRecordTypeError("Clinical Record among Patient Records")
             if rectype_clinical:
                 self._select_doc_type(dox['ehr_structure_id'])
-            puzzle=puzzle+first+"\",\"_type\":\""+self.collection_name+"\""
+            action={'_index': self.database, '_type': self.collection_name}
             if(dox.has_key('_id')):
-                puzzle = puzzle+",\"_id\":\""+dox['_id']+"\"}}\n"
-            else:
-                puzzle=puzzle+"}}\n"
-            puzzle=puzzle+self._to_json(dox)
-            puzzle=puzzle+"\n"
-        return puzzle
+                action['_id']=dox['_id']
+            puzzle.append(self._to_json({'create': action}))
+            puzzle.append(self._to_json(dox))
+        return ''.join('%s\n' % line for line in puzzle)
+
 
+    def _get_base_id(self, record):
+        if self._is_patient_record(record):
+            return record['_id']
+        return record['_id'].rsplit('_', 1)[0]
+
+    def pack_ids(self, records, rectype_clinical):
+        """
+        pack the entries of the lookup table for the given records for the bulk insertion,
+        current entries are fetched with a single request
+
+        :param records: records to be packed, they must be the same records packed with pack_records
+        :type records : list of dict
+        :param rectype_clinical: whether the records are clinical records
+        :type rectype_clinical: bool
+        :return:
+        """
+        lookup_entries = dict()
+        for dox in records:
+            if rectype_clinical:
+                self._select_doc_type(dox['ehr_structure_id'])
+            lookup_entries.setdefault(self._get_base_id(dox), []).append([dox['_id'], self.database,
+                                                                          self.collection_name])
+        try:
+            existing_records = self.client.mget(index=self.database_ids, doc_type=self.doc_ids,
+                                                body={'ids': lookup_entries.keys()})['docs']
+        except elasticsearch.NotFoundError:
+            # the lookup table is created with the first entry
+            existing_records = []
+        for er in existing_records:
+            if er.get('found'):
+                lookup_entries[er['_id']] = er['_source']['ids'] + lookup_entries[er['_id']]
+        puzzle=[]
+        for baseid, ids in lookup_entries.iteritems():
+            puzzle.append(self._to_json({'index': {'_index': self.database_ids, '_type': self.doc_ids, '_id': baseid}}))
+            puzzle.append(self._to_json({'ids': ids}))
+        return ''.join('%s\n' % line for line in puzzle)
+
+    def _get_taken_ids(self, indextc, ids):
+        """
+        given the database and a list of ids returns the ids of the records that already exist,
+        a single request is made to the server
+
+        :param indextc: database (index)
+        :type indextc: str
+        :param ids: the ids that will be checked
+        :type ids: list
+        :return: set
+        """
+        if not ids:
+            return set()
+        try:
+            res = self.client.mget(index=indextc, body={'ids': ids}, _source=False)
+        except elasticsearch.NotFoundError:
+            return set()
+        return set(d['_id'] for d in res['docs'] if d.get('found'))
 
     def _is_id_taken(self,indextc,idtc,collection_nametc=None):
         """
@@ -640,50 +720,54 @@ class ElasticSearchDriver(DriverInterface):
         notduplicatedlist=[]
         duplicatedlistid=[]
         records_map={}
+        taken_ids=self._get_taken_ids(self.database,[r['_id'] for r in records])
         for r in records:
             myid=r['_id']
-            if myid in records_map:
+            if myid in records_map or myid in taken_ids:
                 duplicatedlist.append(r)
                 duplicatedlistid.append(myid)
             else:
                 records_map[myid]=r
-                if(not self._is_patient_record(r)):
-                    self._select_doc_type(r['ehr_structure_id'])
-                if(self._is_id_taken(self.database,myid)):
-                    duplicatedlist.append(r)
-                    duplicatedlistid.append(myid)
-                else:
-                    notduplicatedlist.append(r)
+                notduplicatedlist.append(r)
         if duplicatedlist and not skip_existing_duplicated:
             raise DuplicatedKeyError('The following IDs are already in use: %s' % duplicatedlistid)
+        if not notduplicatedlist:
+            return [],duplicatedlist
+        # records and their lookup table entries are written with a single request
         bulklist = self.pack_records(notduplicatedlist,rectype_clinical)
+        bulklist = bulklist + self.pack_ids(notduplicatedlist,rectype_clinical)
         bulkanswer = self.client.bulk(body=bulklist,index=self.database,refresh=self.refresh,
                                       timeout=self.insert_timeout)
-        failuresid=[]
-        errtype=[]
-        nerrors=0
-        successfulid=[]
+        created = [b['create'] for b in bulkanswer['items'] if 'create' in b]
         if(bulkanswer['errors']): # there are errors
             for b in bulkanswer['items']:
-                if(b['create'].has_key('error')):
-                    failuresid.append(str(b['create']['_id']))
-                    errtype.append(str(b['create']['error']))
-                    nerrors += 1
+                for action, res in b.iteritems():
+                    if res.has_key('error'):
+                        self.logger.error('Bulk %s of record %s failed: %s', action, res['_id'], res['error'])
+            # rollback, remove created records and the lookup table entries added for them,
+            # records that failed because their ID was taken concurrently keep the lookup
+            # table entry of the record that was saved with that ID
+            takenlistid=[]
+            for c in created:
+                if not c.has_key('error'):
+                    r=records_map[c['_id']]
+                    if rectype_clinical:
+                        self._select_doc_type(r['ehr_structure_id'])
+                    self.delete_record(c['_id'])
+                elif c.get('status') == 409:
+                    takenlistid.append(c['_id'])
                 else:
-                    successfulid.append(b['create']['_id'])
-            for s in successfulid:
-                r=records_map[s]
-                if rectype_clinical:
-                    self._select_doc_type(r['ehr_structure_id'])
-                self._store_ids(r)
-                self.delete_record(s)
+                    try:
+                        self._erase_ids(str(c['_id']))
+                    except MissingRevisionError:
+                        pass
+            if takenlistid:
+                if not skip_existing_duplicated:
+                    raise DuplicatedKeyError('The following IDs are already in use: %s' % takenlistid)
+                duplicatedlist.extend(records_map[i] for i in takenlistid)
             return [],duplicatedlist
         else:
-            for r in notduplicatedlist:
-                if rectype_clinical:
-                    self._select_doc_type(r['ehr_structure_id'])
-                self._store_ids(r)
-            return [b['create']['_id'] for b in bulkanswer['items']],duplicatedlist
+            return [c['_id'] for c in created],duplicatedlist
 
     def get_record_by_id(self, record_id):
         """
@@ -725,7 +809,47 @@ class ElasticSearchDriver(DriverInterface):
         except elasticsearch.NotFoundError:
             return None
 
+    def get_records_by_ids(self, records_id, fields=None, active_only=False):
+        """
+        Retrieve all the records whose ID is in *records_id* with a single request,
+        a multi get is used if all records are requested, a search with an ids filter if
+        only active records are requested
 
+        :param records_id: the IDs of the records
+        :type records_id: list
+        :param fields: the fields to be retrieved
+        :type fields: list
+        :param active_only: if True, skip records with the active flag set to False
+        :type active_only: boolean
+        :return: a list with the matching records, records order is not guaranteed
+        :rtype: list
+        """
+        self.__check_connection()
+        records_id = [str(rid) for rid in records_id]
+        if not records_id:
+            return []
+        if active_only:
+            query = {
+                'query': {
+                    'filtered': {
+                        'filter': {
+                            'bool': {
+                                'must': [
+                                    {'ids': {'values': records_id}},
+                                    {'term': {'active': True}}
+                                ]
+                            }
+                        }
+                    }
+                }
+            }
+            return list(self.get_records_by_query(query, fields) or [])
+        if fields:
+            res = self.client.mget(index=self.database, body={'ids': records_id},
+                                   _source_include=fields)
+        else:
+            res = self.client.mget(index=self.database, body={'ids': records_id})
+        return [decode_dict(doc['_source']) for doc in res['docs'] if doc.get('found')]
 
     def get_record_by_id_lookup(self, record_id):
         """
@@ -875,6 +999,34 @@ class ElasticSearchDriver(DriverInterface):
             return ( decode_dict(res[i]) for i in range(0,len(res)) )
         return None
 
+    def iter_records(self, filters=None, batch_size=1000, after_id=None):
+        """
+        Iterate over all records of the current collection using a scroll sorted by _uid,
+        so that an iteration can be resumed from the last retrieved ID (ElasticSearch 1.x has
+        no search_after, a range filter on _uid is used instead)
+
+        :param filters: a map of field/value pairs that records must match
+        :type filters: dictionary
+        :param batch_size: the number of records fetched from the server with each round trip
+        :type batch_size: int
+        :param after_id: if not None, only return records with an ID greater than this one
+        :return: a generator over the matching records
+        """
+        self.__check_connection()
+        clauses = [{'term': {field: value}} for field, value in (filters or {}).iteritems()]
+        if after_id is not None:
+            clauses.append({'range': {'_uid': {'gt': '%s#%s' % (self.collection, after_id)}}})
+        if clauses:
+            records_filter = {'bool': {'must': clauses}}
+        else:
+            records_filter = {'match_all': {}}
+        query = {
+            'query': {'filtered': {'filter': records_filter}},
+            'sort': [{'_uid': {'order': 'asc'}}]
+        }
+        for hit in self._scroll_hits(query, size=batch_size, doc_type=self.collection):
+            yield decode_dict(hit['_source'])
+
     def get_records_by_values(self, field, values):
         """
         Retrieve all records whose field *field* matches one of the given values
@@ -1177,6 +1329,117 @@ class ElasticSearchDriver(DriverInterface):
         self.add_record(new_record)
         return last_update
 
+    def swap_record(self, record_id, new_record, version, update_timestamp_label=None):
+        """
+        Replace record with *record_id* with the given *new_record* only if the version of the
+        saved record is *version* and if its content hash or its metadata differ from the ones
+        of *new_record*. If the document type of the record doesn't change, the record is indexed using the
+        ElasticSearch version of the retrieved document, so the replacement fails if the document
+        was modified after it was checked; otherwise the record is deleted and saved again with
+        its new document type and the replacement is not atomic.
+
+        :param record_id: the ID of the record that will be replaced with the new one
+        :param new_record: the new record
+        :type new_record: dict
+        :param version: the expected version of the saved record
+        :type version: int
+        :param update_timestamp_label: the label of the *last_update* field of the record
+                                       if the last update timestamp must be recorded or None
+        :type update_timestamp_label: field label or None
+        :return: the replaced record, or None if no record was replaced, and the timestamp of the
+                 last update as saved in the DB or None (if *update_timestamp_label* was None)
+        """
+        self.__check_connection()
+        try:
+            res = self.client.get(index=self.database, id=record_id)
+        except elasticsearch.NotFoundError:
+            return None, None
+        previous_record = decode_dict(res['_source'])
+        if previous_record.get('version') != version or \
+                self._is_redundant_swap(previous_record, new_record):
+            return None, None
+        if 'ehr_structure_id' in new_record:
+            doc_type = '%s_%s' % (self.collection, new_record['ehr_structure_id'])
+        else:
+            doc_type = res['_type']
+        if doc_type != res['_type']:
+            return previous_record, self.replace_record(record_id, new_record, update_timestamp_label)
+        last_update = None
+        if update_timestamp_label:
+            last_update = time.time()
+            new_record[update_timestamp_label] = last_update
+        new_record['_id'] = record_id
+        try:
+            self.client.index(index=self.database, doc_type=doc_type, body=self._to_json(new_record),
+                              id=record_id, version=res['_version'], refresh=self.refresh,
+                              timeout=self.insert_timeout)
+        except elasticsearch.ConflictError:
+            self.logger.debug('Record %r was modified by a concurrent update', record_id)
+            return None, None
+        return previous_record, last_update
+
+    def _apply_update(self, record, update_type, field_label, value):
+        if update_type == 'set':
+            record[field_label] = value
+        elif update_type == 'add':
+            record[field_label].append(value)
+        elif update_type == 'extend':
+            record[field_label].extend(value)
+        else:
+            for item in (value if isinstance(value, list) else [value]):
+                record[field_label].remove(item)
+        return record
+
+    def versioned_update(self, record_id, version, field_label, update_type, value,
+                         update_timestamp_label=None):
+        """
+        Apply an update to the field *field_label* of the record with *record_id* and increase
+        its version only if the version of the saved record is *version*. The record is indexed
+        using the ElasticSearch version of the retrieved document, so the update fails if the
+        document was modified after it was read.
+
+        :param record_id: record's ID
+        :param version: the expected version of the saved record
+        :type version: int
+        :param field_label: the label of the field that will be updated
+        :type field_label: string
+        :param update_type: the operation applied to the field, one of UPDATE_TYPES
+        :type update_type: string
+        :param value: the new value of the field or the item (or items) that will be added to
+          or removed from the list
+        :param update_timestamp_label: the label of the *last_update* field of the record if the last update timestamp
+          must be recorded or None
+        :type update_timestamp_label: field label or None
+        :return: the record before the update, or None if no record was updated, and the
+                 timestamp of the last update as saved in the DB or None
+                 (if *update_timestamp_label* was None)
+        """
+        self._check_update_type(update_type)
+        self.__check_connection()
+        try:
+            res = self.client.get(index=self.database, id=record_id)
+        except elasticsearch.NotFoundError:
+            return None, None
+        previous_record = decode_dict(res['_source'])
+        if previous_record.get('version') != version or \
+                (update_type == 'set' and previous_record.get(field_label) == value):
+            return None, None
+        record_to_update = self._apply_update(copy.deepcopy(previous_record), update_type,
+                                              field_label, value)
+        record_to_update['version'] = version + 1
+        if update_timestamp_label:
+            last_update = time.time()
+            record_to_update[update_timestamp_label] = last_update
+        else:
+            last_update = None
+        try:
+            self.client.index(index=self.database, doc_type=res['_type'], body=record_to_update,
+                              id=record_id, version=res['_version'], timeout=self.insert_timeout)
+        except elasticsearch.ConflictError:
+            self.logger.debug('Record %r was modified by a concurrent update', record_id)
+            return None, None
+        return previous_record, last_update
+
     def add_to_list(self, record_id, list_label, item_value, update_timestamp_label=None,
                     increase_version=False):
         """
@@ -1254,7 +1517,7 @@ class ElasticSearchDriver(DriverInterface):
         :param left: left part of the expression
         :param right: right part of the expression
         :param operand: operand
-        :return: mapped expression in ES syntax
+        :return: mapped expression as the clauses of an ES bool query
         """
         def cast_right_operand(rigth_operand):
             if rigth_operand.isdigit():
@@ -1278,11 +1541,11 @@ class ElasticSearchDriver(DriverInterface):
         right = cast_right_operand(right.strip())
         left = left.strip()
         if operand == '=':
-            return {"{\"match\" : "+str({left : right})+"}" : "$%nothing%$"}
+            return {'must': [{'match': {left: right}}]}
         elif operand == "!=":
-            return   { "  \"must_not\" : { \"match\" : "+str({left : right})+"}" : "$%nothing%$" }
+            return {'must_not': [{'match': {left: right}}]}
         elif operand in operands_map:
-            return { "{ \"range\" :  "+str({left: {operands_map[operand]: right}})+"}" : "$%nothing%$" }
+            return {'must': [{'range': {left: {operands_map[operand]: right}}}]}
         else:
             raise ValueError('The operand %s is not supported' % operand)
 
@@ -1348,6 +1611,35 @@ class ElasticSearchDriver(DriverInterface):
         path_pieces[-1] = 'archetype_class'
         return '.'.join(path_pieces)
 
+    def _merge_bool_clauses(self, query, clauses):
+        """
+        Add the clauses of an ES bool query to another one
+
+        :param query: the bool query that will be extended
+        :type query: dict
+        :param clauses: the bool query whose clauses will be added
+        :type clauses: dict
+        :return: the extended bool query
+        """
+        for occur, clause in clauses.iteritems():
+            if isinstance(clause, list):
+                query.setdefault(occur, list()).extend(clause)
+            else:
+                query[occur] = clause
+        return query
+
+    def _to_query_clause(self, clauses):
+        """
+        Turn the clauses of a bool query into a single query clause
+
+        :param clauses: the clauses of a bool query
+        :type clauses: dict
+        :return: a query clause in ES syntax
+        """
+        if clauses.keys() == ['must'] and len(clauses['must']) == 1:
+            return clauses['must'][0]
+        return {'bool': clauses}
+
 #    @profile
     def _calculate_condition_expression(self, condition, variables_map, containment_mapping):
         """
@@ -1356,7 +1648,7 @@ class ElasticSearchDriver(DriverInterface):
         :param condition:
         :param variables_map:
         :param containment_mapping:
-        :return: dict with condition translated in ES syntax
+        :return: dict with the clauses of an ES bool query
         """
         query = dict()
         paths = self._build_paths(containment_mapping)
@@ -1378,29 +1670,14 @@ class ElasticSearchDriver(DriverInterface):
                     else:
                         and_indices.append(i+1)
         if len(or_indices) > 0:
-            for j in or_indices:
-                if(str(expressions[j]).find("must_not") != -1):
-                    exprstr=self._clean_piece(expressions[j])
-                    exprstr2="{ \"bool\":"+exprstr+"}"
-                    exprstr3=exprstr2.replace("\\'","'").replace("\"bool\":{'","\"bool\":{ {'").replace("}':","}}':")
-                    expressions[j]= { exprstr3 : "$%nothing%$"}
-            or_statement= " \"should\" : "+str([ expressions[i] for i in or_indices])+",\"minimum_should_match\" : 1"
-            expressions[max(expressions.keys()) + 1] = or_statement
-            and_indices.append(max(expressions.keys()))
-        if len(and_indices) > 0:
+            query['should'] = [self._to_query_clause(expressions[j]) for j in or_indices]
+            query['minimum_should_match'] = 1
             for ai in and_indices:
-                if(isinstance(expressions[ai],str)):
-                    query.update({str(expressions[ai]) : "$%nothing%$" })
-                elif (str(expressions[ai]).find("must_not") == -1 ):
-                    query.update({ " \"must\" : "+str(expressions[ai]) : "$%nothing%$" })
-                else:
-                    query.update(expressions[ai])
+                if ai not in or_indices:
+                    self._merge_bool_clauses(query, expressions[ai])
         else:
             for e in expressions.values():
-                if (str(e).find("must_not") == -1 ):
-                    query.update({" \"must\" : "+ str(e) : "$%nothing%$" })
-                else:
-                    query.update(e)
+                self._merge_bool_clauses(query, e)
         return query
 
     def _compute_predicate(self, predicate):
@@ -1408,7 +1685,7 @@ class ElasticSearchDriver(DriverInterface):
         Compute a predicate (archetype or expression)
 
         :param predicate:
-        :return: dict with predicate translated in ES syntax
+        :return: dict with the clauses of an ES bool query
         """
         query = dict()
         if type(predicate) == Predicate:
@@ -1422,13 +1699,12 @@ class ElasticSearchDriver(DriverInterface):
                 if op and ro:
                     self.logger.debug("lo: %s - op: %s - ro: %s", lo, op, ro)
                     if op == "=":
-                        query.update({"{ \"match\" : {"+ str({lo : ro})+"}}" : "$%nothing%$" })
-#                        query[lo] = ro
+                        query['must'] = [{'match': {lo: ro}}]
             else:
                 raise PredicateException("No predicate expression found")
         elif type(predicate) == ArchetypePredicate:
             predicate_string = predicate.archetype_id
-            query.update({"{ \"filter\" : {\"exists\" : { \"field\" : "+ str(predicate_string)+"}}}" : "$%nothing%$"} )
+            query['must'] = [{'filtered': {'filter': {'exists': {'field': predicate_string}}}}]
         else:
             raise PredicateException("No predicate expression found")
         return query
@@ -1457,7 +1733,7 @@ class ElasticSearchDriver(DriverInterface):
                 else:
                     right_operand = pr.right_operand
                 if pr.left_operand == 'uid':
-                    query.update({ " \"must\" : { \"term\" : {\"patient_id\": \"" + str(right_operand).lower() +"\"}}" : "$%nothing%$"})
+                    query['must'] = [{'term': {'patient_id': str(right_operand).lower()}}]
                 elif pr.left_operand == 'id':
                     # use given EHR ID
                     query.update(self._map_operand(pr.left_operand,
@@ -1480,7 +1756,7 @@ class ElasticSearchDriver(DriverInterface):
         :param patients_collection:
         :param ehr_collection:
         :param aliases_mapping:
-        :return: location expression translated in ES syntax
+        :return: dict with the clauses of an ES bool query
         """
         query = dict()
         if location.class_expression:
@@ -1511,6 +1787,9 @@ class ElasticSearchDriver(DriverInterface):
         if path == 'uid.value':
             return {'_id': True}
 
+    def _merge_condition_expressions(self, condition_query, location_query):
+        return self._merge_bool_clauses(condition_query, location_query)
+
     def _calculate_selection_expression(self, selection, variables_map, containment_mapping):
         """
         Calculate a selection expression
@@ -1537,6 +1816,14 @@ class ElasticSearchDriver(DriverInterface):
                                                                    var.variable.path.value)
         return query, results_aliases
 
+    def _calculate_order_expression(self, order_rules, variables_map, containment_mapping):
+        return super(ElasticSearchDriver, self)._calculate_order_expression(order_rules, variables_map,
+                                                                            containment_mapping)
+
+    def _calculate_aggregation_expression(self, selection, variables_map, containment_mapping):
+        return super(ElasticSearchDriver, self)._calculate_aggregation_expression(selection, variables_map,
+                                                                                  containment_mapping)
+
     def _split_results(self, query_result):
         for key, value in query_result.iteritems():
             if isinstance(value, dict):
@@ -1552,12 +1839,13 @@ class ElasticSearchDriver(DriverInterface):
 
     def get_records_by_query(self, query, fields=None, limit=0):
         """
-        Choose which routine to get records by query
+        Choose which routine to get records by query, records are fetched from the server
+        a page at a time while they are consumed
 
         :param query:
         :param fields:
         :param limit:
-        :return:
+        :return: a generator over the records
         """
         if self.grbq == "from":
             res=self.get_records_by_query_from(query,fields,limit)
@@ -1572,10 +1860,53 @@ class ElasticSearchDriver(DriverInterface):
         res = self.client.get_source(index=self.database, id=record_id, _source_include=values_list)
         return decode_dict(res)
 
+    def _scroll_hits(self, query, fields=None, limit=0, size=None, doc_type=None):
+        """
+        Fetch the hits matching the given query one page at a time using a scroll, the scroll is
+        cleared when all hits are fetched, the limit is reached or the iteration is stopped
+
+        :param query: the query
+        :param fields: the fields to be retrieved
+        :type fields: string
+        :param limit: the max number of hits, 0 means no limit
+        :type limit: integer
+        :param size: the number of hits fetched with each round trip, if None the threshold
+                     of the driver is used
+        :type size: integer
+        :param doc_type: if not None, only hits of this doc_type are fetched
+        :return: a generator over the hits
+        """
+        size = size or self.threshold
+        if limit and limit < size:
+            size = limit
+        search_args = {'index': self.database, 'body': query, 'size': size, 'scroll': self.scrolltime}
+        if fields:
+            search_args['_source_include'] = fields
+        if doc_type:
+            search_args['doc_type'] = doc_type
+        res = self.client.search(**search_args)
+        scroll_id = res.get('_scroll_id')
+        fetched = 0
+        try:
+            while res['hits']['hits']:
+                for hit in res['hits']['hits']:
+                    yield hit
+                    fetched += 1
+                    if limit and fetched >= limit:
+                        return
+                res = self.client.scroll(scroll_id=scroll_id, scroll=self.scrolltime)
+                scroll_id = res.get('_scroll_id', scroll_id)
+        finally:
+            if scroll_id:
+                try:
+                    self.client.clear_scroll(scroll_id=scroll_id)
+                except elasticsearch.TransportError:
+                    pass
+
     def get_records_by_query_scan(self, query,fields=None,limit=0):
         """
         Retrieve all records matching the given query
-        Approach 1: using scroll for number of records greater than threshold
+        Approach 1: using a scroll, records are fetched a page at a time while they are consumed
 
         :param limit: the max number of total results to be returned
         :type limit: integer
@@ -1583,103 +1914,55 @@ class ElasticSearchDriver(DriverInterface):
         :type  fields: string
         :param query: the value that must be matched for the given field
         :type query: string
-        :return: a list of records
-        :rtype: list
+        :return: a generator over the records
         """
-        size = self.threshold
-        if limit:
-            if limit<size:
-                size=limit
-
-#        query["size"]=self.threshold
-        scrolltime=self.scrolltime
-        restot = []
-        pippo=False
-        sc_id=""
-        while not pippo:
-            if restot==[]:
-                if fields:
-                    resu = self.client.search(index=self.database,_source_include=fields,size=size,body=query,scroll=scrolltime)
-                else:
-                    resu = self.client.search(index=self.database,size=size,body=query,scroll=scrolltime)
-                if resu['hits']['hits']==[]:
-                    pippo=True
-                else:
-                    sc_id=resu["_scroll_id"]
-                    number_of_results=resu['hits']['total']
-                    restot.extend(resu['hits']['hits'])
-                    if len(resu['hits']['hits']) < size:
-                        pippo=True
-            else:
-                resuh=self.client.scroll(scroll_id=sc_id, scroll=scrolltime)['hits']
-                if resuh['hits']==[]:
-                    pippo=True
-                else:
-                    if limit and len(resuh['hits'])+len(restot) >= limit:
-                        missing=limit-len(restot)
-                        for i in range(0,missing):
-                            restot.append(resuh['hits'][i])
-                        pippo=True
-                    else:
-                        restot.extend(resuh['hits'])
-                        if len(resuh['hits']) < size:
-                            pippo=True
-        res = [p['_source'] for p in restot]
-        if res != []:
-            return ( decode_dict(res[i]) for i in range(0,len(res)) )
-        return None
+        for hit in self._scroll_hits(query, fields, limit):
+            yield decode_dict(hit['_source'])
 
     def get_records_by_query_from(self, query,fields=None,limit=0):
         """
         Retrieve all records matching the given query
-        Approach 2: using from for number of records greater than threshold
+        Approach 2: using pages of records sorted by _uid, each page starts after the last _uid of
+        the previous one (ElasticSearch 1.x has no search_after, a range filter on _uid is used instead).
+        Queries with their own sort are fetched using a scroll.
 
         :param limit: the max number of total results to be returned
         :type limit: integer
         :param fields: the fields to be retrieved
         :type  fields: string
         :param query: the value that must be matched for the given field
-        :type query: string
-        :return: a list of records
-        :rtype: list
-        """
+        :type query: string or dict
+        :return: a generator over the records
+        """
+        if isinstance(query, basestring):
+            query = json.loads(query)
+        if 'sort' in query:
+            for record in self.get_records_by_query_scan(query, fields, limit):
+                yield record
+            return
         size = self.threshold
-        if limit:
-            if limit<size:
-                size=limit
-        restot = []
+        if limit and limit < size:
+            size = limit
+        page_query = dict(query, sort=[{'_uid': {'order': 'asc'}}])
+        search_args = {'index': self.database, 'size': size}
         if fields:
-            resu = self.client.search(index=self.database,_source_include=fields,size=size,body=query)['hits']
-        else:
-            resu = self.client.search(index=self.database,size=size,body=query)['hits']
-        number_of_results=resu['total']
-        restot.extend(resu['hits'])
-        if limit:
-            nmin=min(number_of_results,limit)
-            if nmin>size:
-                for i in range(1, (nmin-1)/size+1):
-                    if fields:
-                        resu = self.client.search(index=self.database,_source_include=fields,size=size,from_=i*size,body=query)['hits']
-                    else:
-                        resu = self.client.search(index=self.database,size=size,from_=i*size,body=query)['hits']
-                    if len(restot)+len(resu['hits'])>=limit:
-                        missing=limit-len(restot)
-                        for i in range(0,missing):
-                            restot.append(resu['hits'][i])
-                    else:
-                        restot.extend(resu['hits'])
-        else:
-            if number_of_results > size:
-                for i in range(1, (number_of_results-1)/size+1):
-                    if fields:
-                        resu = self.client.search(index=self.database,_source_include=fields,size=size,from_=i*size,body=query)['hits']
-                    else:
-                        resu = self.client.search(index=self.database,size=size,from_=i*size,body=query)['hits']
-                    restot.extend(resu['hits'])
-        res = [p['_source'] for p in restot]
-        if res != []:
-            return ( decode_dict(res[i]) for i in range(0,len(res)) )
-        return None
+            search_args['_source_include'] = fields
+        fetched = 0
+        while True:
+            hits = self.client.search(body=page_query, **search_args)['hits']['hits']
+            for hit in hits:
+                yield decode_dict(hit['_source'])
+                fetched += 1
+                if limit and fetched >= limit:
+                    return
+            if len(hits) < size:
+                return
+            page_query['query'] = {
+                'filtered': {
+                    'query': query.get('query', {'match_all': {}}),
+                    'filter': {'range': {'_uid': {'gt': hits[-1]['sort'][0]}}}
+                }
+            }
 
     def count_records_by_query(self, query):
         """
@@ -1692,7 +1975,29 @@ class ElasticSearchDriver(DriverInterface):
         return self.client.search(index=self.database,body=query,search_type='count')['hits']['total']
 
 #    @profile
-    def _run_aql_query(self, query, fields, aliases, collection):
+    def _add_sort(self, query, order_by):
+        """
+        Add the sort clause built from the ORDER BY expression to a query, missing values
+        come first for ascending sorts and last for descending ones like in the merge of sorted results
+
+        :param query: the query in ES syntax
+        :type query: dict
+        :param order_by: the ORDER BY expression built by the :meth:`_calculate_order_expression` method
+        :return: the sorted query
+        """
+        sort = list()
+        for field, _, direction in order_by or []:
+            if field is None:
+                continue
+            if direction == 'DESC':
+                sort.append({field: {'order': 'desc', 'missing': '_last'}})
+            else:
+                sort.append({field: {'order': 'asc', 'missing': '_first'}})
+        if sort:
+            query = dict(query, sort=sort)
+        return query
+
+    def _run_aql_query(self, query, fields, aliases, collection, limit=0, order_by=None):
         """
         Run the AQL query
 
@@ -1700,8 +2005,11 @@ class ElasticSearchDriver(DriverInterface):
         :param fields:
         :param aliases:
         :param collection:
+        :param limit: the max number of records, 0 means no limit
+        :param order_by: the ORDER BY expression used to sort the records, if any
         :return: records matching the query given
         """
+        query = self._add_sort(query, order_by)
         self.logger.debug("Running query\n%s\nwith filters\n%s", query, fields)
         rs = ResultSet()
         for path, alias in aliases.iteritems():
@@ -1715,21 +2023,182 @@ class ElasticSearchDriver(DriverInterface):
         self.connect()
         self.select_collection(collection)
         selected_fields=self._collate_selected_fields(fields)
-#        query_results = self.get_records_by_query(query)
-        query_results = self.get_records_by_query(query,selected_fields)
-        if close_conn_after_done:
-            self.disconnect()
-        else:
-            self.select_collection(original_collection)
-        if query_results:
-            for q in query_results:
-                record = dict()
-                for x in self._split_results(q):
-                    record[x[0]] = x[1]
-                rr = ResultRow(record)
-                rs.add_row(rr)
+        try:
+            # records are fetched while they are consumed, the connection must be open
+            for q in self.get_records_by_query(query,selected_fields,limit):
+                rs.add_record(dict(self._split_results(q)))
+        finally:
+            if close_conn_after_done:
+                self.disconnect()
+            else:
+                self.select_collection(original_collection)
         return rs
 
+    def _iter_aql_query(self, query, fields, limit=0, batch_size=None, order_by=None):
+        """
+        Lazily fetch the records matching the AQL query using a scroll, the scroll is cleared
+        when all records are fetched or the iteration is stopped
+
+        :param query:
+        :param fields:
+        :param limit: the max number of records, 0 means no limit
+        :param batch_size: the number of records fetched with each round trip, if None the
+                           threshold of the driver is used
+        :param order_by: the ORDER BY expression used to sort the records, if any
+        :return: a generator over the records, split into path/value maps
+        """
+        query = self._add_sort(query, order_by)
+        self.logger.debug("Streaming query\n%s\nwith filters\n%s", query, fields)
+        self.__check_connection()
+        selected_fields = self._collate_selected_fields(fields)
+        for hit in self._scroll_hits(query, selected_fields, limit, batch_size):
+            yield dict(self._split_results(decode_dict(hit['_source'])))
+
+    def _stream_aql_queries(self, total_queries, ehr_repository, limit, batch_size):
+        """
+        Chain the records returned by the given queries, the connection is kept open until
+        all records are fetched
+
+        :param total_queries:
+        :param ehr_repository:
+        :param limit: the max number of records returned by all queries, 0 means no limit
+        :param batch_size:
+        :return: a generator over the records
+        """
+        if self.is_connected:
+            original_collection = self.collection
+            close_conn_after_done = False
+        else:
+            close_conn_after_done = True
+        self.connect()
+        self.select_collection(ehr_repository)
+        try:
+            if len(total_queries) > 1 and 'order_by' in total_queries[0]:
+                streams = [(self._iter_aql_query(q['condition'], q['selection'], limit, batch_size,
+                                                 q['order_by']), q['order_by']) for q in total_queries]
+                for record in islice(self._merge_sorted_records(streams), limit or None):
+                    yield record
+            else:
+                fetched = 0
+                for query in total_queries:
+                    query_limit = limit - fetched if limit else 0
+                    for record in self._iter_aql_query(query['condition'], query['selection'],
+                                                       query_limit, batch_size, query.get('order_by')):
+                        yield record
+                        fetched += 1
+                    if limit and fetched >= limit:
+                        break
+        finally:
+            if close_conn_after_done:
+                self.disconnect()
+            else:
+                self.select_collection(original_collection)
+
+    def _build_aggregations(self, aggregation):
+        """
+        Translate the description of an aggregated query into ES aggregations, a terms aggregation
+        is nested for each GROUP BY field and metrics are computed within the innermost buckets
+
+        :param aggregation: the aggregation built by the :meth:`_calculate_aggregation_expression` method
+        :return: the aggregations in ES syntax
+        :rtype: dict
+        """
+        aggs = dict()
+        for i, (alias, function, field) in enumerate(aggregation['functions']):
+            key = 'a%d' % i
+            if field is None:
+                # COUNT(*) is the doc_count of the bucket
+                continue
+            if function == 'COUNT':
+                aggs[key] = {'value_count': {'field': field}}
+            elif function == 'AVG':
+                aggs[key] = {'sum': {'field': field}}
+                aggs['%s_count' % key] = {'value_count': {'field': field}}
+            else:
+                aggs[key] = {function.lower(): {'field': field}}
+        for i in reversed(xrange(len(aggregation['group_by']))):
+            # size 0 returns all the terms
+            terms = {'terms': {'field': aggregation['group_by'][i][1], 'size': 0}}
+            if aggs:
+                terms['aggs'] = aggs
+            aggs = {'g%d' % i: terms}
+        return aggs
+
+    def _decode_aggregations(self, aggregations, aggregation, doc_count, group_values=()):
+        """
+        Walk the buckets returned by ES and yield a partial result for each group
+
+        :param aggregations: the aggregations returned by ES
+        :param aggregation: the aggregation built by the :meth:`_calculate_aggregation_expression` method
+        :param doc_count: the number of documents within the current bucket
+        :param group_values: the values of the GROUP BY fields of the current bucket
+        :return: a generator of (group values, partial values) pairs
+        """
+        level = len(group_values)
+        if level < len(aggregation['group_by']):
+            for bucket in aggregations['g%d' % level]['buckets']:
+                key = bucket['key']
+                if isinstance(key, unicode):
+                    key = key.encode('utf-8')
+                for r in self._decode_aggregations(bucket, aggregation, bucket['doc_count'],
+                                                   group_values + (key,)):
+                    yield r
+        else:
+            values = dict()
+            for i, (alias, function, field) in enumerate(aggregation['functions']):
+                key = 'a%d' % i
+                if field is None:
+                    values[alias] = doc_count
+                elif function == 'AVG':
+                    values[alias] = [aggregations[key]['value'], aggregations['%s_count' % key]['value']]
+                else:
+                    values[alias] = aggregations[key]['value']
+            yield group_values, values
+
+    def _run_aql_aggregation(self, query, aggregation):
+        """
+        Run an aggregated AQL query, only the aggregated values are returned by ES
+
+        :param query: the query in ES syntax
+        :param aggregation: the aggregation built by the :meth:`_calculate_aggregation_expression` method
+        :return: a list of partial results
+        """
+        aggs = self._build_aggregations(aggregation)
+        body = query
+        if aggs:
+            body = dict(query, aggs=aggs)
+        self.logger.debug("Running aggregation query\n%s", body)
+        res = self.client.search(index=self.database, body=body, search_type='count')
+        return list(self._decode_aggregations(res.get('aggregations', {}), aggregation, res['hits']['total']))
+
+    def _aggregated_queries(self, total_queries, ehr_repository, limit=0):
+        """
+        Run aggregated queries and merge their results
+
+        :param total_queries:
+        :param ehr_repository:
+        :param limit: the max number of results, 0 means no limit
+        :return: a ResultSet with a row for each group
+        """
+        if self.is_connected:
+            original_collection = self.collection
+            close_conn_after_done = False
+        else:
+            close_conn_after_done = True
+        self.connect()
+        self.select_collection(ehr_repository)
+        partial_results = []
+        try:
+            for query in total_queries:
+                partial_results.extend(self._run_aql_aggregation(query['condition'], query['aggregation']))
+        finally:
+            if close_conn_after_done:
+                self.disconnect()
+            else:
+                self.select_collection(original_collection)
+        return self._merge_aggregation_results(total_queries[0]['aggregation'], partial_results, limit,
+                                               total_queries[0].get('order_by'))
+
     def _run_aql_count(self, query, collection):
         """
         Run the AQL count query
@@ -1766,9 +2235,10 @@ class ElasticSearchDriver(DriverInterface):
                 lfields.append(sf)
         return ",".join(lfields)
 
-    def build_queries(self, query_model, patients_repository, ehr_repository, query_params=None):
+    def build_queries(self, query_model, patients_repository, ehr_repository, query_params=None,
+                      structures_mapping=None):
         return super(ElasticSearchDriver, self).build_queries(query_model, patients_repository, ehr_repository,
-                                                      query_params)
+                                                      query_params, structures_mapping)
 
     def _get_query_hash(self, query):
         return super(ElasticSearchDriver, self)._get_query_hash(query)
@@ -1784,12 +2254,12 @@ class ElasticSearchDriver(DriverInterface):
         Return the structure selector in ES syntax
 
         :param structure_ids:
-        :return:dict with structures selector
+        :return: the structures filter in ES syntax
         """
         if len(structure_ids) == 1:
-            return {"\"must\" : {\"term\" : {\"ehr_structure_id\" : \""+str(structure_ids[0])+"\"} }": "$%nothing%$"}
+            return {'term': {'ehr_structure_id': structure_ids[0]}}
         else:
-            return {"\"must\" : {\"terms\" : {\"ehr_structure_id\" : "+str([structure_ids])+",\"execution\" : \"or\" } }" : "$%nothing%$"}
+            return {'terms': {'ehr_structure_id': structure_ids, 'execution': 'or'}}
 
     def _aggregate_queries(self, queries):
         """
@@ -1802,72 +2272,151 @@ class ElasticSearchDriver(DriverInterface):
         queries_hash_map = self._get_queries_hash_map(queries)
         structures_hash_map = self._get_structures_hash_map(queries)
         for qhash, structures in structures_hash_map.iteritems():
-            ql=[]
             query = queries_hash_map[qhash]
-            q1=self._clean_piece(query['condition'])
-            ql.append(" \"query\" : { \"bool\" : "+str(q1)+"}")
-            q2=self._clean_piece(self._get_structures_selector(structures))
-            ql.append(" \"filter\" : { \"bool\" : "+str(q2)+"}")
-            qs=",".join(ql)
-            qtot=" \"query\" : { \"filtered\" : {"+qs + "}}"
-            qtot={ qtot : "$%nothing%$"}
-            query['condition']=qtot
+            query['condition'] = {
+                'query': {
+                    'filtered': {
+                        'query': {'bool': query['condition']},
+                        'filter': self._get_structures_selector(structures)
+                    }
+                }
+            }
             aggregated_queries.append(query)
         return aggregated_queries
 
-    def execute_query(self, query_model, patients_repository, ehr_repository,
-                      query_params=None, count_only=False, query_processes=1):
+    def compile_query(self, query_model, patients_repository, ehr_repository, query_params=None,
+                      structures_mapping=None):
         """
-        Execute a query parsed with the :class:`pyehr.aql.parser.Parser` object and expressed
-        as a :class:`pyehr.aql.model.QueryModel`. If the query is a parametric one, query parameters
-        must be passed using the query_params dictionary.
+        Translate a query parsed with the :class:`pyehr.aql.parser.Parser` object into a list of
+        ES queries that can be executed with the :meth:`run_compiled_query` method.
 
         :param query_model: the :class:`pyehr.aql.parser.QueryModel` obtained when the query
                             is parsed
         :type: :class:`pyehr.aql.parser.QueryModel`
         :param query_params: a dictionary containing query's parameters and their values
         :type: dictionary
-        :return: a :class:`pyehr.ehr.services.dbmanager.querymanager.query.ResultSet` object
-                 containing results for the given query
+        :param structures_mapping: the structures and aliases maps returned by the
+                                   :meth:`IndexService.map_aql_contains` method
+        :type structures_mapping: tuple
+        :return: a list of ES queries
         """
         queries = self.build_queries(query_model, patients_repository, ehr_repository,
-                                     query_params)
+                                     query_params, structures_mapping)
         aggregated_queries = self._aggregate_queries(queries)
         total_queries=[]
         for query in aggregated_queries:
             single_query={}
-            query_string=self._clean_piece(query['condition'])
-            query_string=self._final_check(query_string)
-            single_query.update({'condition':query_string})
+            single_query.update({'condition':query['condition']})
             single_query.update({'selection':query['selection']})
             single_query.update({'aliases':query['aliases']})
+            for key in ('aggregation', 'order_by'):
+                if key in query:
+                    single_query.update({key:query[key]})
             total_queries.append(single_query)
+        return total_queries
+
+    def run_compiled_query(self, queries, ehr_repository, count_only=False, query_processes=1,
+                           limit=0, executor=None):
+        """
+        Execute a list of queries built with the :meth:`compile_query` method
+
+        :param limit: the maximum number of results, 0 means that all results will be fetched
+        :type limit: int
+        :param executor: the pool used to run queries when *query_processes* is greater than 1,
+                         if None a new pool of processes is created
+        :type executor: :class:`multiprocessing.pool.Pool`
+        :return: a :class:`pyehr.ehr.services.dbmanager.querymanager.query.ResultSet` object
+                 containing results for the given queries or the number of matching records
+                 if count_only is True
+        """
         if count_only:
-            return self._count_only_queries(total_queries,ehr_repository)
+            return self._count_only_queries(queries,ehr_repository)
+        elif queries and 'aggregation' in queries[0]:
+            return self._aggregated_queries(queries,ehr_repository,limit)
         else:
-            return self._regular_queries(total_queries,ehr_repository,query_processes)
+            return self._regular_queries(queries,ehr_repository,query_processes,limit,executor)
 
-    def _regular_queries(self,total_queries,ehr_repository,query_processes):
+    def stream_compiled_query(self, queries, ehr_repository, limit=0, batch_size=None):
+        """
+        Execute a list of queries built with the :meth:`compile_query` method fetching results
+        with a scroll only when they are consumed
+
+        :param limit: the maximum number of results, 0 means that all results will be fetched
+        :type limit: int
+        :param batch_size: the number of records retrieved with each round trip to the server,
+                           if None the threshold of the driver is used
+        :type batch_size: int
+        :return: a :class:`pyehr.ehr.services.dbmanager.querymanager.results_wrappers.StreamingResultSet`
+        """
+        aliases = dict()
+        for query in queries:
+            aliases.update(query['aliases'])
+        return StreamingResultSet(self._stream_aql_queries(queries, ehr_repository, limit, batch_size),
+                                  aliases)
+
+    def execute_query(self, query_model, patients_repository, ehr_repository,
+                      query_params=None, count_only=False, query_processes=1):
+        """
+        Execute a query parsed with the :class:`pyehr.aql.parser.Parser` object and expressed
+        as a :class:`pyehr.aql.model.QueryModel`. If the query is a parametric one, query parameters
+        must be passed using the query_params dictionary.
+
+        :param query_model: the :class:`pyehr.aql.parser.QueryModel` obtained when the query
+                            is parsed
+        :type: :class:`pyehr.aql.parser.QueryModel`
+        :param query_params: a dictionary containing query's parameters and their values
+        :type: dictionary
+        :return: a :class:`pyehr.ehr.services.dbmanager.querymanager.query.ResultSet` object
+                 containing results for the given query
+        """
+        total_queries = self.compile_query(query_model, patients_repository, ehr_repository,
+                                           query_params)
+        return self.run_compiled_query(total_queries, ehr_repository, count_only, query_processes,
+                                       max(query_model.selection.top, 0))
+
+    def _regular_queries(self,total_queries,ehr_repository,query_processes,limit=0,executor=None):
         """
         Call the routines to perform a single processor or multiprocessor query
 
         :param total_queries:
         :param ehr_repository:
         :param query_processes:
+        :param limit: the max number of results, 0 means no limit
+        :param executor: the pool used to run the queries, if None a new pool of processes is created
         :return:
         """
+        # sorted results of more queries are merged, each query must fetch up to limit results
+        ordered = len(total_queries) > 1 and 'order_by' in total_queries[0]
         total_results = ResultSet()
+        sorted_results = []
         if query_processes == 1 or len(total_queries) == 1:
             for i in range(0,len(total_queries)):
+                query_limit = limit - total_results.total_results if limit and not ordered else limit
                 results = self._run_aql_query(total_queries[i]['condition'], fields=total_queries[i]['selection'],
-                                          aliases=total_queries[i]['aliases'], collection=ehr_repository)
+                                          aliases=total_queries[i]['aliases'], collection=ehr_repository,
+                                          limit=query_limit, order_by=total_queries[i].get('order_by'))
+                if ordered:
+                    sorted_results.append(results)
+                    continue
                 total_results.extend(results)
+                if limit and total_results.total_results >= limit:
+                    break
         else:
-            queries_pool = Pool(query_processes)
-            results = queries_pool.imap_unordered( MultiprocessQueryRunner(self.host, self.database,
-                                                    ehr_repository, self.port, self.user,self.passwd),total_queries)
-            for r in results:
-                total_results.extend(r)
+            if limit:
+                total_queries = [dict(q, limit=limit) for q in total_queries]
+            runner = MultiprocessQueryRunner(self.host, self.database, ehr_repository,
+                                             self.port, self.user, self.passwd)
+            results = self._map_queries(runner, total_queries, query_processes, executor, ordered)
+            if ordered:
+                sorted_results = list(results)
+            else:
+                for r in results:
+                    total_results.extend(r)
+                if limit:
+                    total_results.truncate(limit)
+        if ordered:
+            total_results = self._merge_sorted_result_sets(zip(sorted_results,
+                                                               [q['order_by'] for q in total_queries]), limit)
         return total_results
 
     def _count_only_queries(self,total_queries,ehr_repository):
@@ -1883,189 +2432,6 @@ class ElasticSearchDriver(DriverInterface):
             cresult = self._run_aql_count(total_queries[i]['condition'], collection=ehr_repository)
             count=count+cresult
         return count
-#    @profile
-    def _final_check(self,qtot):
-        """
-        Final check on parentheses
-
-        :param qtot:
-        :return:
-        """
-        ql=list(qtot)
-        ob=0
-        oq=0
-        for i in ql:
-            if i=="{":
-                ob=ob+1
-            elif i=="}":
-                ob=ob-1
-            elif i=="[":
-                oq=oq+1
-            elif i=="]":
-                oq=oq-1
-        if ob != 0:
-            if ob>0:
-                for i in range(ob):
-                    ql.append("}")
-            else:
-                for i in range(ob):
-                    ql.pop(len(ql) - 1 - ql[::-1].index("}"))
-        if oq !=0:
-            if oq>0:
-                for i in range(oq):
-                    ql.append("]")
-            else:
-                for i in range(oq):
-                    ql.pop(len(ql) - 1 - ql[::-1].index("]"))
-        qtot="".join(ql)
-        return qtot
-
-    def _clean_piece(self,piece):
-        """
-        clean a piece of expression from artifacts used to build it
-
-        :param piece:
-        :return:
-        """
-        def cleanp(p):
-            newp = str(p)
-            newpr=newp[::-1]
-            #clean p from nothing
-            posnothing=[]
-            poscolon=[]
-            posparleft=[]
-            posparright=[]
-            starts=0
-            ends = len(newp)
-            while starts < ends:
-                #find position of string nothing
-                positionn = newp.find("$%nothing%$",starts,ends)
-                if (positionn == -1):
-                    starts=ends
-                else:
-                    starts=positionn+1
-                    posnothing.append(positionn)
-                    #find position of left colon
-                    positionc=newpr.find(":",len(newpr)-positionn,len(newpr))
-                    if( positionc == -1):
-                        print "not found colon for a given nothing :D"
-                        print "bad piece to cleanup: %s" % newp
-                        raise QueryCreationException()
-                    else:
-                        positionc=len(newpr)-positionc-1
-                        poscolon.append(positionc)
-                    #find position of first right parenthesis
-                    position=newp.find("}",positionn+10,len(newp))
-                    position2=newp.find("]",positionn+10,len(newp))
-                    isbrace=True
-                    if( position==-1 and position2==-1):
-                        print "not found parenthesis for a given nothing :D"
-                        print "bad piece to cleanup: %s" % newp
-                        raise QueryCreationException()
-                    else:
-                        if(position2 != -1):
-                            if(position == -1):
-                                posparright.append(position2)
-                                isbrace=False
-                            if(position < position2):
-                                posparright.append(position)
-                            else:
-                                posparright.append(position2)
-                                isbrace=False
-                        else:
-                            posparright.append(position)
-                    #find position of corresponding left parenthesis
-                    br=0
-                    sq=0
-                    for g,h in enumerate(newpr[(len(newpr)-positionc):len(newpr)]):
-                        if h == "{":
-                            if isbrace and br==0:
-                                posparleft.append(positionc-g-1)
-                                break
-                            else:
-                                br=br-1
-                        elif h == "[":
-                            if not isbrace and sq==0:
-                                posparleft.append(positionc-g-1)
-                                break
-                            else:
-                                sq=sq-1
-                        elif h== "}":
-                            br=br+1
-                        elif h=="]":
-                            sq=sq+1
-            newpl = list(newp)
-            for i in posparleft:
-                newpl[i]=""
-                newpl[i+1]=""
-            for i in range(len(poscolon)):
-                for j in range(poscolon[i]-1,posparright[i]+1):
-                    newpl[j]=""
-            #clean p from extra braces
-            #clean p from extra squares
-            br=0
-            sq=0
-            istart=[]
-            iend=[]
-            cursor=-1
-            for i in range(len(newpl)-1):
-                if newpl[i]==newpl[i+1]:
-                    if(newpl[i]=="{"):
-                        br=2
-                        istart.append(i)
-                        cursor=len(istart)-1
-                    elif(newpl[i]=="}"):
-                        if(br==2):
-                            iend.append(i)
-                            cursor=-1
-                        else:
-                            br=0
-                            if(cursor>-1):
-                                istart.pop()
-                    elif(newpl[i]=="["):
-                        sq=1
-                        istart.append(i)
-                        cursor=len(istart)-1
-                    elif(newpl[i]=="]"):
-                        if(sq==1):
-                            iend.append(i)
-                            cursor=-1
-                        else:
-                            sq=0
-                            if(cursor>-1):
-                                istart.pop()
-                elif newpl[i]=="{":
-                    if (i-1) in istart:
-                        pass
-                    else:
-                        br=0
-                elif newpl[i]== "[":
-                    if (i-1) in istart:
-                        pass
-                    else:
-                        sq=0
-            for i in range(len(istart)):
-                newpl[istart[i]]=""
-                newpl[iend[i]]=""
-            #change all single quotation marks to double
-            for i in range(len(newpl)-1):
-                if newpl[i]=="\\" and newpl[i+1]=="'":
-                    newpl[i]=""
-                    newpl[i+1]='"'
-                elif newpl[i]=="\\" and newpl[i+1]=="\"":
-                    newpl[i]=""
-                elif newpl[i] == "'":
-                    newpl[i]='"'
-                elif newpl[i+1]=="'":
-                    newpl[i+1]='"'
-            newpn = "".join(newpl)
-            return newpn
-        newpiece="{"
-        for p in piece:
-            newpiece=newpiece+cleanp(p)+","
-        newpiece=newpiece.strip(",")+"}"
-        return newpiece
-
     def get_selection_hash(self,selection):
         """
         get hash for selection
@@ -1,7 +1,34 @@
 from abc import ABCMeta, abstractmethod
 from pyehr.ehr.services.dbmanager.errors import *
-import re, json
+import re, json, heapq
 from hashlib import md5
+from itertools import izip, islice
+from multiprocessing import Pool
+
+
+class OrderKey(object):
+    """
+    Sort key for records sorted by one or more fields, each field can be sorted in ascending
+    or descending order
+    """
+
+    __slots__ = ('values', 'descending')
+
+    def __init__(self, values, descending):
+        self.values = values
+        self.descending = descending
+
+    def __eq__(self, other):
+        return self.values == other.values
+
+    def __ne__(self, other):
+        return self.values != other.values
+
+    def __lt__(self, other):
+        for v1, v2, desc in izip(self.values, other.values, self.descending):
+            if v1 != v2:
+                return v1 > v2 if desc else v1 < v2
+        return False
 
 
 class DriverInterface(object):
@@ -11,6 +38,12 @@ class DriverInterface(object):
     """
     __metaclass__ = ABCMeta
 
+    # the operations that can be applied by a versioned update
+    UPDATE_TYPES = ('set', 'add', 'extend', 'remove')
+    # the metadata of clinical records checked, together with the content hash, when swapping
+    # records: an update that only changes them is not redundant
+    SWAP_CHECKED_FIELDS = ('patient_id', 'active', 'creation_time')
+
     def __enter__(self):
         self.connect()
         return self
@@ -80,6 +113,12 @@ class DriverInterface(object):
                     raise dke
         return saved, errors
 
+    def _get_batch_key(self, uid):
+        # IDs of records' revisions are dictionaries
+        if isinstance(uid, dict):
+            return tuple(sorted(uid.iteritems()))
+        return uid
+
     def _check_batch(self, records_batch, uid_field):
         """
         Check records batch for duplicated
@@ -87,7 +126,7 @@ class DriverInterface(object):
         from collections import Counter
         duplicated_counter = Counter()
         for r in records_batch:
-            duplicated_counter[r[uid_field]] += 1
+            duplicated_counter[self._get_batch_key(r[uid_field])] += 1
         if len(duplicated_counter) < len(records_batch):
             raise DuplicatedKeyError('The following IDs have one or more duplicated in this batch: %s' %
                                      [k for k, v in duplicated_counter.iteritems() if v > 1])
@@ -99,6 +138,14 @@ class DriverInterface(object):
         """
         pass
 
+    @abstractmethod
+    def get_records_by_ids(self, records_id, fields=None, active_only=False):
+        """
+        Retrieve all the records whose ID is in *records_id* using a single query, if
+        *active_only* is True records with the active flag set to False are skipped
+        """
+        pass
+
     @abstractmethod
     def get_record_by_version(self, record_id, version):
         """
@@ -127,6 +174,15 @@ class DriverInterface(object):
         """
         pass
 
+    @abstractmethod
+    def iter_records(self, filters=None, batch_size=1000, after_id=None):
+        """
+        Iterate over all records of the current collection matching the *filters* map ordered
+        by ID, records are fetched from the backend server *batch_size* at a time and, if
+        *after_id* is given, only records with an ID greater than *after_id* are returned
+        """
+        pass
+
     @abstractmethod
     def get_records_by_query(self, selector, fields, limit):
         """
@@ -170,6 +226,12 @@ class DriverInterface(object):
         """
         pass
 
+    def delete_versions_by_ids(self, records_id):
+        """
+        Delete all versions of the records with the given IDs
+        """
+        return sum(self.delete_later_versions(rid) for rid in records_id)
+
     @abstractmethod
     def delete_records_by_query(self, query):
         """
@@ -186,6 +248,24 @@ class DriverInterface(object):
         """
         pass
 
+    def versioned_update_records(self, records_versions, field_label, field_value,
+                                 update_timestamp_label=None):
+        """
+        Set the field with label *field_label* of the records in *records_versions*, a map of
+        records' IDs and their expected versions, to *field_value* and increase their version.
+        As for :meth:`versioned_update`, a record is updated only if its saved version matches.
+        Return the IDs of the updated records and the timestamp of the last update.
+        """
+        updated_ids = list()
+        last_update = None
+        for rid, version in records_versions.iteritems():
+            previous_record, update_timestamp = self.versioned_update(rid, version, field_label, 'set',
+                                                                      field_value, update_timestamp_label)
+            if previous_record is not None:
+                updated_ids.append(rid)
+                last_update = update_timestamp
+        return updated_ids, last_update
+
     @abstractmethod
     def replace_record(self, record_id, new_record, update_timestamp_label=None):
         """
@@ -193,6 +273,59 @@ class DriverInterface(object):
         """
         pass
 
+    @abstractmethod
+    def swap_record(self, record_id, new_record, version, update_timestamp_label=None):
+        """
+        Replace record with *record_id* with the given *new_record* only if the saved record's
+        version is *version* and its content hash or metadata (see SWAP_CHECKED_FIELDS) differ
+        from the ones of *new_record*.
+        Return the replaced record (or None if the record was not replaced) and the timestamp
+        of the last update.
+        """
+        pass
+
+    @abstractmethod
+    def versioned_update(self, record_id, version, field_label, update_type, value,
+                         update_timestamp_label=None):
+        """
+        Apply to the field with label *field_label* of the record with ID *record_id* one of the
+        operations in UPDATE_TYPES ('set' the field, 'add' an item to a list, 'extend' a list
+        with a list of items or 'remove' one or more items from a list) and increase the version
+        of the record, only if the saved record's version is *version*. A 'set' is not applied
+        if the field already has the given value.
+        Return the record as it was before the update (or None if the record was not updated)
+        and the timestamp of the last update.
+        """
+        pass
+
+    def _check_update_type(self, update_type):
+        if update_type not in self.UPDATE_TYPES:
+            raise ValueError('Unsupported update type %s, allowed values are %s' %
+                             (update_type, ', '.join(self.UPDATE_TYPES)))
+
+    def _is_redundant_swap(self, saved_record, new_record):
+        """
+        Check if *new_record* would replace *saved_record* without changing it: clinical data are
+        compared using their content hash and metadata fields (see SWAP_CHECKED_FIELDS) are
+        compared by value
+        """
+        return saved_record.get('content_hash') == new_record.get('content_hash') and \
+            all(saved_record.get(f) == new_record.get(f) for f in self.SWAP_CHECKED_FIELDS)
+
+    def _get_content_hash(self, ehr_data):
+        """
+        Get the hash of the clinical data of a record, it is saved with the record in order to
+        detect redundant updates without reading the record back. The hash is computed on the
+        canonical encoding produced by the standard json module, so that it doesn't depend on
+        the JSON library used by the drivers
+
+        :param ehr_data: the clinical data of the record, as they are saved on the backend
+        :type ehr_data: dict
+        :return: the hash of the clinical data
+        :rtype: str
+        """
+        return md5(json.dumps(ehr_data, sort_keys=True, separators=(',', ':'))).hexdigest()
+
     @abstractmethod
     def add_to_list(self, record_id, list_label, item_value, update_timestamp_label,
                     increase_version):
@@ -307,24 +440,187 @@ class DriverInterface(object):
     def _calculate_selection_expression(self, selection, aliases, containment_mapping):
         pass
 
+    def _get_variable_field(self, variable, variables_map, paths):
+        """
+        Return the record field that maps the given :class:`pyehr.aql.model.IdentifiedPath`
+        """
+        path = self._normalize_path(variable.path.value)
+        if variable.variable == variables_map['EHR']:
+            return self._map_ehr_selection(path, variables_map['EHR']).keys()[0]
+        return '%s.%s' % (paths[variables_map[variable.variable]], path)
+
+    @abstractmethod
+    def _calculate_order_expression(self, order_rules, variables_map, containment_mapping):
+        """
+        Map the ORDER BY rules of a query to a list of [field, alias, direction] triples, field is None
+        for aggregate functions, aggregated results are sorted using the aliases
+        """
+        paths = self._build_paths(containment_mapping)
+        order_by = list()
+        for rule in order_rules.rules:
+            var = rule.variable
+            if var.variable is None:
+                order_by.append([None, var.label, rule.direction])
+                continue
+            label = var.label or '%s%s' % (var.variable.variable, var.variable.path.value)
+            field = None if var.function else self._get_variable_field(var.variable, variables_map, paths)
+            order_by.append([field, label, rule.direction])
+        return order_by
+
+    def _merge_sorted_records(self, records_streams):
+        """
+        Merge records coming from more queries into a single sorted stream. *records_streams* is a list of
+        (records, order_by) pairs, records of each stream must be sorted according to its order_by rules,
+        fields can be different among streams but rules must map the same aliases in the same order
+        """
+        def decorate(records, order_by, stream_index):
+            fields = [field for field, _, _ in order_by]
+            descending = [direction == 'DESC' for _, _, direction in order_by]
+            for r in records:
+                yield OrderKey([r.get(f) for f in fields], descending), stream_index, r
+
+        decorated_streams = [decorate(records, order_by, i) for i, (records, order_by) in enumerate(records_streams)]
+        for _, _, record in heapq.merge(*decorated_streams):
+            yield record
+
+    def _merge_sorted_result_sets(self, result_sets, limit=0):
+        """
+        Merge sorted :class:`pyehr.ehr.services.dbmanager.querymanager.results_wrappers.ResultSet` objects,
+        *result_sets* is a list of (result_set, order_by) pairs
+        """
+        from pyehr.ehr.services.dbmanager.querymanager.results_wrappers import ResultSet
+
+        total_results = ResultSet()
+        for rs, _ in result_sets:
+            for c in rs.columns:
+                total_results.add_column_definition(c)
+        records = self._merge_sorted_records([(rs.records, order_by) for rs, order_by in result_sets])
+        for r in islice(records, limit or None):
+            total_results.add_record(r)
+        return total_results
+
+    @abstractmethod
+    def _calculate_aggregation_expression(self, selection, variables_map, containment_mapping):
+        """
+        Map the variables of an aggregated selection to record fields. Return the selection expression,
+        the description of the aggregation, as a dictionary with the *group_by* list of [alias, field] pairs
+        and the *functions* list of [alias, function, field] triples (field is None for a COUNT(*)), and
+        the aliases of the results.
+        """
+        selection_query = {'_id': False}
+        paths = self._build_paths(containment_mapping)
+        aggregation = {'group_by': list(), 'functions': list()}
+        results_aliases = dict()
+        for var in selection.variables:
+            if var.variable is None:
+                aggregation['functions'].append([var.label, var.function, None])
+                results_aliases[var.label] = var.label
+                continue
+            var_path = self._get_variable_field(var.variable, variables_map, paths)
+            selection_query[var_path] = True
+            label = var.label or '%s%s' % (var.variable.variable, var.variable.path.value)
+            if var.function:
+                aggregation['functions'].append([label, var.function, var_path])
+            else:
+                aggregation['group_by'].append([label, var_path])
+            # aggregated results are already labeled using the aliases
+            results_aliases[label] = label
+        return selection_query, aggregation, results_aliases
+
+    def _merge_aggregation_results(self, aggregation, partial_results, limit=0, order_by=None):
+        """
+        Merge partial results of an aggregated query obtained from one or more queries into a
+        :class:`pyehr.ehr.services.dbmanager.querymanager.results_wrappers.ResultSet`. Each partial result
+        is a pair with the tuple of the values of the GROUP BY fields and a dictionary that maps the alias
+        of each function to its partial value, AVG partial values are [sum, count] pairs. Results are
+        sorted by the aliases in the *order_by* rules.
+        """
+        from pyehr.ehr.services.dbmanager.querymanager.results_wrappers import ResultSet, ResultColumnDef
+
+        def merge(function, value_1, value_2):
+            if value_1 is None:
+                return value_2
+            if value_2 is None:
+                return value_1
+            if function in ('COUNT', 'SUM'):
+                return value_1 + value_2
+            if function == 'AVG':
+                return [value_1[0] + value_2[0], value_1[1] + value_2[1]]
+            if function == 'MIN':
+                return min(value_1, value_2)
+            return max(value_1, value_2)
+
+        groups = dict()
+        for group_values, values in partial_results:
+            group = groups.setdefault(group_values, dict())
+            for alias, function, _ in aggregation['functions']:
+                group[alias] = merge(function, group.get(alias), values.get(alias))
+        if not groups and not aggregation['group_by']:
+            # an aggregation without GROUP BY fields always returns a single row
+            groups[()] = dict()
+        results = ResultSet()
+        for alias, _ in aggregation['group_by']:
+            results.add_column_definition(ResultColumnDef(alias, alias))
+        for alias, _, _ in aggregation['functions']:
+            results.add_column_definition(ResultColumnDef(alias, alias))
+        records = list()
+        for group_values, values in groups.iteritems():
+            record = dict(izip([alias for alias, _ in aggregation['group_by']], group_values))
+            for alias, function, _ in aggregation['functions']:
+                value = values.get(alias)
+                if function == 'AVG':
+                    value = float(value[0]) / value[1] if value and value[1] else None
+                elif function == 'COUNT':
+                    value = value or 0
+                record[alias] = value
+            records.append(record)
+        if order_by:
+            descending = [direction == 'DESC' for _, _, direction in order_by]
+            records.sort(key=lambda r: OrderKey([r.get(alias) for _, alias, _ in order_by], descending))
+        for r in islice(records, limit or None):
+            results.add_record(r)
+        return results
+
     @abstractmethod
     def _split_results(self, query_results):
         pass
 
     @abstractmethod
-    def _run_aql_query(self, query, fields, aliases, collection):
+    def _run_aql_query(self, query, fields, aliases, collection, limit=0, order_by=None):
         pass
 
     @abstractmethod
-    def build_queries(self, query_model, patients_repository, ehr_repository, query_params=None):
-        query_params = query_params or dict()
+    def _iter_aql_query(self, query, fields, limit=0, batch_size=None, order_by=None):
+        """
+        Lazily fetch records matching *query* from the current collection, records are
+        returned already split into path/value maps
+        """
+        pass
+
+    def _merge_condition_expressions(self, condition_query, location_query):
+        """
+        Add the expression built for the location of the query to the expression built for
+        its condition
+        """
+        condition_query.update(location_query)
+        return condition_query
+
+    @abstractmethod
+    def build_queries(self, query_model, patients_repository, ehr_repository, query_params=None,
+                      structures_mapping=None):
+        if query_params is None:
+            query_params = dict()
         selection = query_model.selection
         location = query_model.location
         condition = query_model.condition
-        # TODO: add ORDER RULES and TIME CONSTRAINTS
+        # TODO: add TIME CONSTRAINTS
         queries = dict()
-        # get aliases map and paths map for structures that match the CONTAINS statement
-        structures_map, aliases_map = self.index_service.map_aql_contains(location.containers)
+        # get aliases map and paths map for structures that match the CONTAINS statement,
+        # if they were not already provided
+        if structures_mapping is None:
+            structures_mapping = self.index_service.map_aql_contains(location.containers)
+        structures_map, aliases_map = structures_mapping
+        aliases_map = dict(aliases_map)
         for structure_id, archetype_paths in structures_map.iteritems():
             # location_query simply maps EHR section, this will be shared among all structure paths
             location_query = self._calculate_location_expression(location, query_params, patients_repository,
@@ -332,10 +628,18 @@ class DriverInterface(object):
             for arch_path in archetype_paths:
                 apat_query = dict()
                 # build selection section of the query
-                selection_query, result_aliases = self._calculate_selection_expression(selection, aliases_map,
-                                                                                       arch_path)
+                if selection.aggregated:
+                    selection_query, aggregation, result_aliases = \
+                        self._calculate_aggregation_expression(selection, aliases_map, arch_path)
+                    apat_query['aggregation'] = aggregation
+                else:
+                    selection_query, result_aliases = self._calculate_selection_expression(selection, aliases_map,
+                                                                                           arch_path)
                 apat_query['selection'] = selection_query
                 apat_query['aliases'] = result_aliases
+                if query_model.order_rules:
+                    apat_query['order_by'] = self._calculate_order_expression(query_model.order_rules,
+                                                                              aliases_map, arch_path)
                 # build condition section of the query
                 if condition:
                     condition_query = self._calculate_condition_expression(condition, aliases_map, arch_path)
@@ -344,10 +648,64 @@ class DriverInterface(object):
                     # set and empty dictionary as 'condition', it will be filled later with rules to match
                     # ClinicalRecord structure ID
                     apat_query['condition'] = dict()
-                apat_query['condition'].update(location_query)
+                apat_query['condition'] = self._merge_condition_expressions(apat_query['condition'],
+                                                                            location_query)
                 queries.setdefault(structure_id, list()).append(apat_query)
         return queries
 
+    @abstractmethod
+    def compile_query(self, query_model, patients_repository, ehr_repository, query_params=None,
+                      structures_mapping=None):
+        """
+        Translate the given :class:`pyehr.aql.model.QueryModel` into a list of queries for the
+        backend server that can be executed using the :meth:`run_compiled_query` method.
+        *structures_mapping* is the output of the :meth:`IndexService.map_aql_contains` method
+        for the query, if None the :class:`IndexService` will be contacted.
+        """
+        pass
+
+    @abstractmethod
+    def run_compiled_query(self, queries, ehr_repository, count_only=False, query_processes=1,
+                           limit=0, executor=None):
+        """
+        Execute the queries obtained with the :meth:`compile_query` method, if *limit* is
+        greater than 0 no more than *limit* results are returned. If *query_processes* is greater
+        than 1, queries are distributed among the workers of *executor* (a
+        :class:`multiprocessing.pool.Pool` or :class:`multiprocessing.pool.ThreadPool`), if no
+        executor is given a pool of *query_processes* processes is created for the current call.
+        """
+        pass
+
+    def _map_queries(self, runner, queries, query_processes, executor=None, ordered=False):
+        """
+        Apply *runner* to all the *queries* using the workers of *executor* and yield the results
+        as soon as they are available; if *ordered* is True results are yielded in the same order
+        of the queries. If *executor* is None, a pool of *query_processes* processes is created
+        and terminated when all the results have been retrieved.
+        """
+        pool = executor or Pool(query_processes)
+        try:
+            if ordered:
+                results = pool.imap(runner, queries)
+            else:
+                results = pool.imap_unordered(runner, queries)
+            for r in results:
+                yield r
+        finally:
+            if executor is None:
+                pool.terminate()
+                pool.join()
+
+    @abstractmethod
+    def stream_compiled_query(self, queries, ehr_repository, limit=0, batch_size=None):
+        """
+        Execute the queries obtained with the :meth:`compile_query` method and return a
+        :class:`pyehr.ehr.services.dbmanager.querymanager.results_wrappers.StreamingResultSet`
+        that fetches results from the backend server *batch_size* at a time while they are
+        consumed. If *limit* is greater than 0 no more than *limit* results are fetched.
+        """
+        pass
+
     @abstractmethod
     def _get_query_hash(self, query):
         query_hash = md5()
@@ -1,14 +1,18 @@
 from pyehr.aql.parser import *
 from pyehr.ehr.services.dbmanager.drivers.interface import DriverInterface
+from pyehr.ehr.services.dbmanager.drivers.connection_pool import get_connection_pool
+from pyehr.ehr.services.dbmanager.dbservices.index_service import IndexService
 from pyehr.ehr.services.dbmanager.querymanager.results_wrappers import ResultSet,\
-    ResultColumnDef, ResultRow
+    ResultColumnDef, ResultRow, StreamingResultSet
 from pyehr.ehr.services.dbmanager.errors import *
 from pyehr.utils import *
+from pyehr.utils.cache import LRUCache
 import pymongo
 import pymongo.errors
+from bson.son import SON
 import time
 from hashlib import md5
-from multiprocessing import Pool
+from itertools import islice
 
 try:
     import simplejson as json
@@ -16,25 +20,33 @@ except ImportError:
     import json
 
 
+# the lists found along a field in the records of a structure, keyed by
+# (database, collection, structure ID, field) and shared by all the drivers of the process;
+# entries expire after a while and are discarded when the structures index changes
+_array_paths_cache = LRUCache(max_size=4096, ttl=600)
+
+
 class MultiprocessQueryRunnerPM2(object):
 
     def __init__(self, host, database, collection,
-                 port, user, passwd):
+                 port, user, passwd, query_engine='find'):
         self.host = host
         self.database = database
         self.collection_name = collection
         self.port = port
         self.user = user
         self.passwd = passwd
+        self.query_engine = query_engine
 
     def __call__(self, query_description):
         driver_instance = MongoDriverPM2(
             self.host, self.database, self.collection_name,
-            self.port, self.user, self.passwd
+            self.port, self.user, self.passwd, query_engine=self.query_engine
         )
         results = driver_instance._run_aql_query(
             query_description['condition'], query_description['selection'],
-            query_description['aliases'], self.collection_name
+            query_description['aliases'], self.collection_name,
+            query_description.get('limit', 0), query_description.get('order_by')
         )
         return results
 
@@ -45,14 +57,31 @@ class MongoDriverPM2(DriverInterface):
     and *password* the driver will contact MongoDB when a connection is needed and will interrogate a specific
     *collection* stored in one *database* within the server. If no *logger* object is passed to constructor, a
     new one is created.
+
+    AQL queries are executed with a *query_engine* that can be 'find' (the default), which runs a find
+    and flattens the returned documents on the client, or 'aggregate', which runs an aggregation pipeline
+    that unwinds the lists along the selected paths and projects the selected fields, so that the server
+    returns one flat row for each result.
     """
 
     # This map is used to encode\decode data when writing\reading to\from MongoDB
     ENCODINGS_MAP = {'.': '-'}
 
+    QUERY_ENGINES = ('find', 'aggregate')
+
+    # fields used to select records by most queries, sparse indexes are used for fields that
+    # are not part of all the records (i.e. revisions have a composite _id)
+    BASE_INDEXES = [
+        ('ehr_structure_id', {'sparse': True}),
+        ('patient_id', {'sparse': True}),
+        ('active', {}),
+        ('_id._id', {'sparse': True})
+    ]
+    CONDITION_INDEX_PREFIX = 'aql_condition_'
+
     def __init__(self, host, database, collection,
                  port=None, user=None, passwd=None,
-                 index_service=None, logger=None):
+                 index_service=None, logger=None, query_engine='find'):
         self.client = None
         self.database = None
         self.collection = None
@@ -64,23 +93,45 @@ class MongoDriverPM2(DriverInterface):
         self.passwd = passwd
         self.index_service = index_service
         self.logger = logger or get_logger('mongo-db-driver')
+        if query_engine not in self.QUERY_ENGINES:
+            raise ValueError('Unknown query engine %s, use one of %r' % (query_engine, self.QUERY_ENGINES))
+        self.query_engine = query_engine
+
+    @property
+    def _pool_key(self):
+        return (self.__class__.__name__, self.host, self.port, self.database_name,
+                self.user, self.passwd)
+
+    def _open_client(self):
+        self.logger.debug('opening a new client for host %s', self.host)
+        try:
+            client = pymongo.MongoClient(self.host, self.port)
+        except pymongo.errors.ConnectionFailure:
+            raise DBManagerNotConnectedError('Unable to connect to MongoDB at %s:%s' %
+                                             (self.host, self.port))
+        if self.user:
+            self.logger.debug('authenticating with username %s', self.user)
+            client[self.database_name].authenticate(self.user, self.passwd)
+        return client
+
+    def _close_client(self, client):
+        client.disconnect()
+
+    def _check_client(self, client):
+        client.admin.command('ping')
 
     def connect(self):
         """
-        Open a connection to a MongoDB server.
+        Open a connection to a MongoDB server. The client is leased from the connection pool
+        shared by all drivers of the current process, a new one is opened only if no idle
+        client is available.
         """
         if not self.client:
             self.logger.debug('connecting to host %s', self.host)
-            try:
-                self.client = pymongo.MongoClient(self.host, self.port)
-            except pymongo.errors.ConnectionFailure:
-                raise DBManagerNotConnectedError('Unable to connect to MongoDB at %s:%s' %
-                                                 (self.host, self.port))
+            self.client = get_connection_pool().lease(self._pool_key, self._open_client,
+                                                      self._close_client, self._check_client)
             self.logger.debug('binding to database %s', self.database_name)
             self.database = self.client[self.database_name]
-            if self.user:
-                self.logger.debug('authenticating with username %s', self.user)
-                self.database.authenticate(self.user, self.passwd)
             self.logger.debug('using collection %s', self.collection_name)
             self.collection = self.database[self.collection_name]
         else:
@@ -89,17 +140,92 @@ class MongoDriverPM2(DriverInterface):
 
     def disconnect(self):
         """
-        Close a connection to a MongoDB server.
+        Close a connection to a MongoDB server. The client is released to the connection pool.
         """
-        self.logger.debug('disconnecting from host %s', self.client.host)
-        self.client.disconnect()
+        self.logger.debug('disconnecting from host %s', self.host)
+        get_connection_pool().release(self._pool_key, self.client, self._close_client)
         self.database = None
         self.collection = None
         self.client = None
 
-    def init_structure(self, structure_def):
-        # MongoDB doesn't need structures initialization
-        pass
+    def init_structure(self, structure_def=None):
+        """
+        Create the indexes used by pyEHR on the current collection, indexes that already exist
+        are left untouched. Base indexes (see BASE_INDEXES) are always created, if *structure_def*
+        is a dictionary with a 'condition_fields' list, an index is created for each field as
+        well (see :meth:`create_condition_index`).
+
+        :param structure_def: the description of the additional indexes
+        :type structure_def: dict
+        :return: the names of the indexes
+        :rtype: list
+        """
+        self._check_connection()
+        indexes = list()
+        for field, options in self.BASE_INDEXES:
+            indexes.append(self.collection.create_index([(field, pymongo.ASCENDING)], **options))
+        for field in (structure_def or {}).get('condition_fields', []):
+            indexes.append(self.create_condition_index(field))
+        return indexes
+
+    def _get_condition_index_name(self, field):
+        return '%s%s' % (self.CONDITION_INDEX_PREFIX, md5(field).hexdigest())
+
+    def create_condition_index(self, field):
+        """
+        Create an index that supports AQL conditions over the given record field. The index is
+        a compound one on (ehr_structure_id, field), since AQL queries always select the structures
+        matching the CONTAINS clause, and it is a partial index that only contains the records where
+        *field* exists, so that each index is as big as the structures using the field.
+        Partial indexes require MongoDB 3.2 or later.
+
+        :param field: the record field, as used in the queries built by the driver
+        :type field: str
+        :return: the name of the index
+        :rtype: str
+        """
+        self._check_connection()
+        return self.collection.create_index([('ehr_structure_id', pymongo.ASCENDING), (field, pymongo.ASCENDING)],
+                                            name=self._get_condition_index_name(field),
+                                            partialFilterExpression={field: {'$exists': True}})
+
+    def get_condition_indexes(self):
+        """
+        Get the indexes created with the :meth:`create_condition_index` method
+
+        :return: a dictionary mapping index names to the indexed record fields
+        :rtype: dict
+        """
+        self._check_connection()
+        return dict((name, info['key'][-1][0]) for name, info in self.collection.index_information().iteritems()
+                    if name.startswith(self.CONDITION_INDEX_PREFIX))
+
+    def drop_condition_index(self, field):
+        """
+        Drop the index created for the given field with the :meth:`create_condition_index` method
+        """
+        self._check_connection()
+        self.collection.drop_index(self._get_condition_index_name(field))
+
+    def get_condition_fields(self, condition):
+        """
+        Get the record fields used by a condition built by the driver, operators and fields
+        covered by the base indexes are skipped
+
+        :param condition: the condition of a query, in MongoDB syntax
+        :type condition: dict
+        :return: the fields in the order they appear in the condition
+        :rtype: list
+        """
+        fields = list()
+        base_fields = [f for f, _ in self.BASE_INDEXES]
+        for key, value in condition.iteritems():
+            if key in ('$or', '$and', '$nor'):
+                for c in value:
+                    fields.extend(f for f in self.get_condition_fields(c) if f not in fields)
+            elif not key.startswith('$') and key not in base_fields and key not in fields:
+                fields.append(key)
+        return fields
 
     @property
     def is_connected(self):
@@ -138,28 +264,16 @@ class MongoDriverPM2(DriverInterface):
             encoded_record['_id'] = patient_record.record_id
         return encoded_record
 
-    def _normalize_keys(self, document, original, encoded):
-        normalized_doc = {}
-        for k, v in document.iteritems():
-            k = k.replace(original, encoded)
-            if not isinstance(v, dict):
-                if isinstance(v, list):
-                    v = [self._normalize_keys(x, original, encoded) for x in v]
-                normalized_doc[k] = v
-            else:
-                normalized_doc[k] = self._normalize_keys(v, original, encoded)
-        return normalized_doc
-
     def _encode_clinical_record(self, clinical_record):
-        ehr_data = clinical_record.ehr_data.to_json()
-        for original_value, encoded_value in self.ENCODINGS_MAP.iteritems():
-            ehr_data = self._normalize_keys(ehr_data, original_value, encoded_value)
+        # keys are encoded while the archetype is converted to JSON
+        ehr_data = clinical_record.ehr_data.to_json(keys_map=self.ENCODINGS_MAP)
         encoded_record = {
             'patient_id': clinical_record.patient_id,
             'creation_time': clinical_record.creation_time,
             'last_update': clinical_record.last_update,
             'active': clinical_record.active,
             'ehr_data': ehr_data,
+            'content_hash': self._get_content_hash(ehr_data),
             '_version': clinical_record.version
         }
         if clinical_record.structure_id:
@@ -169,9 +283,8 @@ class MongoDriverPM2(DriverInterface):
         return encoded_record
 
     def _encode_clinical_record_revision(self, clinical_record_revision):
-        ehr_data = clinical_record_revision.ehr_data.to_json()
-        for original_value, encoded_value in self.ENCODINGS_MAP.iteritems():
-            ehr_data = self._normalize_keys(ehr_data, original_value, encoded_value)
+        # keys are encoded while the archetype is converted to JSON
+        ehr_data = clinical_record_revision.ehr_data.to_json(keys_map=self.ENCODINGS_MAP)
         return {
             '_id': clinical_record_revision.record_id,
             'ehr_structure_id': clinical_record_revision.structure_id,
@@ -225,27 +338,22 @@ class MongoDriverPM2(DriverInterface):
                 record_id=record.get('_id')
             )
 
-    def _decode_keys(self, document, encoded, original):
-        normalized_doc = {}
-        for k, v in document.iteritems():
-            k = k.replace(encoded, original)
-            if not isinstance(v, dict):
-                normalized_doc[k] = v
-            else:
-                normalized_doc[k] = self._decode_keys(v, encoded, original)
-        return normalized_doc
+    def _decode_archetype(self, ehr_data):
+        from pyehr.ehr.services.dbmanager.dbservices.wrappers import ArchetypeInstance
+
+        # encoded keys are restored while archetype details are decoded, when they are accessed
+        keys_map = dict((encoded, original) for original, encoded in self.ENCODINGS_MAP.iteritems())
+        return ArchetypeInstance.from_json(ehr_data, validate=False, lazy=True, keys_map=keys_map)
 
     def _decode_clinical_record(self, record, loaded):
         from pyehr.ehr.services.dbmanager.dbservices.wrappers import ClinicalRecord,\
             ArchetypeInstance
 
-        record = decode_dict(record)
+        # archetype data are decoded by ArchetypeInstance.from_json
+        record = decode_dict(record, skip_keys=('ehr_data',) if loaded else ())
         if loaded:
-            ehr_data = record['ehr_data']
-            for original_value, encoded_value in self.ENCODINGS_MAP.iteritems():
-                ehr_data = self._decode_keys(ehr_data, encoded_value, original_value)
             crec = ClinicalRecord(
-                ehr_data=ArchetypeInstance.from_json(ehr_data),
+                ehr_data=self._decode_archetype(record['ehr_data']),
                 creation_time=record['creation_time'],
                 last_update=record['last_update'],
                 active=record['active'],
@@ -274,15 +382,11 @@ class MongoDriverPM2(DriverInterface):
         return crec
 
     def _decode_clinical_record_revision(self, record):
-        from pyehr.ehr.services.dbmanager.dbservices.wrappers import ClinicalRecordRevision, \
-            ArchetypeInstance
+        from pyehr.ehr.services.dbmanager.dbservices.wrappers import ClinicalRecordRevision
 
-        record = decode_dict(record)
-        ehr_data = record['ehr_data']
-        for original_value, encoded_value in self.ENCODINGS_MAP.iteritems():
-            ehr_data = self._decode_keys(ehr_data, encoded_value, original_value)
+        record = decode_dict(record, skip_keys=('ehr_data',))
         return ClinicalRecordRevision(
-            ehr_data=ArchetypeInstance.from_json(ehr_data),
+            ehr_data=self._decode_archetype(record['ehr_data']),
             patient_id=record['patient_id'],
             creation_time=record['creation_time'],
             last_update=record['last_update'],
@@ -340,9 +444,10 @@ class MongoDriverPM2(DriverInterface):
         # check for duplicated ID in records' batch
         self._check_batch(records, '_id')
         self._check_connection()
-        records_map = {r['_id']: r for r in records}
-        duplicated_ids = [x['_id'] for x in self.get_records_by_query({'_id': {'$in': records_map.keys()}},
-                                                                      {'_id': True})]
+        records_map = {self._get_batch_key(r['_id']): r for r in records}
+        duplicated_ids = [self._get_batch_key(x['_id']) for x in
+                          self.get_records_by_query({'_id': {'$in': [r['_id'] for r in records]}},
+                                                    {'_id': True})]
         if len(duplicated_ids) > 0 and not skip_existing_duplicated:
             raise DuplicatedKeyError('The following IDs are already in use: %s' % duplicated_ids)
         try:
@@ -367,6 +472,25 @@ class MongoDriverPM2(DriverInterface):
         else:
             return res
 
+    def get_records_by_ids(self, records_id, fields=None, active_only=False):
+        """
+        Retrieve all the records whose ID is in *records_id* with a single query
+
+        :param records_id: the IDs of the records
+        :type records_id: list
+        :param fields: a list of field names that should be returned in the result set or a dict specifying the
+                       fields to include or exclude
+        :type fields: list or dictionary
+        :param active_only: if True, skip records with the active flag set to False
+        :type active_only: boolean
+        :return: a list with the matching records, records order is not guaranteed
+        :rtype: list
+        """
+        selector = {'_id': {'$in': list(records_id)}}
+        if active_only:
+            selector['active'] = True
+        return list(self.get_records_by_query(selector, fields))
+
     def get_record_by_version(self, record_id, version):
         """
         Retrieve a record using its ID and version number
@@ -411,7 +535,28 @@ class MongoDriverPM2(DriverInterface):
         """
         return self.get_records_by_query({field: value})
 
-    def get_records_by_query(self, selector, fields=None, limit=0):
+    def iter_records(self, filters=None, batch_size=1000, after_id=None):
+        """
+        Iterate over all records of the current collection using a server side cursor,
+        records are sorted by ID so that an iteration can be resumed from the last
+        retrieved ID
+
+        :param filters: a map of field/value pairs that records must match
+        :type filters: dictionary
+        :param batch_size: the number of records fetched from the server with each round trip
+        :type batch_size: int
+        :param after_id: if not None, only return records with an ID greater than this one
+        :return: a generator over the matching records
+        """
+        self._check_connection()
+        selector = dict(filters or {})
+        if after_id is not None:
+            selector['_id'] = {'$gt': after_id}
+        cursor = self.collection.find(selector).sort('_id', pymongo.ASCENDING).batch_size(batch_size)
+        for rec in cursor:
+            yield decode_dict(rec)
+
+    def get_records_by_query(self, selector, fields=None, limit=0, sort=None):
         """
         Retrieve all records matching the given query
 
@@ -423,11 +568,13 @@ class MongoDriverPM2(DriverInterface):
         :param limit: the maximum number of records that will be fetched by the query, default value is 0
                       which means that limit won't be applied and all records will be fetched
         :type limit: int
+        :param sort: a list of (field, direction) pairs used to sort the records
+        :type sort: list
         :return: a list with the matching records
         :rtype: list
         """
         self._check_connection()
-        return (decode_dict(rec) for rec in self.collection.find(selector, fields, limit=limit))
+        return (decode_dict(rec) for rec in self.collection.find(selector, fields, limit=limit, sort=sort))
 
     def get_values_by_record_id(self, record_id, values_list):
         """
@@ -487,6 +634,17 @@ class MongoDriverPM2(DriverInterface):
         return self.delete_records_by_query({'_id._id': record_id,
                                              '_version': {'$gt': version_to_keep}})
 
+    def delete_versions_by_ids(self, records_id):
+        """
+        Delete all versions of the records with the given IDs using a single query.
+
+        :param records_id: IDs of the records
+        :type records_id: list
+        :return: the number of deleted records
+        :rtype: int
+        """
+        return self.delete_records_by_query({'_id._id': {'$in': records_id}})
+
     def delete_records_by_query(self, query):
         """
         Delete all records that match the given query
@@ -515,6 +673,14 @@ class MongoDriverPM2(DriverInterface):
         res = self.collection.update({'_id': record_id}, update_condition)
         self.logger.debug('updated %d documents', res[u'n'])
 
+    def _update_records(self, selector, update_condition):
+        self._check_connection()
+        self.logger.debug('Updating records matching %r, with condition %r', selector,
+                          update_condition)
+        res = self.collection.update(selector, update_condition, multi=True)
+        self.logger.debug('updated %d documents', res[u'n'])
+        return res[u'n']
+
     @property
     def documents_count(self):
         """
@@ -536,6 +702,19 @@ class MongoDriverPM2(DriverInterface):
         update_statement.setdefault('$inc', {})['_version'] = 1
         return update_statement
 
+    def _get_update_statement(self, update_type, field_label, value):
+        self._check_update_type(update_type)
+        if update_type == 'set':
+            return {'$set': {field_label: value}}
+        elif update_type == 'add':
+            return {'$addToSet': {field_label: value}}
+        elif update_type == 'extend':
+            return {'$addToSet': {field_label: {'$each': value}}}
+        elif isinstance(value, list):
+            return {'$pullAll': {field_label: value}}
+        else:
+            return {'$pull': {field_label: value}}
+
     def update_field(self, record_id, field_label, field_value, update_timestamp_label=None,
                      increase_version=False):
         """
@@ -553,7 +732,7 @@ class MongoDriverPM2(DriverInterface):
         :return: the timestamp of the last update as saved in the DB or None
                  (if *update_timestamp_label* was None)
         """
-        update_statement = {'$set': {field_label: field_value}}
+        update_statement = self._get_update_statement('set', field_label, field_value)
         if update_timestamp_label:
             update_statement, last_update = self._update_record_timestamp(update_timestamp_label,
                                                                           update_statement)
@@ -564,6 +743,50 @@ class MongoDriverPM2(DriverInterface):
         self._update_record(record_id, update_statement)
         return last_update
 
+    def versioned_update_records(self, records_versions, field_label, field_value,
+                                 update_timestamp_label=None):
+        """
+        Set the field *field_label* of the records in *records_versions* and increase their version
+        using a single query, only records whose saved version is the expected one are updated.
+        If no *update_timestamp_label* is given, records are updated one at a time.
+
+        :param records_versions: a map of records' IDs and their expected versions
+        :type records_versions: dict
+        :param field_label: field's label
+        :type field_label: string
+        :param field_value: new value for the selected field
+        :param update_timestamp_label: the label of the *last_update* field of the records
+                                       if the last update timestamp must be recorded or None
+        :type update_timestamp_label: field label or None
+        :return: the IDs of the updated records and the timestamp of the last update as saved
+                 in the DB or None (if *update_timestamp_label* was None)
+        """
+        if not records_versions:
+            return [], None
+        if not update_timestamp_label:
+            # without a timestamp written by this update, the records it changed can't be
+            # told apart from the ones moved to the same version by a concurrent update
+            return super(MongoDriverPM2, self).versioned_update_records(records_versions, field_label,
+                                                                        field_value)
+        update_statement = self._get_update_statement('set', field_label, field_value)
+        update_statement, last_update = self._update_record_timestamp(update_timestamp_label,
+                                                                      update_statement)
+        update_statement = self._increase_version(update_statement)
+        updated_count = self._update_records(
+            {'$or': [{'_id': rid, '_version': v} for rid, v in records_versions.iteritems()]},
+            update_statement
+        )
+        if updated_count == len(records_versions):
+            return records_versions.keys(), last_update
+        # records changed by concurrent updates were skipped, the ones updated by this
+        # query are the ones that now have the next version and this update's timestamp
+        updated_records = self.get_records_by_query(
+            {'$or': [{'_id': rid, '_version': v + 1, update_timestamp_label: last_update}
+                     for rid, v in records_versions.iteritems()]},
+            {'_id': True}
+        )
+        return [r['_id'] for r in updated_records], last_update
+
     def replace_record(self, record_id, new_record, update_timestamp_label=None):
         """
         Replace record with *record_id* with the given *new_record*
@@ -589,6 +812,88 @@ class MongoDriverPM2(DriverInterface):
         self._update_record(record_id, new_record)
         return last_update
 
+    def _find_and_replace(self, selector, new_record):
+        return self.collection.find_and_modify(selector, new_record, new=False)
+
+    def swap_record(self, record_id, new_record, version, update_timestamp_label=None):
+        """
+        Replace record with *record_id* with the given *new_record* only if the version of the
+        saved record is *version* and if its content hash or its metadata differ from the ones
+        of *new_record*. Check and replacement are a single atomic operation.
+
+        :param record_id: the ID of the record that will be replaced with the new one
+        :param new_record: the new record
+        :type new_record: dict
+        :param version: the expected version of the saved record
+        :type version: int
+        :param update_timestamp_label: the label of the *last_update* field of the record
+                                       if the last update timestamp must be recorded or None
+        :type update_timestamp_label: field label or None
+        :return: the replaced record, or None if no record was replaced, and the timestamp of the
+                 last update as saved in the DB or None (if *update_timestamp_label* was None)
+        """
+        self._check_connection()
+        last_update = None
+        if update_timestamp_label:
+            last_update = time.time()
+            new_record[update_timestamp_label] = last_update
+        try:
+            new_record.pop('_id')
+        except KeyError:
+            pass
+        selector = {
+            '_id': record_id,
+            '_version': version,
+            # records saved without a content hash are always replaced, as well as records
+            # whose metadata change
+            '$or': [{'content_hash': {'$ne': new_record.get('content_hash')}}] +
+                   [{f: {'$ne': new_record.get(f)}} for f in self.SWAP_CHECKED_FIELDS]
+        }
+        previous_record = self._find_and_replace(selector, new_record)
+        self.logger.debug('Record %r replaced: %s', record_id, previous_record is not None)
+        return previous_record, last_update
+
+    def _find_and_update(self, selector, update_statement):
+        return self.collection.find_and_modify(selector, update_statement, new=False)
+
+    def versioned_update(self, record_id, version, field_label, update_type, value,
+                         update_timestamp_label=None):
+        """
+        Apply an update to the field *field_label* of the record with *record_id* and increase
+        its version only if the version of the saved record is *version*. Check, update and
+        retrieval of the record as it was before the update are a single atomic operation.
+
+        :param record_id: record's ID
+        :param version: the expected version of the saved record
+        :type version: int
+        :param field_label: the label of the field that will be updated
+        :type field_label: string
+        :param update_type: the operation applied to the field, one of UPDATE_TYPES
+        :type update_type: string
+        :param value: the new value of the field or the item (or items) that will be added to
+          or removed from the list
+        :param update_timestamp_label: the label of the *last_update* field of the record
+                                       if the last update timestamp must be recorded or None
+        :type update_timestamp_label: field label or None
+        :return: the record before the update, or None if no record was updated, and the
+                 timestamp of the last update as saved in the DB or None
+                 (if *update_timestamp_label* was None)
+        """
+        self._check_connection()
+        update_statement = self._get_update_statement(update_type, field_label, value)
+        if update_timestamp_label:
+            update_statement, last_update = self._update_record_timestamp(update_timestamp_label,
+                                                                          update_statement)
+        else:
+            last_update = None
+        update_statement = self._increase_version(update_statement)
+        selector = {'_id': record_id, '_version': version}
+        if update_type == 'set':
+            selector[field_label] = {'$ne': value}
+        previous_record = self._find_and_update(selector, update_statement)
+        self.logger.debug('Record %r updated: %s', record_id, previous_record is not None)
+        return previous_record, last_update
+
     def add_to_list(self, record_id, list_label, item_value, update_timestamp_label=None,
                     increase_version=False):
         """
@@ -603,7 +908,7 @@ class MongoDriverPM2(DriverInterface):
         :type update_timestamp_label: string or None
         :return: the timestamp of the last update as saved in the DB or None (if update_timestamp_field was None)
         """
-        update_statement = {'$addToSet': {list_label: item_value}}
+        update_statement = self._get_update_statement('add', list_label, item_value)
         if update_timestamp_label:
             update_statement, last_update = self._update_record_timestamp(update_timestamp_label,
                                                                           update_statement)
@@ -628,7 +933,7 @@ class MongoDriverPM2(DriverInterface):
         :type update_timestamp_label: string or None
         :return: the timestamp of the last update as saved in the DB or None (if update_timestamp_field was None)
         """
-        update_statement = {'$addToSet': {list_label: {'$each': items}}}
+        update_statement = self._get_update_statement('extend', list_label, items)
         if update_timestamp_label:
             update_statement, last_update = self._update_record_timestamp(update_timestamp_label,
                                                                           update_statement)
@@ -653,10 +958,7 @@ class MongoDriverPM2(DriverInterface):
         :type update_timestamp_label: field label or None
         :return: the timestamp of the last update as saved in the DB or None (if update_timestamp_field was None)
         """
-        if isinstance(item_value, list):
-            update_statement = {'$pullAll': {list_label: item_value}}
-        else:
-            update_statement = {'$pull': {list_label: item_value}}
+        update_statement = self._get_update_statement('remove', list_label, item_value)
         if update_timestamp_label:
             update_statement, last_update = self._update_record_timestamp(update_timestamp_label,
                                                                           update_statement)
@@ -861,6 +1163,14 @@ class MongoDriverPM2(DriverInterface):
                                                                    var.variable.path.value)
         return query, results_aliases
 
+    def _calculate_order_expression(self, order_rules, variables_map, containment_mapping):
+        return super(MongoDriverPM2, self)._calculate_order_expression(order_rules, variables_map,
+                                                                       containment_mapping)
+
+    def _calculate_aggregation_expression(self, selection, variables_map, containment_mapping):
+        return super(MongoDriverPM2, self)._calculate_aggregation_expression(selection, variables_map,
+                                                                             containment_mapping)
+
     def _split_results(self, query_result):
         for key, value in query_result.iteritems():
             if isinstance(value, dict):
@@ -873,7 +1183,143 @@ class MongoDriverPM2(DriverInterface):
             else:
                 yield key, value
 
-    def _run_aql_query(self, query, fields, aliases, collection):
+    def _get_sort_expression(self, order_by):
+        if order_by:
+            return [(field, pymongo.DESCENDING if direction == 'DESC' else pymongo.ASCENDING)
+                    for field, _, direction in order_by]
+
+    def _get_record_array_paths(self, record, field):
+        # the paths of the lists found following the given field in the record, a path is
+        # repeated for each level of nested lists; the layout is incomplete if the field is
+        # missing or an empty list is found along its path
+        array_paths = list()
+        value = record
+        path = list()
+        for key in field.split('.') + [None]:
+            while isinstance(value, list):
+                if not value:
+                    return array_paths, False
+                array_paths.append('.'.join(path))
+                value = value[0]
+            if key is None:
+                break
+            if not isinstance(value, dict) or key not in value:
+                return array_paths, False
+            value = value[key]
+            path.append(key)
+        return array_paths, True
+
+    def _get_query_structures(self, query):
+        # the structure IDs selected by a query built with the compile_query method
+        structures = set()
+        if isinstance(query, dict):
+            for key, value in query.iteritems():
+                if key == 'ehr_structure_id':
+                    if isinstance(value, dict):
+                        structures.update(value.get('$in', []))
+                    else:
+                        structures.add(value)
+                else:
+                    structures.update(self._get_query_structures(value))
+        elif isinstance(query, list):
+            for q in query:
+                structures.update(self._get_query_structures(q))
+        return structures
+
+    def _merge_array_paths(self, array_paths, other_paths):
+        # keep each path as many times as it is found in the list with more occurrences
+        merged_paths = list(array_paths)
+        for path in set(other_paths):
+            merged_paths.extend([path] * (other_paths.count(path) - merged_paths.count(path)))
+        return merged_paths
+
+    def _get_array_paths(self, query, fields):
+        """
+        Map each one of the given fields to the lists that must be unwound to reach it. Records
+        with the same structure share their layout, the lists are found in one record of each
+        structure selected by the query that contains the field, retrieved with a single
+        aggregation for each field, and cached, so that only structures that were never seen
+        before cost a round trip to the server.
+        """
+        fields_paths = dict((f, list()) for f in fields)
+        structures = self._get_query_structures(query)
+        structures_version = IndexService.structures_version
+        cache_key = lambda structure, field: (self.database_name, self.collection_name, structure, field)
+        for f in fields:
+            missing_structures = list()
+            for structure in structures:
+                cached = _array_paths_cache.get(cache_key(structure, f))
+                if cached is None or cached[1] != structures_version:
+                    missing_structures.append(structure)
+                else:
+                    fields_paths[f] = self._merge_array_paths(fields_paths[f], cached[0])
+            if structures and not missing_structures:
+                continue
+            # only records that contain the field show the lists found along its path
+            field_query = {'$and': [query, {f: {'$exists': True}}]}
+            if missing_structures:
+                field_query['$and'].append({'ehr_structure_id': {'$in': missing_structures}})
+            pipeline = [
+                {'$match': field_query},
+                {'$project': {f: True, 'ehr_structure_id': True}},
+                {'$group': {'_id': '$ehr_structure_id', 'record': {'$first': '$$ROOT'}}}
+            ]
+            for res in self._run_aggregation_pipeline(pipeline):
+                paths, complete = self._get_record_array_paths(res['record'], f)
+                if structures and complete:
+                    _array_paths_cache.set(cache_key(res['_id'], f), (paths, structures_version))
+                fields_paths[f] = self._merge_array_paths(fields_paths[f], paths)
+        return fields_paths
+
+    def _get_unwind_stage(self, path):
+        # records without the list are dropped by $unwind
+        return {'$unwind': '$%s' % path}
+
+    def _get_unwind_stages(self, query, fields):
+        # lists shared by more fields are unwound once, so that values of the same list
+        # element end up in the same row, outer lists are unwound first
+        unwind_counters = dict()
+        for array_paths in self._get_array_paths(query, fields).itervalues():
+            for path in set(array_paths):
+                unwind_counters[path] = max(unwind_counters.get(path, 0), array_paths.count(path))
+        unwind_stages = list()
+        for path in sorted(unwind_counters, key=lambda p: p.count('.')):
+            unwind_stages.extend([self._get_unwind_stage(path)] * unwind_counters[path])
+        return unwind_stages
+
+    def _build_query_pipeline(self, query, fields, limit=0, order_by=None):
+        """
+        Translate a query and its selection into an aggregation pipeline that returns a flat row for
+        each result: lists along the selected paths are unwound (lists shared by more paths are
+        unwound once, so that values of the same list element end up in the same row) and selected
+        fields are projected to top level keys.
+
+        :return: the pipeline and a map of the projected keys and the selected fields
+        """
+        selected_fields = [f for f, selected in fields.iteritems() if selected]
+        pipeline = [{'$match': query}]
+        pipeline.extend(self._get_unwind_stages(query, selected_fields))
+        if order_by:
+            # records are sorted using the original paths, so that fields that are not
+            # projected can be used as well
+            pipeline.append({'$sort': SON([(field, -1 if direction == 'DESC' else 1)
+                                           for field, _, direction in order_by])})
+        if limit:
+            pipeline.append({'$limit': limit})
+        keys_map = dict(('c%d' % i, f) for i, f in enumerate(selected_fields))
+        projection = dict((k, '$%s' % f) for k, f in keys_map.iteritems())
+        projection['_id'] = 0
+        pipeline.append({'$project': projection})
+        return pipeline, keys_map
+
+    def _iter_pipeline_rows(self, query, fields, limit=0, batch_size=None, order_by=None):
+        pipeline, keys_map = self._build_query_pipeline(query, fields, limit, order_by)
+        for row in self._run_aggregation_pipeline(pipeline, batch_size):
+            yield dict((keys_map[k], v) for k, v in decode_dict(row).iteritems())
+
+    def _run_aql_query(self, query, fields, aliases, collection, limit=0, order_by=None):
+        if self.query_engine == 'aggregate':
+            return self._run_aql_pipeline(query, fields, aliases, collection, limit, order_by)
         self.logger.debug("Running query\n%s\nwith filters\n%s", query, fields)
         rs = ResultSet()
         for path, alias in aliases.iteritems():
@@ -886,23 +1332,57 @@ class MongoDriverPM2(DriverInterface):
             close_conn_after_done = True
         self.connect()
         self.select_collection(collection)
-        query_results = self.get_records_by_query(query, fields)
+        query_results = self.get_records_by_query(query, fields, limit, self._get_sort_expression(order_by))
 
         if close_conn_after_done:
             self.disconnect()
         else:
             self.select_collection(original_collection)
         for q in query_results:
-            record = dict()
-            for x in self._split_results(q):
-                record[x[0]] = x[1]
-            rr = ResultRow(record)
-            rs.add_row(rr)
+            rs.add_record(dict(self._split_results(q)))
         return rs
 
-    def build_queries(self, query_model, patients_repository, ehr_repository, query_params=None):
+    def _run_aql_pipeline(self, query, fields, aliases, collection, limit=0, order_by=None):
+        rs = ResultSet()
+        for path, alias in aliases.iteritems():
+            rs.add_column_definition(ResultColumnDef(alias, path))
+        if self.is_connected:
+            original_collection = self.collection_name
+            close_conn_after_done = False
+        else:
+            close_conn_after_done = True
+        self.connect()
+        self.select_collection(collection)
+        try:
+            for row in self._iter_pipeline_rows(query, fields, limit, order_by=order_by):
+                rs.add_record(row)
+        finally:
+            if close_conn_after_done:
+                self.disconnect()
+            else:
+                self.select_collection(original_collection)
+        return rs
+
+    def _iter_aql_query(self, query, fields, limit=0, batch_size=None, order_by=None):
+        self.logger.debug("Streaming query\n%s\nwith filters\n%s", query, fields)
+        self._check_connection()
+        if self.query_engine == 'aggregate':
+            for row in self._iter_pipeline_rows(query, fields, limit, batch_size, order_by):
+                yield row
+            return
+        cursor = self.collection.find(query, fields, limit=limit, sort=self._get_sort_expression(order_by))
+        if batch_size:
+            cursor.batch_size(batch_size)
+        try:
+            for q in cursor:
+                yield dict(self._split_results(decode_dict(q)))
+        finally:
+            cursor.close()
+
+    def build_queries(self, query_model, patients_repository, ehr_repository, query_params=None,
+                      structures_mapping=None):
         return super(MongoDriverPM2, self).build_queries(query_model, patients_repository, ehr_repository,
-                                                      query_params)
+                                                      query_params, structures_mapping)
 
     def _get_query_hash(self, query):
         return super(MongoDriverPM2, self)._get_query_hash(query)
@@ -949,33 +1429,172 @@ class MongoDriverPM2(DriverInterface):
         sel_map, queries_map = self._get_selection_maps(queries)
         for sel_hash, mapped_queries in queries_map.iteritems():
             condition = {'$or': [q['condition'] for q in mapped_queries]}
-            aggregated_queries.append({
+            aggregated_query = {
                 'condition': condition,
                 'aliases': mapped_queries[0]['aliases'],
                 'selection': sel_map[sel_hash]
-            })
+            }
+            for key in ('aggregation', 'order_by'):
+                if key in mapped_queries[0]:
+                    aggregated_query[key] = mapped_queries[0][key]
+            aggregated_queries.append(aggregated_query)
         return aggregated_queries
 
-    def _find_by_aql_queries(self, queries, ehr_repository, query_processes):
+    def _get_queries_runner(self, ehr_repository):
+        return MultiprocessQueryRunnerPM2(self.host, self.database_name, ehr_repository,
+                                          self.port, self.user, self.passwd, self.query_engine)
+
+    def _find_by_aql_queries(self, queries, ehr_repository, query_processes, limit=0, executor=None):
         if len(queries) > 1:
             queries = self._aggregate_queries_by_selection(queries)
+        # sorted results of more queries are merged, each query must fetch up to limit results
+        ordered = len(queries) > 1 and 'order_by' in queries[0]
         total_results = ResultSet()
+        sorted_results = list()
         if query_processes == 1 or len(queries) == 1:
             for query in queries:
+                query_limit = limit - total_results.total_results if limit and not ordered else limit
                 results = self._run_aql_query(query=query['condition'], fields=query['selection'],
-                                              aliases=query['aliases'], collection=ehr_repository)
+                                              aliases=query['aliases'], collection=ehr_repository,
+                                              limit=query_limit, order_by=query.get('order_by'))
+                if ordered:
+                    sorted_results.append(results)
+                    continue
                 total_results.extend(results)
+                if limit and total_results.total_results >= limit:
+                    break
         else:
-            queries_pool = Pool(query_processes)
-            results = queries_pool.imap_unordered(
-                MultiprocessQueryRunnerPM2(self.host, self.database_name,
-                                        ehr_repository, self.port, self.user, self.passwd),
-                queries
-            )
-            for r in results:
-                total_results.extend(r)
+            if limit:
+                queries = [dict(q, limit=limit) for q in queries]
+            results = self._map_queries(self._get_queries_runner(ehr_repository), queries,
+                                        query_processes, executor, ordered)
+            if ordered:
+                sorted_results = list(results)
+            else:
+                for r in results:
+                    total_results.extend(r)
+                if limit:
+                    total_results.truncate(limit)
+        if ordered:
+            total_results = self._merge_sorted_result_sets(zip(sorted_results, [q['order_by'] for q in queries]),
+                                                           limit)
         return total_results
 
+    def _stream_aql_queries(self, queries, ehr_repository, limit, batch_size):
+        if self.is_connected:
+            original_collection = self.collection_name
+            close_conn_after_done = False
+        else:
+            close_conn_after_done = True
+        self.connect()
+        self.select_collection(ehr_repository)
+        try:
+            if len(queries) > 1 and 'order_by' in queries[0]:
+                streams = [(self._iter_aql_query(q['condition'], q['selection'], limit, batch_size, q['order_by']),
+                            q['order_by']) for q in queries]
+                for record in islice(self._merge_sorted_records(streams), limit or None):
+                    yield record
+            else:
+                fetched = 0
+                for query in queries:
+                    query_limit = limit - fetched if limit else 0
+                    for record in self._iter_aql_query(query['condition'], query['selection'],
+                                                       query_limit, batch_size, query.get('order_by')):
+                        yield record
+                        fetched += 1
+                    if limit and fetched >= limit:
+                        break
+        finally:
+            if close_conn_after_done:
+                self.disconnect()
+            else:
+                self.select_collection(original_collection)
+
+    def _build_aggregation_pipeline(self, query, aggregation):
+        fields_keys = dict()
+        projection = dict()
+
+        def map_field(field):
+            if field not in fields_keys:
+                # project fields to keys without dots that can be used in the $group stage
+                fields_keys[field] = 'f%d' % len(fields_keys)
+                projection[fields_keys[field]] = '$%s' % field
+            return '$%s' % fields_keys[field]
+
+        group_id = dict()
+        for i, (_, field) in enumerate(aggregation['group_by']):
+            group_id['g%d' % i] = map_field(field)
+        group = {'_id': group_id or None}
+        for i, (_, function, field) in enumerate(aggregation['functions']):
+            key = 'a%d' % i
+            if field is None:
+                group[key] = {'$sum': 1}
+                continue
+            value = map_field(field)
+            not_null_counter = {'$sum': {'$cond': [{'$gt': [value, None]}, 1, 0]}}
+            if function == 'COUNT':
+                group[key] = not_null_counter
+            elif function == 'AVG':
+                group[key] = {'$sum': value}
+                group['%s_count' % key] = not_null_counter
+            else:
+                group[key] = {'$%s' % function.lower(): value}
+        # lists are unwound on the original paths before projecting the fields, as for
+        # queries, so that values of the same list element are aggregated together
+        pipeline = [{'$match': query}]
+        pipeline.extend(self._get_unwind_stages(query, fields_keys.keys()))
+        if projection:
+            projection['_id'] = 0
+            pipeline.append({'$project': projection})
+        pipeline.append({'$group': group})
+        return pipeline
+
+    def _decode_aggregation_result(self, result, aggregation):
+        result = decode_dict(result)
+        # $group leaves fields missing from the records out of the _id, they make a null group
+        group_id = result['_id'] or {}
+        group_values = tuple(group_id.get('g%d' % i) for i in xrange(len(aggregation['group_by'])))
+        values = dict()
+        for i, (alias, function, _) in enumerate(aggregation['functions']):
+            if function == 'AVG':
+                values[alias] = [result['a%d' % i], result['a%d_count' % i]]
+            else:
+                values[alias] = result['a%d' % i]
+        return group_values, values
+
+    def _run_aggregation_pipeline(self, pipeline, batch_size=None):
+        self.logger.debug("Running aggregation pipeline\n%s", pipeline)
+        cursor = {'batchSize': batch_size} if batch_size else {}
+        results = self.collection.aggregate(pipeline, cursor=cursor, allowDiskUse=True)
+        if isinstance(results, dict):
+            # servers that don't support cursors return a single document
+            results = results['result']
+        return results
+
+    def _aggregate_by_aql_queries(self, queries, ehr_repository, limit=0):
+        if len(queries) > 1:
+            queries = self._aggregate_queries_by_selection(queries)
+        if self.is_connected:
+            original_collection = self.collection_name
+            close_conn_after_done = False
+        else:
+            close_conn_after_done = True
+        self.connect()
+        self.select_collection(ehr_repository)
+        partial_results = list()
+        try:
+            for query in queries:
+                pipeline = self._build_aggregation_pipeline(query['condition'], query['aggregation'])
+                for r in self._run_aggregation_pipeline(pipeline):
+                    partial_results.append(self._decode_aggregation_result(r, query['aggregation']))
+        finally:
+            if close_conn_after_done:
+                self.disconnect()
+            else:
+                self.select_collection(original_collection)
+        return self._merge_aggregation_results(queries[0]['aggregation'], partial_results, limit,
+                                               queries[0].get('order_by'))
+
     def _count_by_aql_queries(self, queries, ehr_repository):
         if self.is_connected:
             original_collection = self.collection_name
@@ -994,6 +1613,68 @@ class MongoDriverPM2(DriverInterface):
             self.select_collection(original_collection)
         return results_counter
 
+    def compile_query(self, query_model, patients_repository, ehr_repository, query_params=None,
+                      structures_mapping=None):
+        """
+        Translate a query parsed with the :class:`pyehr.aql.parser.Parser` object into a list of
+        MongoDB queries that can be executed with the :meth:`run_compiled_query` method.
+
+        :param query_model: the :class:`pyehr.aql.parser.QueryModel` obtained when the query
+                            is parsed
+        :type: :class:`pyehr.aql.parser.QueryModel`
+        :param query_params: a dictionary containing query's parameters and their values
+        :type: dictionary
+        :param structures_mapping: the structures and aliases maps returned by the
+                                   :meth:`IndexService.map_aql_contains` method
+        :type structures_mapping: tuple
+        :return: a list of MongoDB queries
+        """
+        queries = self.build_queries(query_model, patients_repository, ehr_repository,
+                                     query_params, structures_mapping)
+        return self._aggregate_queries(queries)
+
+    def run_compiled_query(self, queries, ehr_repository, count_only=False, query_processes=1,
+                           limit=0, executor=None):
+        """
+        Execute a list of queries built with the :meth:`compile_query` method
+
+        :param limit: the maximum number of results, 0 means that all results will be fetched
+        :type limit: int
+        :param executor: the pool used to run queries when *query_processes* is greater than 1,
+                         if None a new pool of processes is created
+        :type executor: :class:`multiprocessing.pool.Pool`
+        :return: a :class:`pyehr.ehr.services.dbmanager.querymanager.query.ResultSet` object
+                 containing results for the given queries or the number of matching records
+                 if count_only is True
+        """
+        if queries and 'aggregation' in queries[0] and not count_only:
+            return self._aggregate_by_aql_queries(queries, ehr_repository, limit)
+        elif not count_only:
+            return self._find_by_aql_queries(queries, ehr_repository, query_processes, limit, executor)
+        else:
+            return self._count_by_aql_queries([aq['condition'] for aq in queries],
+                                              ehr_repository)
+
+    def stream_compiled_query(self, queries, ehr_repository, limit=0, batch_size=None):
+        """
+        Execute a list of queries built with the :meth:`compile_query` method fetching results
+        from MongoDB cursors only when they are consumed
+
+        :param limit: the maximum number of results, 0 means that all results will be fetched
+        :type limit: int
+        :param batch_size: the number of records retrieved with each round trip to the server,
+                           if None MongoDB default is used
+        :type batch_size: int
+        :return: a :class:`pyehr.ehr.services.dbmanager.querymanager.results_wrappers.StreamingResultSet`
+        """
+        if len(queries) > 1:
+            queries = self._aggregate_queries_by_selection(queries)
+        aliases = dict()
+        for query in queries:
+            aliases.update(query['aliases'])
+        return StreamingResultSet(self._stream_aql_queries(queries, ehr_repository, limit, batch_size),
+                                  aliases)
+
     def execute_query(self, query_model, patients_repository, ehr_repository,
                       query_params=None, count_only=False, query_processes=1):
         """
@@ -1009,11 +1690,7 @@ class MongoDriverPM2(DriverInterface):
         :return: a :class:`pyehr.ehr.services.dbmanager.querymanager.query.ResultSet` object
                  containing results for the given query
         """
-        queries = self.build_queries(query_model, patients_repository, ehr_repository,
-                                     query_params)
-        aggregated_queries = self._aggregate_queries(queries)
-        if not count_only:
-            return self._find_by_aql_queries(aggregated_queries, ehr_repository, query_processes)
-        else:
-            return self._count_by_aql_queries([aq['condition'] for aq in aggregated_queries],
-                                              ehr_repository)
+        aggregated_queries = self.compile_query(query_model, patients_repository, ehr_repository,
+                                                query_params)
+        return self.run_compiled_query(aggregated_queries, ehr_repository, count_only,
+                                       query_processes, max(query_model.selection.top, 0))
@@ -2,7 +2,6 @@ from mongo_pm2 import MongoDriverPM2
 import pymongo
 import pymongo.errors
 import time
-from multiprocessing import Pool
 
 from pyehr.ehr.services.dbmanager.querymanager.results_wrappers import ResultSet,\
     ResultColumnDef, ResultRow
@@ -17,22 +16,24 @@ except ImportError:
 class MultiprocessQueryRunnerPM3(object):
 
     def __init__(self, host, database, collection,
-                 port, user, passwd):
+                 port, user, passwd, query_engine='find'):
         self.host = host
         self.database = database
         self.collection_name = collection
         self.port = port
         self.user = user
         self.passwd = passwd
+        self.query_engine = query_engine
 
     def __call__(self, query_description):
         driver_instance = MongoDriverPM3(
             self.host, self.database, self.collection_name,
-            self.port, self.user, self.passwd
+            self.port, self.user, self.passwd, query_engine=self.query_engine
         )
         results = driver_instance._run_aql_query(
             query_description['condition'], query_description['selection'],
-            query_description['aliases'], self.collection_name
+            query_description['aliases'], self.collection_name,
+            query_description.get('limit', 0), query_description.get('order_by')
         )
         return results
 
@@ -43,33 +44,16 @@ class MongoDriverPM3(MongoDriverPM2):
     *collection* stored in one *database* within the server. If no *logger* object is passed to constructor, a
     new one is created.
     """
-    def connect(self):
-        """
-        Open a connection to a MongoDB server.
-        """
-        if not self.client:
-            self.logger.debug('connecting to host %s', self.host)
-            self.client = pymongo.MongoClient(self.host, self.port)
-            self.logger.debug('binding to database %s', self.database_name)
-            self.database = self.client[self.database_name]
-            if self.user:
-                self.logger.debug('authenticating with username %s', self.user)
-                self.database.authenticate(self.user, self.passwd)
-            self.logger.debug('using collection %s', self.collection_name)
-            self.collection = self.database[self.collection_name]
-        else:
-            self.logger.debug('Already connected to database %s, using collection %s',
-                              self.database_name, self.collection_name)
-
-    def disconnect(self):
-        """
-        Close a connection to a MongoDB server.
-        """
-        self.logger.debug('disconnecting from host %s', self.client.host)
-        self.client.close()
-        self.database = None
-        self.collection = None
-        self.client = None
+    def _open_client(self):
+        self.logger.debug('opening a new client for host %s', self.host)
+        client = pymongo.MongoClient(self.host, self.port)
+        if self.user:
+            self.logger.debug('authenticating with username %s', self.user)
+            client[self.database_name].authenticate(self.user, self.passwd)
+        return client
+
+    def _close_client(self, client):
+        client.close()
 
     def add_record(self, record):
         """
@@ -102,9 +86,10 @@ class MongoDriverPM3(MongoDriverPM2):
             return [],[]
         self._check_batch(records, '_id')
         self._check_connection()
-        records_map = {r['_id']: r for r in records}
-        duplicated_ids = [x['_id'] for x in self.get_records_by_query({'_id': {'$in': records_map.keys()}},
-                                                                      {'_id': True})]
+        records_map = {self._get_batch_key(r['_id']): r for r in records}
+        duplicated_ids = [self._get_batch_key(x['_id']) for x in
+                          self.get_records_by_query({'_id': {'$in': [r['_id'] for r in records]}},
+                                                    {'_id': True})]
         if len(duplicated_ids) > 0 and not skip_existing_duplicated:
             raise DuplicatedKeyError('The following IDs are already in use: %s' % duplicated_ids)
         try:
@@ -130,6 +115,14 @@ class MongoDriverPM3(MongoDriverPM2):
         res = self.collection.update_one({'_id': record_id}, update_condition)
         self.logger.debug('updated %d documents', res.modified_count)
 
+    def _update_records(self, selector, update_condition):
+        self._check_connection()
+        self.logger.debug('Updating records matching %r, with condition %r', selector,
+                          update_condition)
+        res = self.collection.update_many(selector, update_condition)
+        self.logger.debug('updated %d documents', res.modified_count)
+        return res.modified_count
+
     def delete_record(self, record_id):
         """
         Delete an existing record
@@ -180,25 +173,27 @@ class MongoDriverPM3(MongoDriverPM2):
         self.collection.replace_one({"_id" : record_id}, new_record)
         return last_update
 
-    def _find_by_aql_queries(self, queries, ehr_repository, query_processes):
-        if len(queries) > 1:
-            queries = self._aggregate_queries_by_selection(queries)
-        total_results = ResultSet()
-        if query_processes == 1 or len(queries) == 1:
-            for query in queries:
-                results = self._run_aql_query(query=query['condition'], fields=query['selection'],
-                                              aliases=query['aliases'], collection=ehr_repository)
-                total_results.extend(results)
-        else:
-            queries_pool = Pool(query_processes)
-            results = queries_pool.imap_unordered(
-                MultiprocessQueryRunnerPM3(self.host, self.database_name,
-                                        ehr_repository, self.port, self.user, self.passwd),
-                queries
-            )
-            for r in results:
-                total_results.extend(r)
-        return total_results
+    def _find_and_replace(self, selector, new_record):
+        return self.collection.find_one_and_replace(selector, new_record,
+                                                    return_document=pymongo.ReturnDocument.BEFORE)
+
+    def _find_and_update(self, selector, update_statement):
+        return self.collection.find_one_and_update(selector, update_statement,
+                                                   return_document=pymongo.ReturnDocument.BEFORE)
+
+    def _get_queries_runner(self, ehr_repository):
+        return MultiprocessQueryRunnerPM3(self.host, self.database_name, ehr_repository,
+                                          self.port, self.user, self.passwd, self.query_engine)
+
+    def _get_unwind_stage(self, path):
+        # keep the records without the list, like the find engine does
+        return {'$unwind': {'path': '$%s' % path, 'preserveNullAndEmptyArrays': True}}
+
+    def _run_aggregation_pipeline(self, pipeline, batch_size=None):
+        self.logger.debug("Running aggregation pipeline\n%s", pipeline)
+        if batch_size:
+            return self.collection.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size)
+        return self.collection.aggregate(pipeline, allowDiskUse=True)
 
     def count_records_by_query(self, selector):
         """
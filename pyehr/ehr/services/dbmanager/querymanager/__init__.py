@@ -1,18 +1,46 @@
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+
 from pyehr.ehr.services.dbmanager.drivers.factory import DriversFactory
 from pyehr.utils import get_logger
+from pyehr.utils.cache import LRUCache
 from pyehr.ehr.services.dbmanager.dbservices.index_service import IndexService
+from pyehr.ehr.services.dbmanager.querymanager.prepared_queries import PreparedQuery,\
+    QueryParameters, normalize_aql_query
+from pyehr.ehr.services.dbmanager.querymanager.results_wrappers import StreamingResultSet
 from pyehr.aql.parser import Parser
 
 
 class QueryManager(object):
     """
-    TODO: add documentation here
+    Execute AQL queries over the clinical records stored in the DB.
+
+    AQL queries are compiled once and stored in a LRU cache of *queries_cache_size* elements
+    (use 0 to disable the cache) keyed on the normalized query text; a compiled query holds the
+    query model, the structures map obtained from the :class:`IndexService` and the driver queries,
+    query parameters are bound when the query is executed. Compiled queries are rebuilt when
+    structures are added to or deleted from the index by the current process and, since other
+    processes can change the index as well, after *queries_cache_ttl* seconds.
+
+    Queries executed with more than one worker are distributed among the workers of a pool owned
+    by the :class:`QueryManager` and reused by all the queries, *query_executor* selects a pool of
+    threads ('thread', the default, since queries are I/O bound and drivers in the same process
+    share the connection pool) or a pool of processes ('process'). Pools are released with the
+    :meth:`close` method.
+
+    With the MongoDB driver, *query_engine* selects how queries are executed: 'find' runs find
+    queries and flattens the documents on the client, 'aggregate' runs aggregation pipelines that
+    return flat rows.
     """
 
+    EXECUTORS = ('thread', 'process')
+
     def __init__(self, driver, host, database, versioning_database=None,
                  patients_repository=None, ehr_repository=None,
                  ehr_versioning_repository=None, port=None, user=None,
-                 passwd=None, logger=None):
+                 passwd=None, logger=None, queries_cache_size=128,
+                 queries_cache_ttl=60, query_executor='thread', query_engine='find'):
         self.driver = driver
         self.host = host
         self.database = database
@@ -25,6 +53,47 @@ class QueryManager(object):
         self.passwd = passwd
         self.index_service = None
         self.logger = logger or get_logger('query_manager')
+        if queries_cache_size:
+            self.compiled_queries = LRUCache(queries_cache_size, queries_cache_ttl)
+        else:
+            self.compiled_queries = None
+        if query_executor not in self.EXECUTORS:
+            raise ValueError('Unknown query executor %s, use one of %r' % (query_executor, self.EXECUTORS))
+        self.query_executor = query_executor
+        self.query_engine = query_engine
+        self._executors = dict()
+        self._executors_lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+        return None
+
+    def _get_executor(self, workers):
+        with self._executors_lock:
+            try:
+                return self._executors[workers]
+            except KeyError:
+                self.logger.debug('Starting a %s pool with %d workers', self.query_executor, workers)
+                if self.query_executor == 'thread':
+                    executor = ThreadPool(workers)
+                else:
+                    executor = Pool(workers)
+                self._executors[workers] = executor
+                return executor
+
+    def close(self):
+        """
+        Stop the workers used to execute queries, the pools will be created again if a query
+        with more than one worker is executed
+        """
+        with self._executors_lock:
+            executors, self._executors = self._executors, dict()
+        for executor in executors.itervalues():
+            executor.close()
+            executor.join()
 
     def _get_drivers_factory(self, repository):
         return DriversFactory(
@@ -36,7 +105,8 @@ class QueryManager(object):
             user=self.user,
             passwd=self.passwd,
             index_service=self.index_service,
-            logger=self.logger
+            logger=self.logger,
+            query_engine=self.query_engine
         )
 
     def set_index_service(self, url, database, user, passwd):
@@ -54,16 +124,29 @@ class QueryManager(object):
         """
         self.index_service = IndexService(database, url, user, passwd, self.logger)
 
-    def execute_aql_query(self, query, query_params=None, count_only=False, query_processes=1):
+    def execute_aql_query(self, query, query_params=None, count_only=False, query_processes=1,
+                          streaming=False, batch_size=None):
         """
         Execute an AQL query and return a :class:`pyehr.ehr.services.dbmanager.querymanager.results_wrappers.ResultSet`
         object that maps the obtained results.
         If the query has one or more parameters, they will be passed using query_params field.
+        If *streaming* is True, a :class:`pyehr.ehr.services.dbmanager.querymanager.results_wrappers.StreamingResultSet`
+        is returned instead, results will be fetched from the DB, *batch_size* at a time, while they are consumed.
+        A TOP clause in the query limits the number of results fetched from the DB, aggregate functions
+        and GROUP BY clauses are computed by the DB and only the aggregated rows are returned.
 
         :param query: an AQL query
         :type query: str
         :param query_params: a dictionary containing query parameters as keys and their values
         :type query_params: dict
+        :param query_processes: the number of workers used to run the queries built for the different
+                                structures matching the query
+        :type query_processes: int
+        :param streaming: return a result set that lazily fetches the results
+        :type streaming: bool
+        :param batch_size: the number of results fetched with each round trip to the DB when
+                           *streaming* is True, if None the default of the driver is used
+        :type batch_size: int
         :return: a :class:`pyehr.ehr.services.dbmanager.querymanager.results_wrappers.ResultSet` object
         """
         if query_params:
@@ -72,11 +155,39 @@ class QueryManager(object):
             # add the $ character to the keys in query_params that don't begin with it
             query_params = dict(('$%s' % k if not k.startswith('$') else k, v)
                                 for k, v in query_params.iteritems())
+        driver = self._get_drivers_factory(self.ehr_repository).get_driver()
+        prepared_query = self._prepare_query(query, driver)
+        queries = prepared_query.bind(query_params)
+        if streaming and not count_only and not prepared_query.query_model.selection.aggregated:
+            # the driver connects when the first result is requested and disconnects when
+            # the result set is exhausted or closed
+            return driver.stream_compiled_query(queries, self.ehr_repository, prepared_query.limit, batch_size)
+        executor = self._get_executor(query_processes) if query_processes > 1 else None
+        with driver:
+            # the count_only field will be retrieved parsing AQL query
+            results_set = driver.run_compiled_query(queries, self.ehr_repository, count_only,
+                                                    query_processes, prepared_query.limit, executor)
+        if streaming and not count_only:
+            # aggregated queries only return the aggregated rows, they are already in memory
+            return StreamingResultSet(results_set.results, dict((c.alias, c.alias) for c in results_set.columns))
+        return results_set
+
+    def _prepare_query(self, query, driver):
+        query_key = normalize_aql_query(query)
+        if self.compiled_queries is not None:
+            prepared_query = self.compiled_queries.get(query_key)
+            if prepared_query and prepared_query.structures_version == IndexService.structures_version:
+                self.logger.debug('Using compiled query from cache')
+                return prepared_query
+        structures_version = IndexService.structures_version
         parser = Parser()
         query_model = parser.parse(query)
-        drf = self._get_drivers_factory(self.ehr_repository)
-        with drf.get_driver() as driver:
-            # the count_only field will be retrieved parsing AQL query
-            results_set = driver.execute_query(query_model, self.patients_repository, self.ehr_repository,
-                                               query_params, count_only, query_processes)
-        return results_set
\ No newline at end of file
+        structures_mapping = self.index_service.map_aql_contains(query_model.location.containers)
+        query_params = QueryParameters()
+        queries = driver.compile_query(query_model, self.patients_repository, self.ehr_repository,
+                                       query_params, structures_mapping)
+        prepared_query = PreparedQuery(query_model, structures_mapping, queries,
+                                       query_params.names, structures_version)
+        if self.compiled_queries is not None:
+            self.compiled_queries.set(query_key, prepared_query)
+        return prepared_query
@@ -0,0 +1,141 @@
+import re
+from copy import deepcopy
+from hashlib import md5
+
+from pyehr.ehr.services.dbmanager.errors import PredicateException
+
+
+_QUOTED_TEXT = re.compile(r'(\'[^\']*\'|"[^"]*")')
+_WHITESPACES = re.compile(r'\s+')
+
+
+def normalize_aql_query(query):
+    """
+    Normalize the text of an AQL query collapsing whitespaces that are not part of a quoted
+    string, so that the same query written on one or more lines gets the same cache key.
+
+    :param query: the AQL query
+    :type query: str
+    :return: the normalized query
+    :rtype: str
+    """
+    chunks = _QUOTED_TEXT.split(query.strip())
+    # quoted strings are the odd elements of the split
+    return ''.join(c if i % 2 else _WHITESPACES.sub(' ', c) for i, c in enumerate(chunks))
+
+
+class QueryParameters(dict):
+    """
+    A dictionary that maps every AQL query parameter to a placeholder. It is passed to the
+    drivers instead of the actual query parameters in order to build query templates, parameters
+    requested by the driver are tracked in the *names* set.
+
+    Placeholders are plain strings, so they survive the string manipulations done by drivers
+    when building queries; a lowercase copy of a placeholder is bound to the lowercase value
+    of the parameter.
+    """
+
+    def __init__(self):
+        super(QueryParameters, self).__init__()
+        self.names = set()
+
+    @staticmethod
+    def get_placeholder(parameter):
+        return '__AQL_PARAM_%s__' % md5(parameter).hexdigest().upper()
+
+    def __missing__(self, key):
+        self.names.add(key)
+        placeholder = QueryParameters.get_placeholder(key)
+        self[key] = placeholder
+        return placeholder
+
+
+def _to_text(value):
+    # parameters received as JSON are unicode strings, str() would fail on non ASCII values
+    if isinstance(value, basestring):
+        return value
+    return unicode(value)
+
+
+def _contains_text(query, text):
+    if isinstance(query, dict):
+        return any(_contains_text(k, text) or _contains_text(v, text) for k, v in query.iteritems())
+    if isinstance(query, list):
+        return any(_contains_text(x, text) for x in query)
+    return isinstance(query, basestring) and text in query
+
+
+def bind_query_params(query, placeholders_map):
+    """
+    Return a copy of *query* where placeholders are replaced by the values in
+    *placeholders_map*. A value that is exactly a placeholder is replaced by the parameter value
+    keeping its type, a placeholder contained in a longer string is replaced by the string
+    representation of the value.
+
+    :param query: the query template, dictionaries and lists are traversed recursively
+    :param placeholders_map: a map of placeholders and the values that must replace them
+    :type placeholders_map: dict
+    :return: the query with bound parameters
+    """
+    if not placeholders_map:
+        return deepcopy(query)
+    if isinstance(query, dict):
+        return dict((k, bind_query_params(v, placeholders_map)) for k, v in query.iteritems())
+    if isinstance(query, list):
+        return [bind_query_params(x, placeholders_map) for x in query]
+    if isinstance(query, basestring):
+        if query in placeholders_map:
+            return placeholders_map[query]
+        for placeholder, value in placeholders_map.iteritems():
+            if placeholder in query:
+                query = query.replace(placeholder, _to_text(value))
+        return query
+    return query
+
+
+class PreparedQuery(object):
+    """
+    An AQL query compiled for a specific driver: the :class:`pyehr.aql.model.QueryModel`, the
+    structures map obtained from the :class:`IndexService` and the driver queries built using
+    placeholders in place of query parameters. *structures_version* records the version of the
+    structures index used to build the queries.
+    """
+
+    def __init__(self, query_model, structures_mapping, queries, parameters,
+                 structures_version):
+        self.query_model = query_model
+        self.structures_mapping = structures_mapping
+        self.queries = queries
+        self.parameters = parameters
+        self.structures_version = structures_version
+        # parameters whose placeholder is lowercased by the driver while building the queries
+        self.lowercase_parameters = set(p for p in parameters if
+                                        _contains_text(queries, QueryParameters.get_placeholder(p).lower()))
+
+    @property
+    def limit(self):
+        """
+        The max number of results set with the TOP clause, 0 if the query has no TOP clause
+        """
+        return max(self.query_model.selection.top, 0)
+
+    def bind(self, query_params=None):
+        """
+        Return the driver queries with the given parameters bound
+
+        :param query_params: a dictionary containing query parameters (with the $ prefix) and their values
+        :type query_params: dict
+        :return: the driver queries ready to be executed
+        """
+        query_params = query_params or dict()
+        placeholders_map = dict()
+        for p in self.parameters:
+            try:
+                value = query_params[p]
+            except KeyError, ke:
+                raise PredicateException('Missing value for parameter %s' % ke)
+            placeholder = QueryParameters.get_placeholder(p)
+            placeholders_map[placeholder] = value
+            if p in self.lowercase_parameters:
+                placeholders_map[placeholder.lower()] = _to_text(value).lower()
+        return bind_query_params(self.queries, placeholders_map)
@@ -1,3 +1,5 @@
+from itertools import islice, izip
+
 from pyehr.ehr.services.dbmanager.errors import InvalidFieldError
 
 
@@ -29,13 +31,36 @@ class ResultRow(object):
             return False
 
 
+class _MissingValue(object):
+    """
+    Marks the cells of a column for rows that have no value for that column
+    """
+
+    def __reduce__(self):
+        # keep a single instance when result sets are pickled to be sent among processes
+        return 'MISSING'
+
+    def __repr__(self):
+        return 'MISSING'
+
+MISSING = _MissingValue()
+
+
 class ResultSet(object):
+    """
+    Results of a query stored by column: each column is a list with one value for every row
+    of the result set (:data:`MISSING` if the row has no value for the column) and is indexed by the
+    path of the record it was extracted from. Paths are mapped to the aliases of the columns used
+    in the results, more paths can share the same alias.
+    """
 
     def __init__(self):
         self.name = None
         self.total_results = 0
         self.columns = []
-        self.rows = []
+        self._aliases = {}
+        self._paths = {}
+        self._columns_data = {}
 
     def to_json(self, add_columns_json=False):
         json_res = {
@@ -47,37 +72,189 @@ class ResultSet(object):
         return json_res
 
     def _get_alias(self, key):
-        for col in self.columns:
-            if col.path == key:
-                return col.alias
-        raise KeyError('Can\'t map key %s' % key)
+        try:
+            return self._aliases[key]
+        except KeyError:
+            raise KeyError('Can\'t map key %s' % key)
 
     def __str__(self):
         return str(self.to_json())
 
+    def _get_column_data(self, path):
+        try:
+            return self._columns_data[path]
+        except KeyError:
+            column = self._columns_data[path] = [MISSING] * self.total_results
+            return column
+
     def extend(self, result_set):
-        self.total_results += result_set.total_results
-        self.rows += result_set.rows
         for c in result_set.columns:
-            if c not in self.columns:
-                self.columns.append(c)
+            self.add_column_definition(c)
+        for path, values in result_set._columns_data.iteritems():
+            column = self._get_column_data(path)
+            column.extend(values)
+        for path, column in self._columns_data.iteritems():
+            if path not in result_set._columns_data:
+                column.extend([MISSING] * result_set.total_results)
+        self.total_results += result_set.total_results
 
     def add_column_definition(self, colum_def):
-        if colum_def not in self.columns:
+        if colum_def.path not in self._aliases:
+            self._aliases[colum_def.path] = colum_def.alias
+            self._paths.setdefault(colum_def.alias, []).append(colum_def.path)
+            self.columns.append(colum_def)
+        elif self._aliases[colum_def.path] != colum_def.alias and colum_def not in self.columns:
+            # the path is already mapped, the first alias is the one used for the results
             self.columns.append(colum_def)
 
-    def add_row(self, row):
-        self.rows.append(row)
+    def add_record(self, record):
+        """
+        Add a row to the result set, *record* maps the paths of the row to their values
+        """
+        for path, value in record.iteritems():
+            column = self._get_column_data(path)
+            column.append(value)
         self.total_results += 1
+        if len(record) < len(self._columns_data):
+            for column in self._columns_data.itervalues():
+                if len(column) < self.total_results:
+                    column.append(MISSING)
+
+    def add_row(self, row):
+        self.add_record(row.record)
+
+    def truncate(self, size):
+        """
+        Keep only the first *size* rows of the result set
+        """
+        for column in self._columns_data.itervalues():
+            del column[size:]
+        self.total_results = min(self.total_results, size)
+
+    def _iter_records(self, columns):
+        keys = [k for k, _ in columns]
+        for values in izip(*[c for _, c in columns]):
+            yield dict((k, v) for k, v in izip(keys, values) if v is not MISSING)
+
+    @property
+    def records(self):
+        """
+        Iterate over the rows of the result set as dictionaries that map paths to values
+        """
+        if not self._columns_data:
+            return (dict() for _ in xrange(self.total_results))
+        return self._iter_records(self._columns_data.items())
+
+    @property
+    def rows(self):
+        """
+        The rows of the result set as :class:`ResultRow` objects
+        """
+        return [ResultRow(r) for r in self.records]
 
     @property
     def results(self):
-        for r in self.rows:
-            yield {self._get_alias(k): v for k, v in r.record.iteritems()}
+        columns = [(self._get_alias(path), column) for path, column in self._columns_data.iteritems()]
+        if not columns:
+            for _ in xrange(self.total_results):
+                yield dict()
+        else:
+            for r in self._iter_records(columns):
+                yield r
+
+    def get_column(self, field):
+        """
+        Return the values of the column with alias *field*, rows with no value for the column
+        are skipped
+
+        :param field: the alias of the column
+        :type field: str
+        :return: the values of the column
+        :rtype: list
+        """
+        columns = [self._columns_data[p] for p in self._paths.get(field, []) if p in self._columns_data]
+        if not columns:
+            if field in self._paths and self.total_results == 0:
+                return []
+            raise InvalidFieldError('There is no field "%s" in this results set' % field)
+        if len(columns) == 1:
+            return [v for v in columns[0] if v is not MISSING]
+        values = list()
+        for row_values in izip(*columns):
+            for v in row_values:
+                if v is not MISSING:
+                    values.append(v)
+                    break
+        return values
 
     def get_distinct_results(self, field):
+        for x in set(self.get_column(field)):
+            yield x
+
+
+class StreamingResultSet(object):
+    """
+    A result set that lazily fetches rows from the backend server. *records* is an iterator
+    over the records returned by the driver, already split into path/value maps, that is consumed
+    only when results are requested; *aliases* maps record paths to the aliases of the columns.
+    The iterator keeps a connection to the backend server open until all the results are fetched
+    or the result set is closed.
+    """
+
+    def __init__(self, records, aliases):
+        self.name = None
+        self.total_results = 0
+        self.aliases = dict(aliases)
+        self.columns = [ResultColumnDef(alias, path) for path, alias in self.aliases.iteritems()]
+        self._records = records
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+        return None
+
+    def next(self):
+        if self.closed:
+            raise StopIteration()
         try:
-            for x in set([r[field] for r in self.results]):
-                yield x
-        except KeyError:
-            raise InvalidFieldError('There is no field "%s" in this results set' % field)
\ No newline at end of file
+            record = next(self._records)
+        except StopIteration:
+            self.close()
+            raise
+        self.total_results += 1
+        try:
+            return dict((self.aliases[k], v) for k, v in record.iteritems())
+        except KeyError, ke:
+            raise KeyError('Can\'t map key %s' % ke)
+
+    @property
+    def results(self):
+        return iter(self)
+
+    def fetch_many(self, size):
+        """
+        Return a list with the next *size* results, the list will be shorter than *size* (or
+        empty) if there are no more results to fetch
+
+        :param size: the number of results that will be fetched
+        :type size: int
+        :return: a list of results
+        :rtype: list
+        """
+        return list(islice(self, size))
+
+    def close(self):
+        """
+        Stop fetching results and release the connection to the backend server
+        """
+        if not self.closed:
+            self.closed = True
+            close = getattr(self._records, 'close', None)
+            if close:
+                close()
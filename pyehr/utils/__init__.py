@@ -46,12 +46,14 @@ def decode_list(data):
     return decoded
 
 
-def decode_dict(data):
+def decode_dict(data, skip_keys=()):
     """
     Transforms UNICODE in dictionary (both in keys and values) into strings
 
     :param data: the dictionary with unicode that must be converted
     :type data: dictionary
+    :param skip_keys: keys of the dictionary whose values are copied without being converted
+    :type skip_keys: list
     :return: the dictionary with unicode replaced by strings
     :rtype: dictionary
     """
@@ -59,7 +61,9 @@ def decode_dict(data):
     for key, val in data.iteritems():
         if isinstance(key, unicode):
             key = key.encode('utf-8')
-        if isinstance(val, unicode):
+        if key in skip_keys:
+            pass
+        elif isinstance(val, unicode):
             val = val.encode('utf-8')
         elif isinstance(val, collections.MutableSequence):
             val = decode_list(val)
@@ -98,3 +102,55 @@ def cleanup_json(data):
     if len(cleaned_data) == 0:
         return None
     return cleaned_data
+
+
+def build_merge_patch(source, target):
+    """
+    Build a JSON merge patch (RFC 7396) that transforms the *source* dictionary into the
+    *target* one. Lists are replaced as a whole and a None value in the patch removes a key,
+    so None values of *target* are not preserved.
+
+    :param source: the original dictionary
+    :type source: dictionary
+    :param target: the dictionary obtained applying the patch
+    :type target: dictionary
+    :return: the patch, an empty dictionary if *source* and *target* are equal
+    :rtype: dictionary
+    """
+    patch = {}
+    for k in source:
+        if k not in target:
+            patch[k] = None
+    for k, v in target.iteritems():
+        if k not in source:
+            patch[k] = v
+        elif source[k] != v:
+            if isinstance(v, collections.Mapping) and isinstance(source[k], collections.Mapping):
+                patch[k] = build_merge_patch(source[k], v)
+            else:
+                patch[k] = v
+    return patch
+
+
+def apply_merge_patch(document, patch):
+    """
+    Apply a JSON merge patch (RFC 7396) to the given dictionary, the dictionary is not
+    modified and the parts that are not touched by the patch are shared with the result
+
+    :param document: the dictionary that is going to be patched
+    :type document: dictionary
+    :param patch: the patch, as built by :func:`build_merge_patch`
+    :type patch: dictionary
+    :return: the patched dictionary
+    :rtype: dictionary
+    """
+    patched = dict(document)
+    for k, v in patch.iteritems():
+        if v is None:
+            patched.pop(k, None)
+        elif isinstance(v, collections.Mapping):
+            original = patched.get(k)
+            patched[k] = apply_merge_patch(original if isinstance(original, collections.Mapping) else {}, v)
+        else:
+            patched[k] = v
+    return patched
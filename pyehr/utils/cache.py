@@ -0,0 +1,73 @@
+import time
+from collections import OrderedDict
+from threading import RLock
+
+
+class LRUCache(object):
+    """
+    A thread safe, bounded, least recently used cache. When the cache holds *max_size*
+    elements, adding a new key removes the least recently used one. If *ttl* is not None,
+    elements older than *ttl* seconds are considered expired and are never returned.
+    """
+
+    def __init__(self, max_size=128, ttl=None):
+        if max_size < 1:
+            raise ValueError('max_size must be an integer greater than 0')
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def _is_expired(self, timestamp):
+        return self.ttl is not None and (time.time() - timestamp) > self.ttl
+
+    def get(self, key, default=None):
+        """
+        Return the value stored for *key* or *default* if the key is missing or expired
+        """
+        with self._lock:
+            try:
+                value, timestamp = self._data.pop(key)
+            except KeyError:
+                return default
+            if self._is_expired(timestamp):
+                return default
+            # move the key at the end of the queue, it is now the most recently used
+            self._data[key] = (value, timestamp)
+            return value
+
+    def set(self, key, value):
+        """
+        Store *value* for the given *key*, removing the least recently used element if
+        the cache is full
+        """
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time())
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        """
+        Remove *key* from the cache
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def invalidate_value(self, value):
+        """
+        Remove all the keys mapped to *value* from the cache
+        """
+        with self._lock:
+            for k in [k for k, (v, _) in self._data.iteritems() if v == value]:
+                del self._data[k]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
@@ -0,0 +1,67 @@
+import importlib
+
+# JSON libraries in order of preference, C accelerated ones first. Libraries must produce the
+# same output as the standard json module, ujson is not supported because it rounds floats
+# to 9 decimal digits and escapes forward slashes by default
+JSON_LIBRARIES = ('simplejson', 'json')
+
+
+def _load_json_library(names):
+    for name in names:
+        try:
+            return importlib.import_module(name)
+        except ImportError:
+            pass
+    raise ImportError('None of the following JSON libraries is available: %s' % ', '.join(names))
+
+_json = _load_json_library(JSON_LIBRARIES)
+
+
+def get_json_library():
+    """
+    Get the name of the library used to encode and decode JSON documents
+
+    :return: the name of the library
+    :rtype: str
+    """
+    return _json.__name__
+
+
+def set_json_library(name):
+    """
+    Use the given library to encode and decode JSON documents, the library must be one of
+    JSON_LIBRARIES
+
+    :param name: the name of the library
+    :type name: str
+    """
+    global _json
+    if name not in JSON_LIBRARIES:
+        raise ValueError('Unsupported JSON library %s, allowed values are %s' %
+                         (name, ', '.join(JSON_LIBRARIES)))
+    _json = _load_json_library([name])
+
+
+def dumps(obj, sort_keys=False):
+    """
+    Encode *obj* as a JSON string using the fastest available library
+
+    :param obj: the object to encode
+    :param sort_keys: if True, dictionary keys are sorted and equal objects are always
+      encoded as the same string
+    :type sort_keys: bool
+    :return: the JSON string
+    :rtype: str
+    """
+    return _json.dumps(obj, sort_keys=sort_keys)
+
+
+def loads(json_data):
+    """
+    Decode the given JSON string using the fastest available library
+
+    :param json_data: the JSON string
+    :type json_data: str
+    :return: the decoded object
+    """
+    return _json.loads(json_data)
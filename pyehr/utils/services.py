@@ -11,7 +11,11 @@ class ServiceConfig(object):
                  db_ehr_repository, db_ehr_versioning_repository,
                  index_url, index_database, index_user, index_passwd,
                  db_service_host, db_service_port, db_service_server_engine,
-                 query_service_host, query_service_port, query_service_server_engine):
+                 query_service_host, query_service_port, query_service_server_engine,
+                 db_service_workers=10, db_service_max_queue=100,
+                 query_service_workers=10, query_service_max_queue=100,
+                 connection_pool_max_size=None, connection_pool_max_idle_time=None,
+                 connection_pool_health_check_interval=None):
         self.db_driver = db_driver
         self.db_host = db_host
         self.db_database = db_database
@@ -32,6 +36,16 @@ class ServiceConfig(object):
         self.query_service_host = query_service_host
         self.query_service_port = query_service_port
         self.query_service_server_engine = query_service_server_engine
+        # used only by the 'threadpool' server engine
+        self.db_service_workers = int(db_service_workers)
+        self.db_service_max_queue = int(db_service_max_queue)
+        self.query_service_workers = int(query_service_workers)
+        self.query_service_max_queue = int(query_service_max_queue)
+        # settings of the pool of database clients, None keeps the pool's default
+        self.connection_pool_max_size = _to_int(connection_pool_max_size)
+        self.connection_pool_max_idle_time = _to_int(connection_pool_max_idle_time)
+        self.connection_pool_health_check_interval = \
+            _to_int(connection_pool_health_check_interval)
 
     def get_db_configuration(self):
         return {
@@ -59,16 +73,39 @@ class ServiceConfig(object):
         return {
             'host': self.db_service_host,
             'port': self.db_service_port,
-            'engine': self.db_service_server_engine
+            'engine': self.db_service_server_engine,
+            'workers': self.db_service_workers,
+            'max_queue': self.db_service_max_queue
         }
 
     def get_query_service_configuration(self):
         return {
             'host': self.query_service_host,
             'port': self.query_service_port,
-            'engine': self.query_service_server_engine
+            'engine': self.query_service_server_engine,
+            'workers': self.query_service_workers,
+            'max_queue': self.query_service_max_queue
         }
 
+    def get_connection_pool_configuration(self):
+        return {
+            'max_size': self.connection_pool_max_size,
+            'max_idle_time': self.connection_pool_max_idle_time,
+            'health_check_interval': self.connection_pool_health_check_interval
+        }
+
+
+def _to_int(value):
+    if value is None:
+        return None
+    return int(value)
+
+
+def _get_optional(parser, section, option, default):
+    if parser.has_option(section, option) and parser.get(section, option):
+        return parser.get(section, option)
+    return default
+
 
 def get_service_configuration(configuration_file, logger=None):
     if not logger:
@@ -96,7 +133,14 @@ def get_service_configuration(configuration_file, logger=None):
             parser.get('db_service', 'server_engine'),
             parser.get('query_service', 'host'),
             parser.get('query_service', 'port'),
-            parser.get('query_service', 'server_engine')
+            parser.get('query_service', 'server_engine'),
+            _get_optional(parser, 'db_service', 'workers', 10),
+            _get_optional(parser, 'db_service', 'max_queue', 100),
+            _get_optional(parser, 'query_service', 'workers', 10),
+            _get_optional(parser, 'query_service', 'max_queue', 100),
+            _get_optional(parser, 'connection_pool', 'max_size', None),
+            _get_optional(parser, 'connection_pool', 'max_idle_time', None),
+            _get_optional(parser, 'connection_pool', 'health_check_interval', None)
         )
         return conf
     except NoOptionError, nopt:
@@ -0,0 +1,124 @@
+import json
+from Queue import Queue, Full
+from threading import Thread
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+from bottle import ServerAdapter
+
+# the name of the server engine that serves requests with a pool of threads
+THREAD_POOL_ENGINE = 'threadpool'
+# seconds spent reading a request that is going to be rejected
+REJECT_TIMEOUT = 0.1
+
+BUSY_RESPONSE_BODY = json.dumps({
+    'SUCCESS': False,
+    'ERROR': 'Server is busy, try again later'
+})
+BUSY_RESPONSE = (
+    'HTTP/1.0 503 Service Unavailable\r\n'
+    'Content-Type: application/json\r\n'
+    'Content-Length: %d\r\n'
+    'Retry-After: 1\r\n'
+    'Connection: close\r\n'
+    '\r\n'
+    '%s'
+) % (len(BUSY_RESPONSE_BODY), BUSY_RESPONSE_BODY)
+
+
+class ThreadPoolWSGIServer(WSGIServer):
+    """
+    A WSGI server that handles requests with a fixed number of worker threads. Accepted
+    connections wait in a queue of *max_queue* elements, when the queue is full new
+    connections are immediately answered with a 503 error, so that slow requests can't make
+    clients pile up in the server.
+    """
+
+    def __init__(self, server_address, request_handler_class, workers=10, max_queue=100):
+        if workers < 1:
+            raise ValueError('workers must be an integer greater than 0')
+        if max_queue < 1:
+            raise ValueError('max_queue must be an integer greater than 0')
+        self.request_queue_size = max_queue
+        WSGIServer.__init__(self, server_address, request_handler_class)
+        self.workers = workers
+        self.requests_queue = Queue(max_queue)
+        self.threads = []
+        for _ in xrange(workers):
+            t = Thread(target=self._process_requests)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def _process_requests(self):
+        while True:
+            request, client_address = self.requests_queue.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                self.requests_queue.task_done()
+
+    def _reject_request(self, request):
+        # the request is read before answering, closing a socket with unread data would
+        # reset the connection before the client gets the response
+        try:
+            request.settimeout(REJECT_TIMEOUT)
+            request.recv(65536)
+            request.sendall(BUSY_RESPONSE)
+        except IOError:
+            pass
+        self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        try:
+            self.requests_queue.put_nowait((request, client_address))
+        except Full:
+            self._reject_request(request)
+
+
+class ThreadPoolServer(ServerAdapter):
+    """
+    A bottle server adapter for the :class:`ThreadPoolWSGIServer`, the *workers* and *max_queue*
+    options set the number of worker threads and the number of connections that can wait for
+    a worker
+    """
+
+    def run(self, handler):
+        quiet = self.quiet
+
+        class RequestHandler(WSGIRequestHandler):
+            def address_string(self):
+                return self.client_address[0]
+
+            def log_request(self, *args, **kwargs):
+                if not quiet:
+                    return WSGIRequestHandler.log_request(self, *args, **kwargs)
+
+        srv = ThreadPoolWSGIServer((self.host, self.port), RequestHandler,
+                                   int(self.options.get('workers', 10)),
+                                   int(self.options.get('max_queue', 100)))
+        srv.set_app(handler)
+        srv.serve_forever()
+
+
+def get_server(engine, host, port, workers=10, max_queue=100):
+    """
+    Get the server that will be passed to bottle's run function, *workers* and *max_queue*
+    are used only by the 'threadpool' engine, any other engine is returned as it is and
+    must be one of the servers supported by bottle
+
+    :param engine: the name of the server engine
+    :type engine: str
+    :param host: the address the server will listen on
+    :param port: the port the server will listen on
+    :param workers: the number of threads serving requests
+    :type workers: int
+    :param max_queue: the number of connections that can wait for a free worker
+    :type max_queue: int
+    :return: a :class:`ThreadPoolServer` or the name of the engine
+    """
+    if engine == THREAD_POOL_ENGINE:
+        return ThreadPoolServer(host=host, port=int(port), workers=workers, max_queue=max_queue)
+    return engine
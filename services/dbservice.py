@@ -5,6 +5,8 @@ from bottle import post, get, put, delete, run, response, request,\
     abort, HTTPError
 
 from pyehr.utils import get_logger
+from pyehr.utils.wsgi import get_server, THREAD_POOL_ENGINE
+from pyehr.ehr.services.dbmanager.drivers.connection_pool import configure_connection_pool
 from pyehr.utils.services import get_service_configuration, check_pid_file,\
     create_pid, destroy_pid, get_rotating_file_logger
 from pyehr.ehr.services.dbmanager.dbservices import DBServices
@@ -462,10 +464,14 @@ class DBService(object):
             if response_body:
                 return self._success(response_body)
 
-    def start_service(self, host, port, engine, debug=False):
+    def start_service(self, host, port, engine, debug=False, workers=10, max_queue=100):
         self.logger.info('Starting DBService daemon with DEBUG set to %s', debug)
+        if engine == THREAD_POOL_ENGINE:
+            self.logger.info('Serving requests with %d threads, %d requests can be queued',
+                             workers, max_queue)
         try:
-            run(host=host, port=port, server=engine, debug=debug)
+            run(host=host, port=port, server=get_server(engine, host, port, workers, max_queue),
+                debug=debug)
         except Exception, e:
             self.logger.critical('An error has occurred: %s', e)
 
@@ -493,6 +499,7 @@ def main(argv):
         msg = 'It was impossible to load configuration, exit'
         logger.critical(msg)
         sys.exit(msg)
+    configure_connection_pool(**conf.get_connection_pool_configuration())
     dbs = DBService(log_file=args.log_file, log_level=args.log_level,
                     **conf.get_db_configuration())
     dbs.add_index_service(**conf.get_index_configuration())
@@ -1,5 +1,7 @@
-import sys, argparse
+import sys, argparse, base64
 from functools import wraps
+from hashlib import md5
+from itertools import islice
 
 try:
     import simplejson as json
@@ -9,7 +11,11 @@ except ImportError:
 from bottle import post, get, run, response, request, abort, HTTPError
 
 from pyehr.ehr.services.dbmanager.querymanager import QueryManager
+from pyehr.ehr.services.dbmanager.querymanager.prepared_queries import normalize_aql_query
+from pyehr.aql.parser import Parser
 from pyehr.utils import get_logger
+from pyehr.utils.wsgi import get_server, THREAD_POOL_ENGINE
+from pyehr.ehr.services.dbmanager.drivers.connection_pool import configure_connection_pool
 from pyehr.utils.services import get_service_configuration, check_pid_file,\
     create_pid, destroy_pid, get_rotating_file_logger
 import pyehr.ehr.services.dbmanager.errors as pyehr_errors
@@ -17,6 +23,8 @@ import pyehr.ehr.services.dbmanager.errors as pyehr_errors
 
 class QueryService():
 
+    RESPONSE_FORMATS = ('json', 'ndjson')
+
     def __init__(self, driver, host, database, versioning_database,
                  patients_repository=None, ehr_repository=None,
                  ehr_versioning_repository=None,
@@ -77,25 +85,135 @@ class QueryService():
         response.status = return_code
         return body
 
-    def _execute_query(self, params, count_only):
+    def _get_query(self, params):
         aql_query = params.get('query')
         if not aql_query:
             self._missing_mandatory_field('query')
         query_params = params.get('query_params')
         if query_params:
             query_params = json.loads(query_params)
+        return aql_query, query_params
+
+    def _execute_query(self, params, count_only):
+        aql_query, query_params = self._get_query(params)
         results = self.qmanager.execute_aql_query(aql_query, query_params, count_only)
         return results
 
+    def _get_query_key(self, aql_query, query_params):
+        # cursors can only be used with the query (and parameters) that created them
+        query_key = md5(normalize_aql_query(aql_query))
+        query_key.update(json.dumps(query_params, sort_keys=True))
+        return query_key.hexdigest()
+
+    def _check_paged_query(self, aql_query):
+        # cursors are offsets in the results of the query, that is executed again for each
+        # page: without a sort order rows could be repeated or skipped between pages
+        if not Parser().parse(aql_query).order_rules:
+            self._error('Paged queries require an ORDER BY clause', 400)
+
+    def _encode_cursor(self, query_key, offset):
+        return base64.urlsafe_b64encode(json.dumps({'query': query_key, 'offset': offset}))
+
+    def _decode_cursor(self, cursor, query_key):
+        try:
+            cursor_data = json.loads(base64.urlsafe_b64decode(str(cursor)))
+            offset, cursor_query_key = int(cursor_data['offset']), cursor_data['query']
+        except (TypeError, ValueError, KeyError):
+            self._error('Invalid cursor %s' % cursor, 400)
+        if cursor_query_key != query_key:
+            self._error('Cursor was not created by the given query', 400)
+        return offset
+
+    def _get_page_size(self, params):
+        page_size = params.get('page_size')
+        if not page_size:
+            return None
+        try:
+            page_size = int(page_size)
+        except ValueError:
+            page_size = 0
+        if page_size < 1:
+            self._error('page_size must be an integer greater than 0', 400)
+        return page_size
+
+    def _get_next_cursor(self, results, query_key, offset, page_size):
+        # a cursor is returned only if there is at least one more result
+        if page_size and next(results, None) is not None:
+            return self._encode_cursor(query_key, offset + page_size)
+        return None
+
+    def _iter_page(self, results, offset, page_size):
+        # results before the cursor are fetched and dropped, they are never kept in memory
+        if offset:
+            next(islice(results, offset, offset), None)
+        if page_size:
+            return islice(results, page_size)
+        return results
+
+    def _stream_results(self, results, query_key, offset, page_size):
+        # one JSON document for each line: columns definition, a line for each row and a
+        # final line with the results count and the cursor of the next page
+        try:
+            yield json.dumps({'COLUMNS': [c.to_json() for c in results.columns]}) + '\n'
+            results_count = 0
+            for row in self._iter_page(results, offset, page_size):
+                results_count += 1
+                yield json.dumps({'ROW': row}) + '\n'
+            yield json.dumps({
+                'SUCCESS': True,
+                'RESULTS_COUNT': results_count,
+                'NEXT_CURSOR': self._get_next_cursor(results, query_key, offset, page_size)
+            }) + '\n'
+        except Exception, e:
+            # the status code was already sent, the error is reported in the last line
+            self.logger.error('Error while streaming results: %s', e)
+            yield json.dumps({'SUCCESS': False, 'ERROR': 'Unexpected error: %s' % e}) + '\n'
+        finally:
+            results.close()
+
+    def _execute_paged_query(self, aql_query, query_params, query_key, offset, page_size):
+        results = self.qmanager.execute_aql_query(aql_query, query_params, streaming=True,
+                                                  batch_size=page_size)
+        with results:
+            rows = list(self._iter_page(results, offset, page_size))
+            next_cursor = self._get_next_cursor(results, query_key, offset, page_size)
+        return {
+            'SUCCESS': True,
+            'RESULTS_SET': {
+                'results_count': len(rows),
+                'results': rows
+            },
+            'NEXT_CURSOR': next_cursor
+        }
+
     @exception_handler
     def execute_query(self):
         params = request.forms
-        results = self._execute_query(params, count_only=False)
-        response_body = {
-            'SUCCESS': True,
-            'RESULTS_SET': results.to_json()
-        }
-        return self._success(response_body)
+        response_format = params.get('response_format') or 'json'
+        if response_format not in self.RESPONSE_FORMATS:
+            self._error('Unsupported response format %s, use one of %s' %
+                        (response_format, ', '.join(self.RESPONSE_FORMATS)), 400)
+        page_size = self._get_page_size(params)
+        cursor = params.get('cursor')
+        if response_format == 'json' and not (page_size or cursor):
+            results = self._execute_query(params, count_only=False)
+            response_body = {
+                'SUCCESS': True,
+                'RESULTS_SET': results.to_json()
+            }
+            return self._success(response_body)
+        aql_query, query_params = self._get_query(params)
+        if page_size or cursor:
+            self._check_paged_query(aql_query)
+        query_key = self._get_query_key(aql_query, query_params)
+        offset = self._decode_cursor(cursor, query_key) if cursor else 0
+        if response_format == 'json':
+            return self._success(self._execute_paged_query(aql_query, query_params, query_key,
+                                                           offset, page_size))
+        results = self.qmanager.execute_aql_query(aql_query, query_params, streaming=True,
+                                                  batch_size=page_size)
+        response.content_type = 'application/x-ndjson'
+        return self._stream_results(results, query_key, offset, page_size)
 
     @exception_handler
     def execute_count_query(self):
@@ -107,12 +225,18 @@ class QueryService():
         }
         return self._success(response_body)
 
-    def start_service(self, host, port, engine, debug=False):
+    def start_service(self, host, port, engine, debug=False, workers=10, max_queue=100):
         self.logger.info('Starting QueryService daemon with DEBUG set to %s', debug)
+        if engine == THREAD_POOL_ENGINE:
+            self.logger.info('Serving requests with %d threads, %d requests can be queued',
+                             workers, max_queue)
         try:
-            run(host=host, port=port, server=engine, debug=debug)
+            run(host=host, port=port, server=get_server(engine, host, port, workers, max_queue),
+                debug=debug)
         except Exception, e:
             self.logger.critical('An error has occurred: %s', e)
+        finally:
+            self.qmanager.close()
 
     def test_server(self):
         return 'QueryManager daemon running'
@@ -141,6 +265,7 @@ def main(argv):
         msg = 'It was impossible to load configuration, exit'
         logger.critical(msg)
         sys.exit(msg)
+    configure_connection_pool(**conf.get_connection_pool_configuration())
     qservice = QueryService(log_file=args.log_file, log_level=args.log_level,
                             **conf.get_db_configuration())
     qservice.add_index_service(**conf.get_index_configuration())
@@ -63,9 +63,9 @@ def get_db_service(conf_file):
 
 def clean_database(db_service, logger):
     logger.info('Starting cleanup')
-    patients = db_service.get_patients(fetch_ehr_records=False)
+    patients = db_service.iter_patients(fetch_ehr_records=False)
     for i, p in enumerate(patients):
-        logger.info('Cleaning data for patient %s (%d of %d)' % (p.record_id, i+1, len(patients)))
+        logger.info('Cleaning data for patient %s (%d)' % (p.record_id, i+1))
         db_service.delete_patient(p, cascade_delete=True)
     logger.info('Cleaning index')
     db_service.index_service.connect()
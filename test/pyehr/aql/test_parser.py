@@ -0,0 +1,88 @@
+import unittest
+from pyehr.aql.parser import Parser
+from pyehr.aql.errors import ParseGroupByError, ParseOrderRulesError
+
+
+class TestParser(unittest.TestCase):
+
+    def __init__(self, label):
+        super(TestParser, self).__init__(label)
+
+    def setUp(self):
+        self.parser = Parser()
+
+    def test_parse_clauses(self):
+        query = """
+        SELECT TOP 10 o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        WHERE o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude >= 180
+        GROUP BY systolic
+        """
+        query_model = self.parser.parse(query)
+        self.assertEqual(query_model.selection.top, 10)
+        self.assertEqual(' '.join(self.parser.location.split()),
+                         'Ehr e CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]')
+        self.assertEqual(' '.join(self.parser.condition.split()),
+                         'o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude >= 180')
+        self.assertEqual(self.parser.group_by.strip(), 'systolic')
+
+    def test_parse_aggregate_functions(self):
+        query = """
+        SELECT e/ehr_id/value AS patient,
+        AVG(o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude) AS avg_systolic,
+        max(o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude),
+        COUNT(*) AS records
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        GROUP BY e/ehr_id/value
+        """
+        query_model = self.parser.parse(query)
+        self.assertTrue(query_model.selection.aggregated)
+        self.assertEqual([(v.function, v.label) for v in query_model.selection.variables],
+                         [(None, 'patient'), ('AVG', 'avg_systolic'),
+                          ('MAX', 'MAX(o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude)'),
+                          ('COUNT', 'records')])
+        self.assertIsNone(query_model.selection.variables[3].variable)
+        self.assertEqual([v.label for v in query_model.group_by], ['patient'])
+
+    def test_parse_invalid_group_by(self):
+        query = """
+        SELECT e/ehr_id/value AS patient,
+        o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic,
+        COUNT(*) AS records
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        GROUP BY patient
+        """
+        with self.assertRaises(ParseGroupByError):
+            self.parser.parse(query)
+
+    def test_parse_order_rules(self):
+        query = """
+        SELECT e/ehr_id/value AS patient,
+        o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        ORDER BY systolic DESCENDING, e/ehr_id/value
+        """
+        query_model = self.parser.parse(query)
+        self.assertEqual([(r.variable.label, r.direction) for r in query_model.order_rules.rules],
+                         [('systolic', 'DESC'), ('patient', 'ASC')])
+        with self.assertRaises(ParseOrderRulesError):
+            self.parser.parse(query.replace('DESCENDING', 'DOWN'))
+        with self.assertRaises(ParseOrderRulesError):
+            self.parser.parse(query.replace('ORDER BY systolic', 'ORDER BY diastolic'))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestParser('test_parse_clauses'))
+    suite.addTest(TestParser('test_parse_aggregate_functions'))
+    suite.addTest(TestParser('test_parse_invalid_group_by'))
+    suite.addTest(TestParser('test_parse_order_rules'))
+    return suite
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite())
@@ -3,7 +3,7 @@ from collections import Counter
 from pyehr.ehr.services.dbmanager.dbservices import DBServices
 from pyehr.ehr.services.dbmanager.dbservices.wrappers import PatientRecord,\
     ClinicalRecord, ArchetypeInstance
-from pyehr.ehr.services.dbmanager.errors import DuplicatedKeyError
+from pyehr.ehr.services.dbmanager.errors import DuplicatedKeyError, CascadeDeleteError
 from pyehr.utils.services import get_service_configuration
 
 CONF_FILE = os.getenv('SERVICE_CONFIG_FILE')
@@ -126,6 +126,46 @@ class TestDBServices(unittest.TestCase):
         # cleanup
         dbs.delete_patient(pat_rec, cascade_delete=True)
 
+    def test_load_missing_ehr_records(self):
+        dbs = DBServices(**self.conf)
+        dbs.set_index_service(**self.index_conf)
+        pat_rec = dbs.save_patient(PatientRecord(record_id='PATIENT_01'))
+        for x in xrange(3):
+            arch = ArchetypeInstance('openEHR-EHR-EVALUATION.dummy-evaluation.v1',
+                                     {'ehr_field': 'ehr_value%02d' % x})
+            _, pat_rec = dbs.save_ehr_record(ClinicalRecord(arch), pat_rec)
+        missing_id = pat_rec.ehr_records[0].record_id
+        # remove the clinical record leaving its reference in the patient record
+        drf = dbs._get_drivers_factory(dbs.ehr_repository)
+        with drf.get_driver() as driver:
+            driver.delete_record(missing_id)
+        self.assertEqual(len(pat_rec.ehr_records), 3)
+        pat_rec = dbs.load_ehr_records(pat_rec)
+        self.assertEqual(len(pat_rec.ehr_records), 2)
+        self.assertNotIn(missing_id, [ehr.record_id for ehr in pat_rec.ehr_records])
+        # cleanup
+        dbs.delete_patient(pat_rec, cascade_delete=True)
+
+    def test_iter_patients(self):
+        dbs = DBServices(**self.conf)
+        dbs.set_index_service(**self.index_conf)
+        patients = []
+        for x in xrange(5):
+            pat_rec = dbs.save_patient(PatientRecord(record_id='PATIENT_%02d' % x))
+            arch = ArchetypeInstance('openEHR-EHR-EVALUATION.dummy-evaluation.v1',
+                                     {'ehr_field': 'ehr_value%02d' % x})
+            _, pat_rec = dbs.save_ehr_record(ClinicalRecord(arch), pat_rec)
+            patients.append(pat_rec)
+        patients_ids = [p.record_id for p in dbs.iter_patients(batch_size=2)]
+        self.assertEqual(patients_ids, sorted(p.record_id for p in patients))
+        for p in dbs.iter_patients(batch_size=2):
+            self.assertEqual(len(p.ehr_records), 1)
+        patients_ids = [p.record_id for p in dbs.iter_patients(batch_size=2, after_id='PATIENT_02')]
+        self.assertEqual(patients_ids, ['PATIENT_03', 'PATIENT_04'])
+        # cleanup
+        for p in patients:
+            dbs.delete_patient(p, cascade_delete=True)
+
     def _get_active_records_count(self, patient_record, counter):
         for ehr in patient_record.ehr_records:
             if ehr.active:
@@ -198,6 +238,43 @@ class TestDBServices(unittest.TestCase):
         dbs.delete_patient(pat_rec_1)
         dbs.delete_patient(pat_rec_2, cascade_delete=True)
 
+    def test_move_ehr_records(self):
+        dbs = DBServices(**self.conf)
+        dbs.set_index_service(**self.index_conf)
+        pat_rec_1 = dbs.save_patient(self.create_random_patient())
+        pat_rec_2 = dbs.save_patient(self.create_random_patient())
+        ehr_records = [ClinicalRecord(ArchetypeInstance('openEHR-EHR-EVALUATION.dummy-evaluation.v1',
+                                                        {'k1': 'v%02d' % x})) for x in xrange(5)]
+        ehr_records, pat_rec_1, _ = dbs.save_ehr_records(ehr_records, pat_rec_1)
+        pat_rec_1, pat_rec_2 = dbs.move_ehr_records(pat_rec_1, pat_rec_2, ehr_records[:3])
+        self.assertEqual(len(pat_rec_1.ehr_records), 2)
+        self.assertEqual(len(pat_rec_2.ehr_records), 3)
+        for ehr in ehr_records[:3]:
+            self.assertEqual(ehr.version, 2)
+            self.assertIsNotNone(dbs.get_ehr_record(ehr.record_id, pat_rec_2.record_id))
+        self.assertEqual(len(dbs.get_revisions(ehr_records[0])), 1)
+        # cleanup
+        dbs.delete_patients([pat_rec_1, pat_rec_2], cascade_delete=True)
+
+    def test_delete_patients(self):
+        dbs = DBServices(**self.conf)
+        dbs.set_index_service(**self.index_conf)
+        patients = []
+        for x in xrange(3):
+            pat_rec = dbs.save_patient(self.create_random_patient())
+            arch = ArchetypeInstance('openEHR-EHR-EVALUATION.dummy-evaluation.v1',
+                                     {'ehr_field': 'ehr_value%02d' % x})
+            _, pat_rec = dbs.save_ehr_record(ClinicalRecord(arch), pat_rec)
+            patients.append(pat_rec)
+        with self.assertRaises(CascadeDeleteError):
+            dbs.delete_patients(patients)
+        self.assertIsNotNone(dbs.get_patient(patients[0].record_id))
+        dbs.delete_patients(patients, cascade_delete=True)
+        for pat_rec in patients:
+            self.assertIsNone(dbs.get_patient(pat_rec.record_id))
+            self.assertIsNone(dbs.get_ehr_record(pat_rec.ehr_records[0].record_id,
+                                                 pat_rec.record_id))
+
     def test_get_ehr_record(self):
         dbs = DBServices(**self.conf)
         dbs.set_index_service(**self.index_conf)
@@ -228,8 +305,12 @@ def suite():
     suite.addTest(TestDBServices('test_save_ehr_records'))
     suite.addTest(TestDBServices('test_remove_ehr_record'))
     suite.addTest(TestDBServices('test_load_ehr_records'))
+    suite.addTest(TestDBServices('test_load_missing_ehr_records'))
+    suite.addTest(TestDBServices('test_iter_patients'))
     suite.addTest(TestDBServices('test_hide_ehr_record'))
     suite.addTest(TestDBServices('test_move_ehr_record'))
+    suite.addTest(TestDBServices('test_move_ehr_records'))
+    suite.addTest(TestDBServices('test_delete_patients'))
     suite.addTest(TestDBServices('test_get_ehr_record'))
     return suite
 
@@ -1,6 +1,7 @@
 import unittest, os
 from lxml import etree
 from pyehr.ehr.services.dbmanager.dbservices.index_service import IndexService
+from pyehr.utils.services import get_service_configuration
 
 CONF_FILE = os.getenv('SERVICE_CONFIG_FILE')
 
@@ -126,6 +127,27 @@ class TestIndexService(unittest.TestCase):
         ehr_structure_2 = etree.tostring(IndexService.get_structure(ehr_record_2))
         self.assertEqual(ehr_structure_1, ehr_structure_2)
 
+    def test_counter_deltas(self):
+        index_conf = get_service_configuration(CONF_FILE).get_index_configuration()
+        index_service = IndexService(index_conf['database'], index_conf['url'],
+                                     index_conf['user'], index_conf['passwd'])
+        ehr_record = {
+            'archetype_class': 'test-openehr-OBSERVATION.test01.v1',
+            'archetype_details': {}
+        }
+        str_id = index_service.get_structure_id(ehr_record)
+        # a second request for the same structure is served by the cache
+        self.assertEqual(index_service.get_structure_id(ehr_record), str_id)
+        index_service.apply_counter_deltas({str_id: 3})
+        doc = index_service._get_structure_by_id(str_id)
+        self.assertEqual(index_service._get_document_reference_counter(doc), 3)
+        index_service.decrease_structure_counter(str_id, 2)
+        doc = index_service._get_structure_by_id(str_id)
+        self.assertEqual(index_service._get_document_reference_counter(doc), 1)
+        index_service.apply_counter_deltas({str_id: -1})
+        self.assertIsNone(index_service._get_structure_by_id(str_id))
+        index_service.disconnect()
+
 
 def suite():
     suite = unittest.TestSuite()
@@ -133,6 +155,7 @@ def suite():
     suite.addTest(TestIndexService('test_structure_dict'))
     suite.addTest(TestIndexService('test_structure_list'))
     suite.addTest(TestIndexService('test_structure_sorting'))
+    suite.addTest(TestIndexService('test_counter_deltas'))
     return suite
 
 if __name__ == '__main__':
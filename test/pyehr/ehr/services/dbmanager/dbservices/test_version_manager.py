@@ -71,6 +71,17 @@ class TestVersionManager(unittest.TestCase):
         self.assertEqual(crec.version, 2)
         self.assertGreater(crec.last_update, crec.creation_time)
 
+    def test_record_metadata_update(self):
+        crec = self.build_dataset()
+        # an update that only changes record's metadata is not redundant
+        crec.active = False
+        crec = self.dbs.update_ehr_record(crec)
+        self.assertEqual(crec.version, 2)
+        self.assertFalse(self.dbs.get_ehr_record(crec.record_id, self.patient.record_id).active)
+        self.assertTrue(self.dbs.version_manager.get_revision(crec.record_id, 1).active)
+        with self.assertRaises(RedundantUpdateError):
+            self.dbs.update_ehr_record(crec)
+
     def test_record_restore(self):
         crec = self.build_dataset()
         for x in xrange(0, 10):
@@ -163,6 +174,28 @@ class TestVersionManager(unittest.TestCase):
         self.assertEqual(revisions[0].version, 10)
         self.assertEqual(revisions[-1].version, 1)
 
+    def test_delta_revisions(self):
+        self.dbs.revisions_mode = 'delta'
+        self.dbs.snapshot_interval = 3
+        self.dbs.version_manager = self.dbs._set_version_manager()
+        crec = self.build_dataset()
+        values = [crec.ehr_data.archetype_details['data']['at0001']]
+        for x in xrange(0, 10):
+            crec.ehr_data.archetype_details['data']['at0001'] = random.randint(100*x, 200*x)
+            crec = self.dbs.update_ehr_record(crec)
+            values.append(crec.ehr_data.archetype_details['data']['at0001'])
+        revisions = self.dbs.get_revisions(crec)
+        self.assertEqual(len(revisions), 10)
+        for rev in revisions:
+            self.assertEqual(rev.ehr_data.archetype_details['data']['at0001'],
+                             values[rev.version - 1])
+        crec_v5 = self.dbs.get_revision(crec, 5)
+        self.assertEqual(crec_v5.ehr_data.archetype_details['data']['at0001'], values[4])
+        crec, deleted_revisions = self.dbs.restore_ehr_version(crec, 5)
+        self.assertEqual(crec.ehr_data.archetype_details['data']['at0001'], values[4])
+        crec_v2 = self.dbs.get_revision(crec, 2)
+        self.assertEqual(crec_v2.ehr_data.archetype_details['data']['at0001'], values[1])
+
     def test_optimistic_lock_error(self):
         # first user creates a clinical record
         crec1 = self.build_dataset()
@@ -176,6 +209,41 @@ class TestVersionManager(unittest.TestCase):
             crec2.ehr_data.archetype_details['data']['at0002'] = 'updated text message'
             self.dbs.update_ehr_record(crec2)
 
+    def test_concurrent_records_field_update(self):
+        self._create_random_patient()
+        self.patient = self.dbs.save_patient(self.patient)
+        crecs, self.patient, _ = self.dbs.save_ehr_records([self._create_random_clinical_record()
+                                                            for _ in xrange(3)], self.patient)
+        version_manager = self.dbs.version_manager
+        drf = self.dbs._get_drivers_factory(self.dbs.ehr_repository)
+        with drf.get_driver() as driver:
+            driver_class = type(driver)
+        versioned_update_records = driver_class.versioned_update_records.im_func
+
+        def concurrent_update(driver, *args, **kwargs):
+            # a concurrent update changes the first record after its version was checked
+            with drf.get_driver() as concurrent_driver:
+                concurrent_driver.update_field(crecs[0].record_id, 'active', True, 'last_update', True)
+            return versioned_update_records(driver, *args, **kwargs)
+
+        driver_class.versioned_update_records = concurrent_update
+        try:
+            with self.assertRaises(OptimisticLockError):
+                self.dbs.hide_ehr_records(crecs)
+        finally:
+            del driver_class.versioned_update_records
+            if not hasattr(driver_class, 'versioned_update_records'):
+                driver_class.versioned_update_records = versioned_update_records
+        # the concurrent update is not overwritten and the version it replaced is not archived
+        self.assertTrue(crecs[0].active)
+        self.assertEqual(crecs[0].version, 1)
+        self.assertTrue(self.dbs.get_ehr_record(crecs[0].record_id, self.patient.record_id).active)
+        self.assertIsNone(version_manager.get_revision(crecs[0].record_id, 1))
+        for crec in crecs[1:]:
+            self.assertFalse(crec.active)
+            self.assertEqual(crec.version, 2)
+            self.assertIsNotNone(version_manager.get_revision(crec.record_id, 1))
+
     def test_redundant_update_error(self):
         crec = self.build_dataset()
         # record unchanged, try to update anyway
@@ -214,13 +282,16 @@ class TestVersionManager(unittest.TestCase):
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(TestVersionManager('test_record_update'))
+    suite.addTest(TestVersionManager('test_record_metadata_update'))
     suite.addTest(TestVersionManager('test_record_restore'))
     suite.addTest(TestVersionManager('test_record_restore_original'))
     suite.addTest(TestVersionManager('test_record_restore_previous_revision'))
     suite.addTest(TestVersionManager('test_record_reindex'))
     suite.addTest(TestVersionManager('test_get_revision'))
     suite.addTest(TestVersionManager('test_get_revisions'))
+    suite.addTest(TestVersionManager('test_delta_revisions'))
     suite.addTest(TestVersionManager('test_optimistic_lock_error'))
+    suite.addTest(TestVersionManager('test_concurrent_records_field_update'))
     suite.addTest(TestVersionManager('test_redundant_update_error'))
     suite.addTest(TestVersionManager('test_missing_revision_error'))
     suite.addTest(TestVersionManager('test_record_restore_unnecessary_error'))
@@ -1,6 +1,6 @@
-import unittest, time
+import unittest, time, pickle
 from pyehr.ehr.services.dbmanager.dbservices.wrappers \
-    import ClinicalRecord, PatientRecord, ArchetypeInstance
+    import ClinicalRecord, PatientRecord, ArchetypeInstance, LazyArchetypeInstance
 from pyehr.ehr.services.dbmanager.errors import InvalidJsonStructureError
 
 
@@ -78,6 +78,76 @@ class TestWrapper(unittest.TestCase):
             self.assertIsInstance(c.record_id, str)
             self.assertIsInstance(c.ehr_data, ArchetypeInstance)
 
+    def test_archetype_from_json(self):
+        arch_json = {
+            u'archetype_class': u'openEHR-EHR-COMPOSITION.encounter.v1',
+            u'archetype_details': {
+                u'context': None,
+                u'empty': {},
+                u'content': [None, {
+                    u'archetype_class': u'openEHR-EHR-OBSERVATION.blood_pressure.v1',
+                    u'archetype_details': {u'systolic': 120, u'units': u'mm[Hg]', u'position': None}
+                }]
+            }
+        }
+        expected_json = {
+            'archetype_class': 'openEHR-EHR-COMPOSITION.encounter.v1',
+            'archetype_details': {
+                'content': [{
+                    'archetype_class': 'openEHR-EHR-OBSERVATION.blood_pressure.v1',
+                    'archetype_details': {'systolic': 120, 'units': 'mm[Hg]'}
+                }]
+            }
+        }
+        for validate in (True, False):
+            arch = ArchetypeInstance.from_json(arch_json, validate)
+            self.assertIsInstance(arch.archetype_class, str)
+            self.assertIsInstance(arch.archetype_details['content'][0], ArchetypeInstance)
+            self.assertEqual(arch.to_json(), expected_json)
+        with self.assertRaises(InvalidJsonStructureError):
+            ArchetypeInstance.from_json({'archetype_class': 'openEHR-EHR-COMPOSITION.encounter.v1',
+                                         'archetype_details': {'context': None}})
+        with self.assertRaises(InvalidJsonStructureError):
+            arch_json['archetype_details']['content'][1]['archetype_details'] = 'value'
+            ArchetypeInstance.from_json(arch_json)
+
+    def test_lazy_archetype(self):
+        arch_json = {
+            u'archetype_class': u'openEHR-EHR-COMPOSITION.encounter.v1',
+            u'archetype_details': {
+                u'context': None,
+                u'content': [{
+                    u'archetype_class': u'openEHR-EHR-OBSERVATION.blood_pressure.v1',
+                    u'archetype_details': {u'data-systolic': 120, u'units': u'mm[Hg]'}
+                }]
+            }
+        }
+        arch = ArchetypeInstance.from_json(arch_json, validate=False, lazy=True, keys_map={'-': '.'})
+        self.assertIsInstance(arch, LazyArchetypeInstance)
+        self.assertEqual(arch.archetype_class, 'openEHR-EHR-COMPOSITION.encounter.v1')
+        self.assertFalse(arch.is_loaded)
+        content = arch.archetype_details['content'][0]
+        self.assertTrue(arch.is_loaded)
+        self.assertIsInstance(content, LazyArchetypeInstance)
+        self.assertFalse(content.is_loaded)
+        self.assertEqual(arch.to_json(), {
+            'archetype_class': 'openEHR-EHR-COMPOSITION.encounter.v1',
+            'archetype_details': {
+                'content': [{
+                    'archetype_class': 'openEHR-EHR-OBSERVATION.blood_pressure.v1',
+                    'archetype_details': {'data.systolic': 120, 'units': 'mm[Hg]'}
+                }]
+            }
+        })
+        # keys are encoded again when the archetype is converted to JSON
+        encoded_json = arch.to_json(keys_map={'.': '-'})
+        self.assertEqual(encoded_json['archetype_details']['content'][0]['archetype_details'],
+                         {'data-systolic': 120, 'units': 'mm[Hg]'})
+        # records don't have a dictionary for instance attributes
+        crec = ClinicalRecord(ehr_data=arch)
+        self.assertFalse(hasattr(crec, '__dict__'))
+        self.assertFalse(hasattr(arch, '__dict__'))
+
     def test_get_clinical_record(self):
         arch = ArchetypeInstance(
             archetype_class='openEHR-EHR-EVALUATION.dummy-evaluation.v1',
@@ -113,13 +183,44 @@ class TestWrapper(unittest.TestCase):
         crec2 = build_clinical_record()
         self.assertNotEqual(crec1, crec2)
 
+    def test_pickle_records(self):
+        arch_json = {
+            u'archetype_class': u'openEHR-EHR-COMPOSITION.encounter.v1',
+            u'archetype_details': {
+                u'content': [{
+                    u'archetype_class': u'openEHR-EHR-OBSERVATION.blood_pressure.v1',
+                    u'archetype_details': {u'data-systolic': 120, u'units': u'mm[Hg]'}
+                }]
+            }
+        }
+        for lazy in (False, True):
+            crec = ClinicalRecord(
+                ehr_data=ArchetypeInstance.from_json(arch_json, lazy=lazy, keys_map={'-': '.'}),
+                record_id='5314b3a55c98931a8a3d1a2c',
+                version=3
+            )
+            prec = PatientRecord(record_id='PATIENT_1', ehr_records=[crec])
+            crec.bind_to_patient(prec)
+            for protocol in xrange(pickle.HIGHEST_PROTOCOL + 1):
+                loaded_prec = pickle.loads(pickle.dumps(prec, protocol))
+                self.assertEqual(loaded_prec, prec)
+                loaded_crec = loaded_prec.ehr_records[0]
+                self.assertIsInstance(loaded_crec.ehr_data, type(crec.ehr_data))
+                self.assertEqual(loaded_crec.patient_id, crec.patient_id)
+                self.assertEqual(loaded_crec.version, crec.version)
+                self.assertEqual(loaded_crec.creation_time, crec.creation_time)
+                self.assertEqual(loaded_crec.to_json(), crec.to_json())
+
 
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(TestWrapper('test_to_json'))
     suite.addTest(TestWrapper('test_from_json'))
+    suite.addTest(TestWrapper('test_archetype_from_json'))
+    suite.addTest(TestWrapper('test_lazy_archetype'))
     suite.addTest(TestWrapper('test_get_clinical_record'))
     suite.addTest(TestWrapper('test_equal_records'))
+    suite.addTest(TestWrapper('test_pickle_records'))
     return suite
 
 if __name__ == '__main__':
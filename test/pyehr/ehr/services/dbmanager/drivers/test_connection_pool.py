@@ -0,0 +1,87 @@
+import unittest, time
+
+from pyehr.ehr.services.dbmanager.drivers.connection_pool import ConnectionPool
+
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.closed = False
+        self.healthy = True
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def __init__(self, label):
+        super(TestConnectionPool, self).__init__(label)
+
+    def setUp(self):
+        self.opened = []
+
+    def _open(self):
+        client = FakeClient()
+        self.opened.append(client)
+        return client
+
+    def _close(self, client):
+        client.closed = True
+
+    def _check(self, client):
+        return client.healthy
+
+    def test_lease_and_release(self):
+        pool = ConnectionPool(max_size=1)
+        client = pool.lease('key', self._open, self._close, self._check)
+        pool.release('key', client, self._close)
+        self.assertIs(pool.lease('key', self._open, self._close, self._check), client)
+        self.assertEqual(len(self.opened), 1)
+        # clients are never shared between different keys
+        self.assertIsNot(pool.lease('other_key', self._open, self._close, self._check), client)
+        self.assertEqual(len(self.opened), 2)
+
+    def test_max_size(self):
+        pool = ConnectionPool(max_size=1)
+        c1 = pool.lease('key', self._open, self._close)
+        c2 = pool.lease('key', self._open, self._close)
+        pool.release('key', c1, self._close)
+        pool.release('key', c2, self._close)
+        self.assertFalse(c1.closed)
+        self.assertTrue(c2.closed)
+
+    def test_idle_eviction(self):
+        pool = ConnectionPool(max_idle_time=0.01)
+        client = pool.lease('key', self._open, self._close)
+        pool.release('key', client, self._close)
+        time.sleep(0.05)
+        self.assertIsNot(pool.lease('key', self._open, self._close), client)
+        self.assertTrue(client.closed)
+
+    def test_health_check(self):
+        pool = ConnectionPool(health_check_interval=0)
+        client = pool.lease('key', self._open, self._close, self._check)
+        pool.release('key', client, self._close)
+        client.healthy = False
+        time.sleep(0.01)
+        self.assertIsNot(pool.lease('key', self._open, self._close, self._check), client)
+        self.assertTrue(client.closed)
+
+    def test_clear(self):
+        pool = ConnectionPool()
+        client = pool.lease('key', self._open, self._close)
+        pool.release('key', client, self._close)
+        pool.clear()
+        self.assertTrue(client.closed)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestConnectionPool('test_lease_and_release'))
+    suite.addTest(TestConnectionPool('test_max_size'))
+    suite.addTest(TestConnectionPool('test_idle_eviction'))
+    suite.addTest(TestConnectionPool('test_health_check'))
+    suite.addTest(TestConnectionPool('test_clear'))
+    return suite
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite())
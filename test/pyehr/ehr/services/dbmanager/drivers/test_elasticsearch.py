@@ -1,5 +1,8 @@
-import unittest
+import unittest, json
+from uuid import uuid4
+from pyehr.aql.parser import Parser
 from pyehr.ehr.services.dbmanager.drivers.elastic_search import ElasticSearchDriver
+from pyehr.ehr.services.dbmanager.dbservices.version_manager import VersionManager
 
 
 class TestElasticSearchDriver(unittest.TestCase):
@@ -55,6 +58,28 @@ class TestElasticSearchDriver(unittest.TestCase):
             for sid in saved_ids:
                 driver.delete_record(sid)
 
+    def test_bulk_ingest_mode(self):
+        records = [{
+            '_id': str(x),
+            'field1': 'value1',
+            'field2': 'value2',
+        } for x in xrange(0, 10)]
+        with ElasticSearchDriver([{"host": "localhost", "port": 9200}], 'test_database', 'test_collection') as driver:
+            with driver.bulk_ingest_mode():
+                saved_ids, _ = driver.add_records(records[:5])
+                saved_ids.extend(driver.add_records(records[5:])[0])
+                self.assertEqual(driver.refresh, 'false')
+                saved, duplicated = driver.add_records(records[:2], skip_existing_duplicated=True)
+                self.assertEqual(saved, [])
+                self.assertEqual(duplicated, records[:2])
+            self.assertEqual(driver.refresh, 'true')
+            self.assertEqual(sorted(saved_ids), sorted(r['_id'] for r in records))
+            self.assertEqual(driver.count(), 10)
+            self.assertEqual(driver.get_record_by_id('3'), records[3])
+            # cleanup
+            for sid in saved_ids:
+                driver.delete_record(sid)
+
     def test_get_record_by_id(self):
         record = {
             '_id': '1',
@@ -83,6 +108,25 @@ class TestElasticSearchDriver(unittest.TestCase):
             for rid in record_ids:
                 driver.delete_record(rid)
 
+    def test_get_records_by_query(self):
+        records = [
+            {'value': x, 'even': x % 2 == 0, '_id': str(x)}
+            for x in xrange(0, 20)
+        ]
+        query = {'query': {'term': {'even': True}}}
+        with ElasticSearchDriver([{"host": "localhost", "port": 9200}], 'test_database', 'test_collection') as driver:
+            record_ids, _ = driver.add_records(records)
+            # records are fetched 3 at a time
+            driver.threshold = 3
+            for grbq in ('scan', 'from'):
+                driver.grbq = grbq
+                even_recs = list(driver.get_records_by_query(query))
+                self.assertEqual(sorted(r['value'] for r in even_recs), range(0, 20, 2))
+                self.assertEqual(len(list(driver.get_records_by_query(query, limit=4))), 4)
+            # cleanup
+            for rid in record_ids:
+                driver.delete_record(rid)
+
     def test_update_field(self):
         record = {
             'label': 'label',
@@ -97,6 +141,80 @@ class TestElasticSearchDriver(unittest.TestCase):
             # cleanup
             driver.delete_record(rec_id)
 
+    def test_delta_revision(self):
+        record_id = uuid4().hex
+        record = {
+            '_id': record_id,
+            'ehr_structure_id': 'structure_delta',
+            'patient_id': 'PATIENT_01',
+            'creation_time': 0,
+            'last_update': 0,
+            'active': True,
+            'version': 2,
+            'ehr_data': {'archetype_class': 'openEHR-EHR-OBSERVATION.dummy-observation.v1',
+                         'archetype_details': {'at0001': 'value2'}}
+        }
+        # a revision archived in delta mode has no clinical data
+        revision = dict((k, v) for k, v in record.iteritems() if k != 'ehr_data')
+        revision.update({
+            '_id': '%s_1' % record_id,
+            'version': 1,
+            'archived': True,
+            VersionManager.DELTA_FIELD: {'version': 1,
+                                         'patch': json.dumps({'archetype_details': {'at0001': 'value1'}})}
+        })
+        version_manager = VersionManager('elasticsearch', 'localhost', 'test_database',
+                                         ehr_repository='test_collection',
+                                         ehr_versioning_repository='test_collection_archive',
+                                         port=9200, revisions_mode='delta')
+        with ElasticSearchDriver([{"host": "localhost", "port": 9200}], 'test_database', 'test_collection') as driver:
+            driver.add_record(record)
+        with ElasticSearchDriver([{"host": "localhost", "port": 9200}], 'test_database',
+                                 'test_collection_archive') as driver:
+            driver.add_record(revision)
+            # the revision is stored under the ID of its record
+            self.assertEqual(len(list(driver.get_revisions_by_ehr_id(record_id))), 1)
+            stored_revision = driver.get_record_by_version(record_id, 1)
+            self.assertNotIn('ehr_data', stored_revision)
+            rebuilt_revision = version_manager._rebuild_revision(driver, record_id, stored_revision)
+            self.assertEqual(rebuilt_revision['ehr_data']['archetype_details'], {'at0001': 'value1'})
+            self.assertEqual(driver.decode_record(dict(rebuilt_revision, _id=revision['_id'])).version, 1)
+            # cleanup
+            driver.delete_record(revision['_id'])
+        with ElasticSearchDriver([{"host": "localhost", "port": 9200}], 'test_database', 'test_collection') as driver:
+            driver.delete_record(record_id)
+
+    def test_compile_query(self):
+        query = """
+        SELECT o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic
+        FROM Ehr e [uid=$ehrUid]
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        WHERE o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude >= 140
+        OR o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude >= 90
+        """
+        archetype_id = 'openEHR-EHR-OBSERVATION.blood_pressure.v1'
+        structures_mapping = (
+            {'structure_1': [{archetype_id: ['root']}], 'structure_2': [{archetype_id: ['root']}]},
+            {'o': archetype_id}
+        )
+        items_path = 'ehr_data.archetype_details.data.at0001.events.at0006.data.at0003.items'
+        driver = ElasticSearchDriver([{"host": "localhost", "port": 9200}], 'test_database', 'test_collection')
+        queries = driver.compile_query(Parser().parse(query), 'patients', 'ehr', {'$ehrUid': 'PATIENT_01'},
+                                       structures_mapping)
+        # both structures produce the same query, the structures are matched by a single filter
+        self.assertEqual(len(queries), 1)
+        condition = queries[0]['condition']['query']['filtered']
+        self.assertEqual(condition['query'], {
+            'bool': {
+                'must': [{'term': {'patient_id': 'patient_01'}}],
+                'should': [{'range': {'%s.at0004.value.magnitude' % items_path: {'gte': 140}}},
+                           {'range': {'%s.at0005.value.magnitude' % items_path: {'gte': 90}}}],
+                'minimum_should_match': 1
+            }
+        })
+        self.assertEqual(sorted(condition['filter']['terms']['ehr_structure_id']),
+                         ['structure_1', 'structure_2'])
+
 
 def suite():
     suite = unittest.TestSuite()
@@ -104,9 +222,13 @@ def suite():
     suite.addTest(TestElasticSearchDriver('test_select_collection'))
     suite.addTest(TestElasticSearchDriver('test_add_record'))
     suite.addTest(TestElasticSearchDriver('test_add_records'))
+    suite.addTest(TestElasticSearchDriver('test_bulk_ingest_mode'))
     suite.addTest(TestElasticSearchDriver('test_get_record_by_id'))
     suite.addTest(TestElasticSearchDriver('test_get_records_by_value'))
+    suite.addTest(TestElasticSearchDriver('test_get_records_by_query'))
     suite.addTest(TestElasticSearchDriver('test_update_field'))
+    suite.addTest(TestElasticSearchDriver('test_delta_revision'))
+    suite.addTest(TestElasticSearchDriver('test_compile_query'))
     return suite
 
 if __name__ == '__main__':
@@ -131,6 +131,103 @@ class TestMongoDBDriver(unittest.TestCase):
             # cleanup
             driver.delete_record(rec_id)
 
+    def test_swap_record(self):
+        record = {'_id': uuid4().hex, '_version': 1, 'content_hash': 'HASH_1', 'label': 'label'}
+        with self.drf.get_driver() as driver:
+            driver.add_record(dict(record))
+            # same content, record is not replaced
+            previous_record, _ = driver.swap_record(record['_id'], dict(record, _version=2), 1)
+            self.assertIsNone(previous_record)
+            # wrong version, record is not replaced
+            new_record = dict(record, _version=2, content_hash='HASH_2')
+            previous_record, _ = driver.swap_record(record['_id'], dict(new_record), 2)
+            self.assertIsNone(previous_record)
+            previous_record, last_update = driver.swap_record(record['_id'], dict(new_record), 1,
+                                                              'last_update')
+            self.assertEqual(previous_record['content_hash'], 'HASH_1')
+            rec = driver.get_record_by_id(record['_id'])
+            self.assertEqual(rec['_version'], 2)
+            self.assertEqual(rec['last_update'], last_update)
+            # cleanup
+            driver.delete_record(record['_id'])
+
+    def test_versioned_update(self):
+        record = {'_id': uuid4().hex, '_version': 1, 'label': 'label', 'items': ['a']}
+        with self.drf.get_driver() as driver:
+            driver.add_record(dict(record))
+            # same value, record is not updated
+            previous_record, _ = driver.versioned_update(record['_id'], 1, 'label', 'set', 'label')
+            self.assertIsNone(previous_record)
+            # wrong version, record is not updated
+            previous_record, _ = driver.versioned_update(record['_id'], 2, 'items', 'add', 'b')
+            self.assertIsNone(previous_record)
+            previous_record, last_update = driver.versioned_update(record['_id'], 1, 'items', 'add',
+                                                                   'b', 'last_update')
+            self.assertEqual(previous_record['items'], ['a'])
+            previous_record, _ = driver.versioned_update(record['_id'], 2, 'items', 'remove', ['a'])
+            self.assertEqual(previous_record['last_update'], last_update)
+            rec = driver.get_record_by_id(record['_id'])
+            self.assertEqual(rec['_version'], 3)
+            self.assertEqual(rec['items'], ['b'])
+            # cleanup
+            driver.delete_record(record['_id'])
+
+    def test_query_pipeline(self):
+        records = [{
+            '_id': uuid4().hex,
+            'ehr_structure_id': 'STRUCTURE_PIPELINE',
+            'ehr_data': {'label': 'record%d' % x, 'rank': x % 3,
+                         'items': [{'value': x}, {'value': x * 10}]}
+        } for x in xrange(6)]
+        query = {'ehr_structure_id': 'STRUCTURE_PIPELINE'}
+        fields = {'_id': False, 'ehr_data.label': True, 'ehr_data.items.value': True}
+        with self.drf.get_driver() as driver:
+            driver.add_records(records)
+            self.assertEqual(driver._get_array_paths(query, ['ehr_data.label', 'ehr_data.items.value']),
+                             {'ehr_data.label': [], 'ehr_data.items.value': ['ehr_data.items']})
+            # sort by a field that is not selected
+            rows = list(driver._iter_pipeline_rows(query, fields, order_by=[['ehr_data.rank', 'rank', 'DESC']]))
+            self.assertEqual(len(rows), 12)
+            ranks = [int(r['ehr_data.label'][-1]) % 3 for r in rows]
+            self.assertEqual(ranks, sorted(ranks, reverse=True))
+            rows = list(driver._iter_pipeline_rows(query, fields, limit=4,
+                                                   order_by=[['ehr_data.rank', 'rank', 'ASC']]))
+            self.assertEqual(len(rows), 4)
+            self.assertEqual(set(int(r['ehr_data.label'][-1]) % 3 for r in rows), set([0]))
+            # cleanup
+            for r in records:
+                driver.delete_record(r['_id'])
+
+    def test_content_hash(self):
+        with self.drf.get_driver() as driver:
+            ehr_data = {'magnitude': 0.1234567890123, 'units': 'mm[Hg]'}
+            self.assertEqual(driver._get_content_hash(ehr_data),
+                             driver._get_content_hash({'units': 'mm[Hg]', 'magnitude': 0.1234567890123}))
+            self.assertNotEqual(driver._get_content_hash(ehr_data),
+                                driver._get_content_hash(dict(ehr_data, magnitude=0.1234567890124)))
+
+    def test_init_structure(self):
+        condition = {
+            '$or': [
+                {'ehr_data.archetype_details.archetype_node_id': 'openEHR-EHR-OBSERVATION.blood_pressure.v1',
+                 'ehr_data.data.events.data.items.value.magnitude': {'$gte': 140}},
+                {'ehr_data.data.events.data.items.value.magnitude': {'$lt': 90}}
+            ],
+            'ehr_structure_id': {'$in': ['STRUCTURE_01']}
+        }
+        with self.drf.get_driver() as driver:
+            fields = driver.get_condition_fields(condition)
+            self.assertEqual(sorted(fields), ['ehr_data.archetype_details.archetype_node_id',
+                                              'ehr_data.data.events.data.items.value.magnitude'])
+            driver.init_structure({'condition_fields': fields[:1]})
+            indexes = driver.collection.index_information()
+            for field, _ in driver.BASE_INDEXES:
+                self.assertIn('%s_1' % field, indexes)
+            self.assertEqual(driver.get_condition_indexes().values(), fields[:1])
+            # cleanup
+            driver.drop_condition_index(fields[0])
+            self.assertEqual(driver.get_condition_indexes(), {})
+
 
 def suite():
     suite = unittest.TestSuite()
@@ -141,6 +238,11 @@ def suite():
     suite.addTest(TestMongoDBDriver('test_get_record_by_id'))
     suite.addTest(TestMongoDBDriver('test_get_records_by_query'))
     suite.addTest(TestMongoDBDriver('test_update_record'))
+    suite.addTest(TestMongoDBDriver('test_swap_record'))
+    suite.addTest(TestMongoDBDriver('test_versioned_update'))
+    suite.addTest(TestMongoDBDriver('test_query_pipeline'))
+    suite.addTest(TestMongoDBDriver('test_content_hash'))
+    suite.addTest(TestMongoDBDriver('test_init_structure'))
     return suite
 
 if __name__ == '__main__':
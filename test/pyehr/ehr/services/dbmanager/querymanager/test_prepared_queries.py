@@ -0,0 +1,82 @@
+import unittest
+from pyehr.ehr.services.dbmanager.querymanager.prepared_queries import PreparedQuery,\
+    QueryParameters, normalize_aql_query
+from pyehr.ehr.services.dbmanager.errors import PredicateException
+
+
+class TestPreparedQueries(unittest.TestCase):
+
+    def __init__(self, label):
+        super(TestPreparedQueries, self).__init__(label)
+
+    def test_normalize_query(self):
+        query_a = """
+        SELECT e/ehr_id/value
+        FROM Ehr e [uid=$ehrUid]
+        WHERE  o/name/value = 'blood   pressure'
+        """
+        query_b = "SELECT e/ehr_id/value FROM Ehr e [uid=$ehrUid] WHERE o/name/value = 'blood   pressure'"
+        self.assertEqual(normalize_aql_query(query_a), query_b)
+        self.assertNotEqual(normalize_aql_query(query_a),
+                            normalize_aql_query(query_b.replace('blood   pressure', 'blood pressure')))
+
+    def test_bind_parameters(self):
+        params = QueryParameters()
+        template = {
+            'ehr_data.ehr_id': params['$ehrUid'],
+            'ehr_data.magnitude': {'$gte': params['$minValue']},
+            'query': 'patient_id:%s' % params['$ehrUid'].lower()
+        }
+        self.assertEqual(params.names, set(['$ehrUid', '$minValue']))
+        prepared_query = PreparedQuery(None, None, [template], params.names, 0)
+        bound_query = prepared_query.bind({'$ehrUid': 'PATIENT_01', '$minValue': 120})
+        self.assertEqual(bound_query, [{
+            'ehr_data.ehr_id': 'PATIENT_01',
+            'ehr_data.magnitude': {'$gte': 120},
+            'query': 'patient_id:patient_01'
+        }])
+        # the template is not modified by the binding
+        self.assertEqual(template['ehr_data.ehr_id'], QueryParameters.get_placeholder('$ehrUid'))
+        with self.assertRaises(PredicateException):
+            prepared_query.bind({'$ehrUid': 'PATIENT_01'})
+
+    def test_bind_unicode_parameters(self):
+        params = QueryParameters()
+        template = {
+            'ehr_data.name': params['$name'],
+            'ehr_data.label': 'name:%s' % params['$name'],
+            'query': 'city:%s' % params['$city'].lower()
+        }
+        prepared_query = PreparedQuery(None, None, [template], params.names, 0)
+        self.assertEqual(prepared_query.lowercase_parameters, set(['$city']))
+        bound_query = prepared_query.bind({'$name': u'Jos\xe9', '$city': u'M\xdcNCHEN'})
+        self.assertEqual(bound_query, [{
+            'ehr_data.name': u'Jos\xe9',
+            'ehr_data.label': u'name:Jos\xe9',
+            'query': u'city:m\xfcnchen'
+        }])
+
+    def test_bind_no_parameters(self):
+        template = {'ehr_data.archetype_class': 'openEHR-EHR-OBSERVATION.blood_pressure.v1'}
+        prepared_query = PreparedQuery(None, None, [template], set(), 0)
+        bound_query = prepared_query.bind()
+        self.assertEqual(bound_query, [template])
+        # changing the bound query doesn't change the prepared one
+        bound_query[0]['ehr_data.archetype_class'] = 'openEHR-EHR-OBSERVATION.heart_rate.v1'
+        bound_query.append({})
+        self.assertEqual(prepared_query.queries, [{
+            'ehr_data.archetype_class': 'openEHR-EHR-OBSERVATION.blood_pressure.v1'
+        }])
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestPreparedQueries('test_normalize_query'))
+    suite.addTest(TestPreparedQueries('test_bind_parameters'))
+    suite.addTest(TestPreparedQueries('test_bind_unicode_parameters'))
+    suite.addTest(TestPreparedQueries('test_bind_no_parameters'))
+    return suite
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite())
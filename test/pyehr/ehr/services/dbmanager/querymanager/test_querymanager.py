@@ -28,7 +28,7 @@ class TestQueryManager(unittest.TestCase):
         for p in self.patients:
             self.dbs.delete_patient(p, cascade_delete=True)
         self.patients = None
-        pass
+        self.qmanager.close()
 
     def _get_quantity(self, value, units):
         return {
@@ -300,6 +300,141 @@ class TestQueryManager(unittest.TestCase):
         sp_results = self.qmanager.execute_aql_query(query)
         mp_results = self.qmanager.execute_aql_query(query, query_processes=2)
         self.assertEqual(sorted(sp_results.to_json()), sorted(mp_results.to_json()))
+        # the pool of workers is reused by the following queries
+        executor = self.qmanager._get_executor(2)
+        mp_results = self.qmanager.execute_aql_query(query, query_processes=2)
+        self.assertIs(self.qmanager._get_executor(2), executor)
+        self.assertEqual(sorted(sp_results.to_json()), sorted(mp_results.to_json()))
+        sconf = get_service_configuration(CONF_FILE)
+        with QueryManager(query_executor='process', **sconf.get_db_configuration()) as qmanager:
+            qmanager.set_index_service(**sconf.get_index_configuration())
+            mp_results = qmanager.execute_aql_query(query, query_processes=2)
+        self.assertEqual(qmanager._executors, {})
+        self.assertEqual(sorted(sp_results.to_json()), sorted(mp_results.to_json()))
+
+    def test_pipeline_query_engine(self):
+        query = """
+        SELECT e/ehr_id/value AS patient_identifier,
+        o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic,
+        o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude AS diastolic
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        WHERE o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude >= 100
+        """
+        sconf = get_service_configuration(CONF_FILE)
+        if sconf.get_db_configuration()['driver'] != 'mongodb':
+            self.skipTest('query engines are only available for MongoDB')
+        _ = self._build_patients_batch(10, 10, (50, 150), (50, 100))
+        find_results = self.qmanager.execute_aql_query(query)
+        with QueryManager(query_engine='aggregate', **sconf.get_db_configuration()) as qmanager:
+            qmanager.set_index_service(**sconf.get_index_configuration())
+            results = qmanager.execute_aql_query(query)
+            self.assertEqual(sorted(find_results.results), sorted(results.results))
+            results = qmanager.execute_aql_query(query, streaming=True, batch_size=7)
+            self.assertEqual(sorted(find_results.results), sorted(results))
+
+    def test_streaming_query(self):
+        query = """
+        SELECT o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic,
+        o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude AS diastolic
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        """
+        batch_details = self._build_patients_batch(10, 10, (50, 100), (50, 100))
+        details_results = list()
+        for k, v in batch_details.iteritems():
+            details_results.extend(v)
+        results = self.qmanager.execute_aql_query(query, streaming=True, batch_size=7)
+        res = results.fetch_many(15)
+        self.assertEqual(len(res), 15)
+        res.extend(results)
+        self.assertEqual(results.total_results, len(details_results))
+        self.assertEqual(sorted(details_results), sorted(res))
+        self.assertEqual(results.fetch_many(10), [])
+        results = self.qmanager.execute_aql_query(query, streaming=True)
+        self.assertEqual(len(results.fetch_many(5)), 5)
+        results.close()
+        self.assertEqual(list(results), [])
+
+    def test_top_query(self):
+        query = """
+        SELECT TOP 15 o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic,
+        o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude AS diastolic
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        """
+        _ = self._build_patients_batch(10, 10, (50, 100), (50, 100))
+        results = self.qmanager.execute_aql_query(query)
+        self.assertEqual(results.total_results, 15)
+        self.assertEqual(len(list(results.results)), 15)
+        results = self.qmanager.execute_aql_query(query, streaming=True, batch_size=10)
+        self.assertEqual(len(list(results)), 15)
+
+    def test_aggregated_query(self):
+        query = """
+        SELECT e/ehr_id/value AS patient_identifier,
+        COUNT(*) AS records,
+        MAX(o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude) AS max_systolic,
+        AVG(o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude) AS avg_diastolic
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        GROUP BY patient_identifier
+        """
+        batch_details = self._build_patients_batch(5, 10, (50, 100), (50, 100))
+        results = self.qmanager.execute_aql_query(query)
+        self.assertEqual(results.total_results, len(batch_details))
+        # ElasticSearch groups analyzed string fields using their lowercase terms
+        batch_details = dict((k.lower(), v) for k, v in batch_details.iteritems())
+        for r in results.results:
+            details = batch_details[r['patient_identifier'].lower()]
+            self.assertEqual(r['records'], len(details))
+            self.assertEqual(r['max_systolic'], max(d['systolic'] for d in details))
+            self.assertAlmostEqual(r['avg_diastolic'],
+                                   float(sum(d['diastolic'] for d in details)) / len(details))
+        query = """
+        SELECT COUNT(*) AS records
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        """
+        results = self.qmanager.execute_aql_query(query)
+        self.assertEqual(list(results.results), [{'records': 50}])
+
+    def test_aggregated_query_missing_group_field(self):
+        query = """
+        SELECT o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude AS diastolic,
+        COUNT(*) AS records
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        GROUP BY diastolic
+        """
+        p = self.dbs.save_patient(PatientRecord('PATIENT_01'))
+        # half of the records have no diastolic value
+        crecs = [ClinicalRecord(ArchetypeInstance(*self._get_blood_pressure_data(120, 80 if x % 2 else None)))
+                 for x in xrange(0, 6)]
+        _, p, _ = self.dbs.save_ehr_records(crecs, p)
+        self.patients.append(p)
+        results = self.qmanager.execute_aql_query(query)
+        self.assertEqual(sorted(results.results),
+                         sorted([{'diastolic': None, 'records': 3}, {'diastolic': 80, 'records': 3}]))
+
+    def test_order_by_query(self):
+        query = """
+        SELECT TOP 20 o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic,
+        o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude AS diastolic
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        ORDER BY systolic DESC, diastolic
+        """
+        _ = self._build_patients_batch_mixed(10, 10, (50, 100), (50, 100))
+        sort_key = lambda r: (-r['systolic'], r['diastolic'])
+        all_results = list(self.qmanager.execute_aql_query(query.replace('TOP 20', '')).results)
+        self.assertEqual(all_results, sorted(all_results, key=sort_key))
+        results = list(self.qmanager.execute_aql_query(query).results)
+        self.assertEqual(results, all_results[:20])
+        results = list(self.qmanager.execute_aql_query(query, query_processes=2).results)
+        self.assertEqual(results, all_results[:20])
+        results = list(self.qmanager.execute_aql_query(query, streaming=True, batch_size=7))
+        self.assertEqual(results, all_results[:20])
 
 
 def suite():
@@ -316,6 +451,12 @@ def suite():
     suite.addTest(TestQueryManager('test_deep_select_query'))
     suite.addTest(TestQueryManager('test_count_query'))
     suite.addTest(TestQueryManager('test_multiprocess_query'))
+    suite.addTest(TestQueryManager('test_pipeline_query_engine'))
+    suite.addTest(TestQueryManager('test_streaming_query'))
+    suite.addTest(TestQueryManager('test_top_query'))
+    suite.addTest(TestQueryManager('test_aggregated_query'))
+    suite.addTest(TestQueryManager('test_aggregated_query_missing_group_field'))
+    suite.addTest(TestQueryManager('test_order_by_query'))
     return suite
 
 if __name__ == '__main__':
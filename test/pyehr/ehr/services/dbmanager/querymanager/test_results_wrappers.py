@@ -0,0 +1,70 @@
+import unittest, pickle
+from pyehr.ehr.services.dbmanager.querymanager.results_wrappers import ResultSet,\
+    ResultColumnDef, ResultRow, MISSING
+from pyehr.ehr.services.dbmanager.errors import InvalidFieldError
+
+
+class TestResultSet(unittest.TestCase):
+
+    def __init__(self, label):
+        super(TestResultSet, self).__init__(label)
+
+    def _build_result_set(self, paths_map, records):
+        rs = ResultSet()
+        for path, alias in paths_map.iteritems():
+            rs.add_column_definition(ResultColumnDef(alias, path))
+        for r in records:
+            rs.add_record(r)
+        return rs
+
+    def test_results(self):
+        rs = self._build_result_set({'p1.magnitude': 'systolic', 'p1.units': 'units'},
+                                    [{'p1.magnitude': 120, 'p1.units': 'mm[Hg]'},
+                                     {'p1.magnitude': 80}])
+        rs.add_row(ResultRow({'p1.units': 'mm[Hg]'}))
+        self.assertEqual(rs.total_results, 3)
+        self.assertEqual(list(rs.results), [{'systolic': 120, 'units': 'mm[Hg]'},
+                                            {'systolic': 80},
+                                            {'units': 'mm[Hg]'}])
+        self.assertEqual(rs.rows[1], ResultRow({'p1.magnitude': 80}))
+        rs.add_record({'p2.magnitude': 90})
+        with self.assertRaises(KeyError):
+            list(rs.results)
+
+    def test_extend(self):
+        rs1 = self._build_result_set({'p1.magnitude': 'systolic'},
+                                     [{'p1.magnitude': 120}, {'p1.magnitude': 80}])
+        rs2 = self._build_result_set({'p2.magnitude': 'systolic', 'patient_id': 'patient'},
+                                     [{'p2.magnitude': 100, 'patient_id': 'PATIENT_01'}])
+        # result sets are pickled when queries are executed by multiple processes
+        rs2 = pickle.loads(pickle.dumps(rs2))
+        rs1.extend(rs2)
+        self.assertEqual(rs1.total_results, 3)
+        self.assertEqual(len(rs1.columns), 3)
+        self.assertEqual(list(rs1.results), [{'systolic': 120}, {'systolic': 80},
+                                             {'systolic': 100, 'patient': 'PATIENT_01'}])
+        self.assertIs(rs1._columns_data['patient_id'][0], MISSING)
+        rs1.truncate(2)
+        self.assertEqual(rs1.total_results, 2)
+        self.assertEqual(rs1.get_column('systolic'), [120, 80])
+
+    def test_columns(self):
+        rs = self._build_result_set({'p1.magnitude': 'systolic', 'p2.magnitude': 'systolic'},
+                                    [{'p1.magnitude': 120}, {'p2.magnitude': 80},
+                                     {'p1.magnitude': 120}])
+        self.assertEqual(rs.get_column('systolic'), [120, 80, 120])
+        self.assertEqual(sorted(rs.get_distinct_results('systolic')), [80, 120])
+        with self.assertRaises(InvalidFieldError):
+            list(rs.get_distinct_results('diastolic'))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestResultSet('test_results'))
+    suite.addTest(TestResultSet('test_extend'))
+    suite.addTest(TestResultSet('test_columns'))
+    return suite
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite())
@@ -0,0 +1,50 @@
+import unittest, time
+
+from pyehr.utils.cache import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def __init__(self, label):
+        super(TestLRUCache, self).__init__(label)
+
+    def test_get_and_set(self):
+        cache = LRUCache(2)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        # 'b' is now the least recently used key
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_ttl(self):
+        cache = LRUCache(2, ttl=0.01)
+        cache.set('a', 1)
+        time.sleep(0.05)
+        self.assertIsNone(cache.get('a'))
+
+    def test_invalidate(self):
+        cache = LRUCache(4)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.set('c', 2)
+        cache.invalidate('a')
+        self.assertNotIn('a', cache)
+        cache.invalidate_value(2)
+        self.assertEqual(len(cache), 0)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestLRUCache('test_get_and_set'))
+    suite.addTest(TestLRUCache('test_ttl'))
+    suite.addTest(TestLRUCache('test_invalidate'))
+    return suite
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite())
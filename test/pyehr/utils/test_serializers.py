@@ -0,0 +1,55 @@
+import unittest, json
+
+from pyehr.utils import serializers
+
+
+class TestSerializers(unittest.TestCase):
+
+    def __init__(self, label):
+        super(TestSerializers, self).__init__(label)
+
+    def test_dumps_and_loads(self):
+        doc = {'archetype_class': 'openEHR-EHR-OBSERVATION.blood_pressure.v1',
+               'archetype_details': {'systolic': 120, 'units': 'mm[Hg]', 'values': [1.5, None, True]}}
+        self.assertIn(serializers.get_json_library(), serializers.JSON_LIBRARIES)
+        self.assertEqual(serializers.loads(serializers.dumps(doc)), doc)
+
+    def test_set_json_library(self):
+        library = serializers.get_json_library()
+        try:
+            serializers.set_json_library('json')
+            self.assertEqual(serializers.get_json_library(), 'json')
+            self.assertEqual(serializers.loads(serializers.dumps({'a': [1, 2]})), {'a': [1, 2]})
+        finally:
+            serializers.set_json_library(library)
+        with self.assertRaises(ValueError):
+            serializers.set_json_library('pickle')
+        with self.assertRaises(ValueError):
+            serializers.set_json_library('ujson')
+
+    def test_lossless_encoding(self):
+        doc = {'magnitude': 0.1234567890123, 'sum': 0.1 + 0.2, 'units': 'mm/h'}
+        library = serializers.get_json_library()
+        try:
+            for name in serializers.JSON_LIBRARIES:
+                try:
+                    serializers.set_json_library(name)
+                except ImportError:
+                    continue
+                json_doc = serializers.dumps(doc, sort_keys=True)
+                self.assertEqual(json_doc, json.dumps(doc, sort_keys=True))
+                self.assertEqual(serializers.loads(json_doc), doc)
+        finally:
+            serializers.set_json_library(library)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestSerializers('test_dumps_and_loads'))
+    suite.addTest(TestSerializers('test_set_json_library'))
+    suite.addTest(TestSerializers('test_lossless_encoding'))
+    return suite
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite())
@@ -0,0 +1,106 @@
+import unittest, time, urllib2
+from threading import Thread, Event
+from wsgiref.simple_server import WSGIRequestHandler
+
+from pyehr.utils.wsgi import ThreadPoolWSGIServer
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class TestThreadPoolWSGIServer(unittest.TestCase):
+
+    def __init__(self, label):
+        super(TestThreadPoolWSGIServer, self).__init__(label)
+        self.server = None
+
+    def _start_server(self, app, workers, max_queue):
+        self.server = ThreadPoolWSGIServer(('127.0.0.1', 0), QuietRequestHandler,
+                                           workers, max_queue)
+        self.server.set_app(app)
+        t = Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def _get(self, results=None):
+        try:
+            res = urllib2.urlopen('http://127.0.0.1:%d/' % self.server.server_port, timeout=5)
+            status = res.getcode()
+        except urllib2.HTTPError, e:
+            status = e.code
+        if results is not None:
+            results.append(status)
+        return status
+
+    def _run_clients(self, clients, results):
+        threads = [Thread(target=self._get, args=(results,)) for _ in xrange(clients)]
+        for t in threads:
+            t.start()
+        return threads
+
+    def tearDown(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def test_concurrent_requests(self):
+        def slow_app(environ, start_response):
+            time.sleep(0.3)
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return ['done']
+
+        self._start_server(slow_app, workers=4, max_queue=10)
+        results = []
+        start = time.time()
+        for t in self._run_clients(4, results):
+            t.join()
+        # requests are served in parallel
+        self.assertLess(time.time() - start, 1.0)
+        self.assertEqual(results, [200] * 4)
+
+    def test_busy_server(self):
+        request_started = Event()
+        release_request = Event()
+
+        def blocking_app(environ, start_response):
+            request_started.set()
+            release_request.wait(5)
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return ['done']
+
+        self._start_server(blocking_app, workers=1, max_queue=1)
+        results = []
+        threads = self._run_clients(1, results)
+        # the first request keeps the only worker busy, the second one is queued
+        request_started.wait(5)
+        threads.extend(self._run_clients(1, results))
+        while self.server.requests_queue.qsize() == 0:
+            time.sleep(0.01)
+        # the queue is full, the request is rejected
+        self.assertEqual(self._get(), 503)
+        release_request.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [200, 200])
+
+    def test_invalid_options(self):
+        with self.assertRaises(ValueError):
+            ThreadPoolWSGIServer(('127.0.0.1', 0), QuietRequestHandler, workers=0)
+        with self.assertRaises(ValueError):
+            ThreadPoolWSGIServer(('127.0.0.1', 0), QuietRequestHandler, max_queue=0)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestThreadPoolWSGIServer('test_concurrent_requests'))
+    suite.addTest(TestThreadPoolWSGIServer('test_busy_server'))
+    suite.addTest(TestThreadPoolWSGIServer('test_invalid_options'))
+    return suite
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite())
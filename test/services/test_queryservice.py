@@ -221,6 +221,66 @@ class TestQueryService(unittest.TestCase):
             results_set = decode_dict(results.json()['RESULTS_SET'])
             self.assertEqual(sorted(records), sorted(results_set['results']))
 
+    def test_paged_query(self):
+        query = """
+        SELECT o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic,
+        o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude AS diastolic
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        ORDER BY systolic, diastolic
+        """
+        batch_details = self._build_patients_batch(5, 5, (50, 100), (50, 100))
+        query_request = self._build_query_request(query)
+        query_request['page_size'] = 10
+        # pages are offsets in the results, a query without a sort order can't be paged
+        unsorted_request = self._build_query_request(query.replace('ORDER BY systolic, diastolic', ''))
+        unsorted_request['page_size'] = 10
+        res = requests.post(self._get_path(self.query_path), unsorted_request)
+        self.assertEqual(res.status_code, 400)
+        results = list()
+        pages = 0
+        while True:
+            res = requests.post(self._get_path(self.query_path), query_request)
+            self.assertEqual(res.status_code, requests.codes.ok)
+            self.assertTrue(res.json()['SUCCESS'])
+            results.extend(decode_dict(res.json()['RESULTS_SET'])['results'])
+            pages += 1
+            if not res.json()['NEXT_CURSOR']:
+                break
+            query_request['cursor'] = res.json()['NEXT_CURSOR']
+        self.assertEqual(pages, 3)
+        details_results = list()
+        for k, v in batch_details.iteritems():
+            details_results.extend(v)
+        self.assertEqual(sorted(results), sorted(details_results))
+        # a cursor can't be used with a different query
+        query_request['query'] = query.replace('diastolic', 'dia')
+        res = requests.post(self._get_path(self.query_path), query_request)
+        self.assertEqual(res.status_code, 400)
+
+    def test_ndjson_query(self):
+        query = """
+        SELECT o/data[at0001]/events[at0006]/data[at0003]/items[at0004]/value/magnitude AS systolic,
+        o/data[at0001]/events[at0006]/data[at0003]/items[at0005]/value/magnitude AS diastolic
+        FROM Ehr e
+        CONTAINS Observation o[openEHR-EHR-OBSERVATION.blood_pressure.v1]
+        """
+        batch_details = self._build_patients_batch(5, 5, (50, 100), (50, 100))
+        query_request = self._build_query_request(query)
+        query_request['response_format'] = 'ndjson'
+        res = requests.post(self._get_path(self.query_path), query_request, stream=True)
+        self.assertEqual(res.status_code, requests.codes.ok)
+        lines = [json.loads(l) for l in res.iter_lines() if l]
+        self.assertIn('COLUMNS', lines[0])
+        self.assertTrue(lines[-1]['SUCCESS'])
+        self.assertEqual(lines[-1]['RESULTS_COUNT'], 25)
+        self.assertIsNone(lines[-1]['NEXT_CURSOR'])
+        results = [decode_dict(l['ROW']) for l in lines[1:-1]]
+        details_results = list()
+        for k, v in batch_details.iteritems():
+            details_results.extend(v)
+        self.assertEqual(sorted(results), sorted(details_results))
+
     def test_simple_patients_selection(self):
         query = """
         SELECT e/ehr_id/value AS patient_identifier
@@ -252,6 +312,8 @@ def suite():
     suite.addTest(TestQueryService('test_deep_where_query'))
     suite.addTest(TestQueryService('test_simple_parametric_query'))
     suite.addTest(TestQueryService('test_simple_patients_selection'))
+    suite.addTest(TestQueryService('test_paged_query'))
+    suite.addTest(TestQueryService('test_ndjson_query'))
     return suite
 
 if __name__ == '__main__':
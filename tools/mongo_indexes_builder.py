@@ -0,0 +1,117 @@
+import sys, argparse
+from collections import Counter
+
+from pyehr.aql.parser import Parser
+from pyehr.ehr.services.dbmanager.dbservices import DBServices
+from pyehr.ehr.services.dbmanager.querymanager.prepared_queries import QueryParameters
+from pyehr.utils.services import get_service_configuration
+from pyehr.utils import get_logger
+
+
+class MongoIndexesBuilder(object):
+    """
+    Create the indexes used by pyEHR on the MongoDB collections of the given environment. If a
+    query log is given, AQL queries are translated into MongoDB queries and an index is created for
+    the record fields used most often in their conditions.
+    """
+
+    def __init__(self, conf_file, db_label=None, log_file=None, log_level='INFO'):
+        conf = get_service_configuration(conf_file)
+        db_conf = conf.get_db_configuration()
+        index_conf = conf.get_index_configuration()
+        if db_conf['driver'] != 'mongodb':
+            sys.exit('ERROR: indexes can be built only for the mongodb driver')
+        if db_label:
+            db_conf['database'] = '%s_%s' % (db_conf['database'], db_label)
+            index_conf['database'] = '%s_%s' % (index_conf['database'], db_label)
+        self.db_service = DBServices(**db_conf)
+        self.db_service.set_index_service(**index_conf)
+        self.logger = get_logger('mongo_indexes_builder', log_file=log_file, log_level=log_level)
+
+    def _read_query_log(self, query_log):
+        # a new query begins with every line starting with a SELECT statement
+        queries = list()
+        with open(query_log) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                if line.strip().upper().startswith('SELECT') or not queries:
+                    queries.append(line)
+                else:
+                    queries[-1] += line
+        self.logger.info('Loaded %d queries from %s', len(queries), query_log)
+        return queries
+
+    def _count_condition_fields(self, queries, driver):
+        fields_counter = Counter()
+        parser = Parser()
+        for query in queries:
+            try:
+                query_model = parser.parse(query)
+            except Exception, e:
+                self.logger.warning('Skipping query that can\'t be parsed: %s', e)
+                continue
+            structures_mapping = self.db_service.index_service.map_aql_contains(query_model.location.containers)
+            # parameters are replaced by placeholders, only field names are used
+            structures_queries = driver.build_queries(query_model, self.db_service.patients_repository,
+                                                      self.db_service.ehr_repository, QueryParameters(),
+                                                      structures_mapping)
+            for qs in structures_queries.itervalues():
+                for q in qs:
+                    fields_counter.update(driver.get_condition_fields(q['condition']))
+        return fields_counter
+
+    def run(self, query_log=None, max_indexes=10, min_occurrences=1, drop_unused=False):
+        for repository in (self.db_service.patients_repository, self.db_service.ehr_repository,
+                           self.db_service.ehr_versioning_repository):
+            if not repository:
+                continue
+            drf = self.db_service._get_drivers_factory(repository)
+            with drf.get_driver() as driver:
+                indexes = driver.init_structure()
+                self.logger.info('Base indexes for collection %s: %s', repository, ', '.join(indexes))
+        if not query_log:
+            return
+        drf = self.db_service._get_drivers_factory(self.db_service.ehr_repository)
+        with drf.get_driver() as driver:
+            fields_counter = self._count_condition_fields(self._read_query_log(query_log), driver)
+            fields = [f for f, occurrences in fields_counter.most_common(max_indexes)
+                      if occurrences >= min_occurrences]
+            for f in fields:
+                self.logger.info('Creating index for field %s (used by %d conditions)', f, fields_counter[f])
+            driver.init_structure({'condition_fields': fields})
+            if drop_unused:
+                for name, field in driver.get_condition_indexes().iteritems():
+                    if field not in fields:
+                        self.logger.info('Dropping index %s for field %s', name, field)
+                        driver.drop_condition_index(field)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser('Create the indexes used by pyEHR queries on MongoDB collections')
+    parser.add_argument('--conf-file', type=str, required=True,
+                        help='pyEHR configuration file')
+    parser.add_argument('--db-label', type=str, default=None,
+                        help='A label that will be added to database\'s name specified in conf file')
+    parser.add_argument('--query-log', type=str, default=None,
+                        help='A file with the AQL queries used to choose the fields that will be indexed')
+    parser.add_argument('--max-indexes', type=int, default=10,
+                        help='The max number of indexes created for query conditions (default 10)')
+    parser.add_argument('--min-occurrences', type=int, default=1,
+                        help='Index only fields used by at least this number of conditions (default 1)')
+    parser.add_argument('--drop-unused', action='store_true',
+                        help='Drop the indexes for query conditions on fields that are no longer selected')
+    parser.add_argument('--log-file', type=str, help='LOG file (default=stderr)')
+    parser.add_argument('--log-level', type=str, default='INFO',
+                        help='LOG level (default INFO)')
+    return parser
+
+
+def main(argv):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    indexes_builder = MongoIndexesBuilder(args.conf_file, args.db_label, args.log_file, args.log_level)
+    indexes_builder.run(args.query_log, args.max_indexes, args.min_occurrences, args.drop_unused)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])